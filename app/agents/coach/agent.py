@@ -1,11 +1,9 @@
 import os
-import json
 import logging
 import pytz
 import uuid
 import time
-import re
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
 # Import thư viện SDK thế hệ mới của Google
 from google import genai
@@ -14,21 +12,45 @@ from google.genai import types
 from app.core.notification import send_telegram_msg
 from app.core.database import (
     save_message, load_history_for_gemini, clear_history,
-    get_training_loads, get_recent_runs_log, update_run_gcs_score
+    get_training_loads, get_recent_runs_log, get_user, get_mean_max_bests,
+    get_race_predictions, get_volume_rollups, get_activity_segments
 )
 from app.agents.coach.utils import calculate_trimp, calculate_acwr
+from app.agents.coach.mean_max import format_duration, format_pace
+from app.agents.coach.pre_analysis import build_run_report, format_run_report
+from app.agents.coach.race_predictor import format_prediction, format_race_time
+from app.services.race_prediction import latest_prediction
 from app.services.rag_memory import rag_db
+from app.agents.coach.tool_registry import tool_registry
+from app.core.config import periodization
+from app.core.events import ACTIVITY_SAVED, HARVEST_COMPLETED, MEMORY_WRITTEN, MESSAGE_SAVED
+from app.core.telemetry import telemetry
 
 # Configure logging
 logger = logging.getLogger("AI_COACH")
 client = genai.Client()
 
+llm_tokens = telemetry.counter("llm_tokens_total", "Token Gemini theo loại (prompt/output)")
+llm_retries = telemetry.counter("llm_retries_total", "Số lần gọi lại Gemini do lỗi 429")
+
+def _record_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, attr in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, attr, None)
+        if count:
+            llm_tokens.inc(count, kind=kind)
+
 # ==========================================
 # 🧰 BỘ CÔNG CỤ (TOOLS) CHO AI AGENT
 # ==========================================
 # Ghi chú: Docstring (""") bên dưới cực kỳ quan trọng. 
 # Gemini sẽ đọc nó để hiểu khi nào cần lấy công cụ nào ra dùng.
+# @tool_registry.tool giữ nguyên docstring/signature, thêm cache theo lượt chat + TTL ngắn.
+# `user_id` do server gắn (tool_registry.turn(user_id=chat_id)) và bị ẩn khỏi signature model nhìn thấy.
 
+@tool_registry.tool(ttl=60, invalidate_on=(ACTIVITY_SAVED, HARVEST_COMPLETED))
 def check_training_status(user_id: str) -> str:
     """
     Kiểm tra chỉ số chấn thương (ACWR) và tải trọng tập luyện (TRIMP) hiện tại của vận động viên.
@@ -39,6 +61,7 @@ def check_training_status(user_id: str) -> str:
     acwr_data = calculate_acwr(loads.get("acute_load_7d", 0), loads.get("chronic_load_28d", 0))
     return f"ACWR: {acwr_data['acwr']} ({acwr_data['status']}) | Acute Load 7d: {loads.get('acute_load_7d')} | Chronic Load 28d: {loads.get('chronic_load_28d')}"
 
+@tool_registry.tool(ttl=60, invalidate_on=(ACTIVITY_SAVED, HARVEST_COMPLETED))
 def get_recent_workouts(user_id: str) -> str:
     """
     Lấy danh sách 5 bài tập chạy bộ gần nhất của vận động viên trên Strava.
@@ -47,14 +70,15 @@ def get_recent_workouts(user_id: str) -> str:
     logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: get_recent_workouts cho User {user_id}")
     return get_recent_runs_log(user_id, limit=5)
 
-def search_long_term_memory(query: str) -> str:
+@tool_registry.tool(ttl=120, invalidate_on=(MEMORY_WRITTEN,))
+def search_long_term_memory(user_id: str, query: str) -> str:
     """
     Tìm kiếm trí nhớ dài hạn (ChromaDB) để lấy bối cảnh về các bài chạy cũ, lời khuyên quá khứ, hoặc chấn thương đã từng xảy ra.
     Hãy gọi công cụ này khi user nhắc đến chuyện tuần trước, tháng trước, hoặc cần so sánh hiện tại với quá khứ.
     """
-    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: search_long_term_memory với từ khóa '{query}'")
+    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: search_long_term_memory cho User {user_id} với từ khóa '{query}'")
     try:
-        results = rag_db.recall(query=query, domain="coach", n_results=3)
+        results = rag_db.recall(query=query, domain="coach", n_results=3, user_id=str(user_id))
         if not results or not results.get('documents') or not results['documents'][0]:
             return "Không tìm thấy ký ức nào liên quan trong não bộ."
         docs = results['documents'][0]
@@ -62,22 +86,92 @@ def search_long_term_memory(query: str) -> str:
     except Exception as e:
         return f"Lỗi truy xuất ký ức: {e}"
 
-def get_total_run_stats(user_id: str) -> str:
+@tool_registry.tool(ttl=120, invalidate_on=(MEMORY_WRITTEN, MESSAGE_SAVED))
+def search_keyword_memory(user_id: str, keywords: str) -> str:
     """
-    Lấy thống kê tổng quãng đường chạy (km) của vận động viên (trong 4 tuần qua, năm nay, và toàn thời gian).
-    Hãy gọi công cụ này khi user hỏi về tổng số km đã chạy.
+    Tra cứu nhanh theo TỪ KHÓA CỤ THỂ trong lịch sử chat và hồ sơ các bài chạy cũ (ví dụ: tên giải chạy, "tuần trước", "chấn thương", tên bài tập).
+    Hãy ưu tiên công cụ này khi câu hỏi chứa từ khóa rõ ràng. Nếu không khớp từ khóa nào, hệ thống sẽ tự tìm theo ngữ nghĩa.
     """
-    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: get_total_run_stats cho User {user_id}")
+    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: search_keyword_memory cho User {user_id} với từ khóa '{keywords}'")
     try:
-        with open("data/athlete_stats.json", "r") as f:
-            stats = json.load(f)
-        return f"Volume 4 tuần qua: {stats.get('recent_run_totals', 0):.1f} km | Năm nay (YTD): {stats.get('ytd_run_totals', 0):.1f} km"
+        hits = rag_db.hybrid_recall(query=keywords, user_id=user_id, domain="coach", n_results=3)
+        if not hits:
+            return "Không tìm thấy ký ức nào khớp từ khóa."
+        return "\n".join([f"- Ký ức ({h['source']}): {h['content']}" for h in hits])
     except Exception as e:
-        return "Chưa có dữ liệu thống kê tổng km (Auto-Harvest chưa thu thập)."
+        return f"Lỗi truy xuất ký ức: {e}"
+
+@tool_registry.tool(ttl=300, invalidate_on=(ACTIVITY_SAVED, HARVEST_COMPLETED))
+def get_total_run_stats(user_id: str, weeks: int = 8) -> str:
+    """
+    Lấy thống kê volume chạy của vận động viên: tổng km 4 tuần qua, tháng này, năm nay (YTD), toàn thời gian,
+    kèm bảng `weeks` tuần gần nhất (km, thời gian, TRIMP, số buổi, bài dài nhất).
+    Hãy gọi công cụ này khi user hỏi về tổng số km đã chạy hoặc volume theo tuần/tháng.
+    """
+    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: get_total_run_stats cho User {user_id}")
+    months = get_volume_rollups(user_id, "month")
+    if not months:
+        return "Chưa có dữ liệu volume (chưa có bài chạy nào trong cơ sở dữ liệu)."
+    today = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).date()
+    this_week = today - timedelta(days=today.weekday())
+    recent = get_volume_rollups(user_id, "week", (this_week - timedelta(weeks=max(4, int(weeks)) - 1)).isoformat())
+    last_4w = sum(w["distance_km"] for w in recent if w["period"] >= (this_week - timedelta(weeks=3)).isoformat())
+    month_km = sum(m["distance_km"] for m in months if m["period"] == today.isoformat()[:7])
+    ytd_km = sum(m["distance_km"] for m in months if m["period"] >= f"{today.year}-01")
+    all_km = sum(m["distance_km"] for m in months)
+    lines = [f"Volume 4 tuần qua: {last_4w:.1f} km | Tháng này: {month_km:.1f} km | Năm nay (YTD): {ytd_km:.1f} km | "
+             f"Toàn thời gian: {all_km:.1f} km ({sum(m['runs'] for m in months)} buổi)"]
+    for w in recent[-max(1, int(weeks)):]:
+        iso_year, iso_week, _ = date.fromisoformat(w["period"]).isocalendar()
+        lines.append(f"- {iso_year}-W{iso_week:02d} (từ {w['period']}): {w['distance_km']:.1f} km | {w['moving_time_min'] / 60:.1f} h | "
+                     f"TRIMP {w['trimp']:.0f} | {w['runs']} buổi | dài nhất {w['long_run_km']:.1f} km")
+    return "\n".join(lines)
+
+@tool_registry.tool(ttl=300, invalidate_on=(ACTIVITY_SAVED, HARVEST_COMPLETED))
+def get_best_efforts(user_id: str, days: int = 90) -> str:
+    """
+    Lấy pace tốt nhất (mean-max) theo từng thời lượng từ 5 giây đến 2 giờ trong `days` ngày gần đây, kèm nhịp tim TB của nỗ lực đó và kỷ lục mọi thời điểm.
+    Hãy gọi công cụ này khi user hỏi về PR, nỗ lực tốt nhất (ví dụ "best 20 phút trong 90 ngày"), hoặc xu hướng thể lực/tốc độ.
+    """
+    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: get_best_efforts cho User {user_id} ({days} ngày)")
+    since = (datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).date() - timedelta(days=max(1, int(days)))).isoformat()
+    recent = {r["duration_s"]: r for r in get_mean_max_bests(user_id, since)}
+    all_time = {r["duration_s"]: r for r in get_mean_max_bests(user_id)}
+    if not all_time:
+        return "Chưa có dữ liệu mean-max (cần stream Strava của các bài chạy)."
+    lines = []
+    for duration_s, best in all_time.items():
+        cur = recent.get(duration_s)
+        recent_txt = (f"{format_pace(cur['speed_mps'])} (HR {cur['hr_bpm'] or '-'}, {str(cur['start_date'])[:10]})"
+                      if cur else "không có")
+        lines.append(f"- {format_duration(duration_s)}: {days} ngày qua {recent_txt} | "
+                     f"Kỷ lục {format_pace(best['speed_mps'])} ({str(best['start_date'])[:10]})")
+    return "\n".join(lines)
+
+@tool_registry.tool(ttl=300, invalidate_on=(ACTIVITY_SAVED, HARVEST_COMPLETED))
+def get_race_prediction(user_id: str) -> str:
+    """
+    Lấy dự đoán thành tích cho cự ly mục tiêu (mặc định bán marathon) kèm dải tin cậy 80%, các mô hình thành phần
+    (Riegel, VDOT, Critical Speed), xu hướng CTL và Goal Confidence Score (GCS) so với mục tiêu, cùng thay đổi so với 4 tuần trước.
+    Hãy gọi công cụ này khi user hỏi về khả năng đạt mục tiêu, thời gian về đích dự kiến, GCS hoặc VDOT.
+    """
+    logger.info(f"[TOOL-USE] 🤖 AI tự động gọi Tool: get_race_prediction cho User {user_id}")
+    current = latest_prediction(user_id)
+    if not current:
+        return "Chưa đủ dữ liệu để dự đoán (cần các bài chạy có stream với nỗ lực >= 10 phút trong 90 ngày)."
+    text = f"Dự đoán (tính ngày {current['as_of']}): {format_prediction(current)}"
+    month_ago = (date.fromisoformat(current["as_of"]) - timedelta(days=28)).isoformat()
+    previous = get_race_predictions(user_id, until=month_ago)
+    if previous:
+        before = previous[-1]
+        text += (f"\n4 tuần trước ({before['as_of']}): {format_race_time(before['predicted_s'])}"
+                 + (f", GCS {before['gcs']}%" if before.get("gcs") is not None else ""))
+    return text
+
 # (Giữ lại hàm này cho luồng phân tích CSV tự động)
-def get_rag_context(query: str, n_results: int = 2) -> str:
+def get_rag_context(query: str, user_id: str, n_results: int = 2) -> str:
     try:
-        results = rag_db.recall(query=query, domain="coach", n_results=n_results)
+        results = rag_db.recall(query=query, domain="coach", n_results=n_results, user_id=str(user_id))
         if not results or not results.get('documents') or not results['documents'][0]:
             return "No relevant long-term memories found."
         docs = results['documents'][0]
@@ -85,48 +179,58 @@ def get_rag_context(query: str, n_results: int = 2) -> str:
     except Exception as e:
         return "Memory retrieval failed."
 
+def get_user_profile_text(user_id: str, profile: dict, config: dict) -> str:
+    """
+    Hồ sơ VĐV cho prompt: `user_profile` trong config chỉ mô tả Tenant chính (.env);
+    VĐV khác dùng thông tin của chính họ trong bảng users.
+    """
+    if str(user_id) == os.getenv("TELEGRAM_CHAT_ID"):
+        return config.get("user_profile", "")
+    parts = [f"Name: {profile.get('name') or 'Runner'}", f"Sex: {profile.get('sex') or 'M'}"]
+    if profile.get("current_goal"):
+        parts.append(f"Goal: {profile['current_goal']}")
+    if profile.get("race_date"):
+        parts.append(f"Race date: {profile['race_date']}")
+    return " | ".join(parts)
+
 # ==========================================
 # LUỒNG 1: PHÂN TÍCH BÀI CHẠY TỰ ĐỘNG (GIỮ NGUYÊN)
 # ==========================================
-def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str, meta_data: dict, config: dict):
+def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str, meta_data: dict, config: dict,
+                            user_id: str = None, streams: dict = None):
     activity_id = str(activity_id) 
     logger.info(f"[COACH AGENT] Analyzing run: {activity_name} (ID: {activity_id})")
 
     tz = pytz.timezone('Asia/Ho_Chi_Minh')
     now = datetime.now(tz)
-    chat_id = os.getenv("TELEGRAM_CHAT_ID")
-    
-    race_date_str = config.get("race_date", "")
-    current_goal = config.get("current_goal", "Duy trì thể lực (Maintenance)")
+    # Mặc định là Tenant chính (.env); Webhook truyền user_id theo owner_id của Strava
+    chat_id = user_id or os.getenv("TELEGRAM_CHAT_ID")
+    profile = (get_user(chat_id) if chat_id else None) or {}
     
-    if race_date_str:
-        try:
-            race_date = datetime.strptime(race_date_str, "%Y-%m-%d").replace(tzinfo=tz)
-            days_to_race = (race_date - now).days
-            weeks_to_race = max(0, days_to_race // 7)
-            if weeks_to_race <= 2: phase = "Tapering (Giảm tải, giữ điểm rơi)"
-            elif weeks_to_race <= 6: phase = "Peak Training (Tích lũy tối đa)"
-            else: phase = "Base/Build (Xây dựng nền tảng)"
-            countdown_text = f"{weeks_to_race} weeks ({days_to_race} days) remaining to Race Day."
-        except ValueError:
-            phase = "Off-season / Maintenance"
-            countdown_text = "Invalid race date format."
-    else:
-        phase = "Off-season / Base Building"
-        countdown_text = f"No race scheduled. Current Focus: {current_goal}."
-
-    max_hr = int(config.get("max_hr", 185))
-    rest_hr = int(config.get("rest_hr", 55))
+    period = periodization(
+        profile.get("race_date") or config.get("race_date"),
+        profile.get("current_goal") or config.get("current_goal"),
+        now.date(),
+    )
+    phase, countdown_text = period.phase_detail, period.countdown_text
+
+    max_hr = int(profile.get("max_hr") or config.get("max_hr", 185))
+    rest_hr = int(profile.get("rest_hr") or config.get("rest_hr", 55))
+    sex = profile.get("sex") or config.get("sex") or "M"
     
-    loads = get_training_loads(str(chat_id))
-    acute_load_7d = loads.get("acute_load_7d", 0)
-    chronic_load_28d = loads.get("chronic_load_28d", 0)
-    acwr_data = calculate_acwr(acute_load_7d, chronic_load_28d)
-    recent_log = get_recent_runs_log(str(chat_id), limit=5)
-    long_term_memory = get_rag_context(query=f"Phân tích bài chạy {activity_name}", n_results=2)
+    with telemetry.span("agent.db_context"):
+        loads = get_training_loads(str(chat_id))
+        acute_load_7d = loads.get("acute_load_7d", 0)
+        chronic_load_28d = loads.get("chronic_load_28d", 0)
+        acwr_data = calculate_acwr(acute_load_7d, chronic_load_28d)
+        recent_log = get_recent_runs_log(str(chat_id), limit=5)
+        prediction = latest_prediction(str(chat_id)) if chat_id else None
+    with telemetry.span("agent.rag"):
+        long_term_memory = (get_rag_context(query=f"Phân tích bài chạy {activity_name}", user_id=chat_id, n_results=2)
+                            if chat_id else "No relevant long-term memories found.")
 
     system_instruction = config.get("system_instruction", "You are an elite AI Running Coach.")
-    user_profile = config.get("user_profile", "")
+    user_profile = get_user_profile_text(chat_id, profile, config)
     
     science_context = f"""
     [TEMPORAL & PERIODIZATION CONTEXT]
@@ -140,6 +244,10 @@ def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str,
     - ACWR Ratio: {acwr_data['acwr']} -> Status: {acwr_data['status']}
     *Rule:* If ACWR Status is 'Danger Zone', YOU MUST warn the runner to take a rest.
 
+    [RACE PREDICTION (deterministic: Riegel / VDOT / Critical Speed + CTL trend)]
+    {format_prediction(prediction)}
+    *Rule:* The Goal Confidence Score (GCS) is the value above. Cite it exactly, do not estimate your own.
+
     [RECENT WORKOUTS LOG]
     {recent_log}
     
@@ -152,8 +260,20 @@ def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str,
     output_format = config.get("output_format", "Output in Plain Text.")
     current_model_name = config.get("model_name", "models/gemini-2.0-flash")
 
+    # Báo cáo tính sẵn (split, vùng tim, decoupling, GAP, interval, sự kiện) thay cho CSV thô
+    with telemetry.span("agent.pre_analysis"):
+        bests = {r["duration_s"]: r["speed_mps"] for r in get_mean_max_bests(str(chat_id))} if chat_id else {}
+        # Cấu trúc bài đã lưu (cùng nhãn với weekly aggregates / recent-runs log), chưa có mới segment lại
+        structure = meta_data.get('structure') or get_activity_segments(activity_id)
+        report = build_run_report(streams, meta_data, max_hr, rest_hr, sex,
+                                  stream_metrics=meta_data.get('stream_metrics'), all_time_bests=bests,
+                                  structure=structure)
+    include_csv = bool(csv_data) and (report is None or config.get("prompt_raw_samples", False))
+
     meta_text = f"[DEVICE] {meta_data.get('device_name', 'Unknown')}\n"
-    if meta_data.get('splits'):
+    if report:
+        meta_text += f"[PRE-ANALYSIS REPORT] (computed exactly from per-second streams; trust these numbers)\n{format_run_report(report)}"
+    elif meta_data.get('splits'):
         meta_text += "\n".join([f"Km {s['km']}: {s['pace']:.2f} m/s | HR {int(s['hr'])}" for s in meta_data.get('splits', [])])
 
     try:
@@ -177,12 +297,15 @@ def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str,
     [TASK] {task_description}
     [METADATA] {meta_text}
     [FORMAT] {output_format}
-    [RAW CSV]
+    """
+    if include_csv:
+        prompt += f"""[RAW CSV]
     {csv_data}
     """
+    logger.info(f"[COACH AGENT] Prompt size: {len(prompt)} chars (raw CSV {'included' if include_csv else 'omitted'})")
 
     if os.getenv("LOG_AI_PROMPTS", "False").lower() == "true":
-        debug_prompt = prompt.replace(csv_data, f"<CSV_DATA_OMITTED_FOR_LOGS> ({len(csv_data)} bytes)")
+        debug_prompt = prompt.replace(csv_data, f"<CSV_DATA_OMITTED_FOR_LOGS> ({len(csv_data)} bytes)") if include_csv else prompt
         logger.info(f"\n{'='*20} [AI PROMPT: RUN ANALYSIS] {'='*20}\n[SYSTEM INSTRUCTION & RAG CONTEXT]:\n{full_instruction}\n\n[USER PROMPT]:\n{debug_prompt}\n{'='*65}\n")
 
     max_retries = 3
@@ -190,19 +313,15 @@ def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str,
     
     for attempt in range(max_retries):
         try:
-            response = chat_session.send_message(prompt) 
+            with telemetry.span("agent.llm", model=current_model_name, attempt=attempt + 1):
+                response = chat_session.send_message(prompt) 
+            _record_usage(response)
             analysis_text = response.text
             
-            gcs_pattern = r"(?:🎯|GOAL CONFIDENCE SCORE|GCS).*?[:\s](\d{1,3})%"
-            gcs_match = re.search(gcs_pattern, analysis_text, re.IGNORECASE | re.UNICODE)
-            
-            if gcs_match:
-                gcs_score = int(gcs_match.group(1))
-                gcs_score = max(0, min(100, gcs_score))
-                update_run_gcs_score(activity_id, gcs_score)
             break
         except Exception as api_err:
             if "429" in str(api_err):
+                llm_retries.inc()
                 time.sleep(60)
             else:
                 break
@@ -211,14 +330,15 @@ def analyze_run_with_gemini(activity_id: str, activity_name: str, csv_data: str,
 
     try:
         if chat_id:
-            save_message(str(chat_id), "model", f"[ANALYSIS] {activity_name}: {analysis_text}")
-            memory_content = f"Sự kiện: VĐV chạy bài '{activity_name}' vào ngày {now.strftime('%Y-%m-%d')}.\nPhân tích:\n{analysis_text}"
-            rag_db.memorize(
-                doc_id=str(activity_id), 
-                content=memory_content, 
-                domain="coach", 
-                extra_meta={"user_id": str(chat_id), "type": "run_analysis"}
-            )
+            with telemetry.span("agent.memorize"):
+                save_message(str(chat_id), "model", f"[ANALYSIS] {activity_name}: {analysis_text}")
+                memory_content = f"Sự kiện: VĐV chạy bài '{activity_name}' vào ngày {now.strftime('%Y-%m-%d')}.\nPhân tích:\n{analysis_text}"
+                rag_db.memorize(
+                    doc_id=str(activity_id), 
+                    content=memory_content, 
+                    domain="coach", 
+                    extra_meta={"user_id": str(chat_id), "type": "run_analysis"}
+                )
         return analysis_text
     except Exception as e:
         logger.error(f"Post-Analysis Save Error: {e}")
@@ -238,26 +358,19 @@ def handle_telegram_chat(chat_id: str, text: str, config: dict):
     now = datetime.now(tz)
     now_str = now.strftime('%A, %Y-%m-%d %H:%M:%S')
 
-    race_date_str = config.get("race_date", "")
-    current_goal = config.get("current_goal", "Duy trì thể lực")
-    
-    if race_date_str:
-        try:
-            race_date = datetime.strptime(race_date_str, "%Y-%m-%d").replace(tzinfo=tz)
-            days_to_race = (race_date - now).days
-            weeks_to_race = max(0, days_to_race // 7)
-            phase = "Tapering" if weeks_to_race <= 2 else "Peak Training" if weeks_to_race <= 6 else "Base/Build"
-            countdown_text = f"{weeks_to_race} weeks ({days_to_race} days) remaining."
-        except ValueError:
-            phase, countdown_text = "Off-season", "Invalid date."
-    else:
-        phase, countdown_text = "Off-season", f"Focus: {current_goal}"
+    profile = get_user(chat_id) or {}
+    period = periodization(
+        profile.get("race_date") or config.get("race_date"),
+        profile.get("current_goal") or config.get("current_goal"),
+        now.date(),
+    )
+    phase, countdown_text = period.phase, period.countdown_text
 
     # ĐÓNG GÓI NHÂN CÁCH MỎNG (THIN PERSONA)
     # Loại bỏ hoàn toàn việc bắt Python truy xuất DB và nhồi vào đây.
     current_model_name = config.get("model_name", "models/gemini-2.0-flash")
     system_instruction = config.get("system_instruction", "You are Coach Dyno.")
-    user_profile = config.get("user_profile", "")
+    user_profile = get_user_profile_text(chat_id, profile, config)
 
     full_persona = f"""
     {system_instruction}
@@ -266,7 +379,6 @@ def handle_telegram_chat(chat_id: str, text: str, config: dict):
     - System Time: {now_str}
     - Target: {countdown_text}
     - Current Phase: {phase}
-    - User ID of the runner: {chat_id}
     
     [USER PROFILE]
     {user_profile}
@@ -274,7 +386,7 @@ def handle_telegram_chat(chat_id: str, text: str, config: dict):
     [CRITICAL INSTRUCTION FOR TOOL USE]
     - You are chatting with the user on Telegram.
     - USE TOOLS to fetch training status, recent workouts, or memory IF required.
-    - If you use a tool, always pass the 'user_id' exactly as '{chat_id}'.
+    - Tools always return data of the runner you are chatting with.
     - If you lack the tools to answer a specific part of the user's question, clearly explain that to the user. DO NOT return an empty response.
     """
 
@@ -282,8 +394,9 @@ def handle_telegram_chat(chat_id: str, text: str, config: dict):
         raw_history = load_history_for_gemini(chat_id, limit=30)
         formatted_history = [{"role": msg["role"], "parts": [{"text": msg["parts"][0]}]} for msg in raw_history]
         
-        # CẤP 4 VŨ KHÍ (Thêm get_total_run_stats)
-        ai_tools = [check_training_status, get_recent_workouts, search_long_term_memory, get_total_run_stats]
+        # CẤP 7 VŨ KHÍ (Thêm get_race_prediction - dự đoán thành tích + GCS tất định)
+        ai_tools = [check_training_status, get_recent_workouts, search_long_term_memory, search_keyword_memory,
+                    get_total_run_stats, get_best_efforts, get_race_prediction]
 
         chat_session = client.chats.create(
             model=current_model_name,
@@ -298,7 +411,9 @@ def handle_telegram_chat(chat_id: str, text: str, config: dict):
         # Nhờ tính năng AFC (Automatic Function Calling), lệnh send_message này
         # sẽ tự động gọi các hàm Python bên trên nếu AI thấy cần thiết, 
         # sau đó AI tự tổng hợp kết quả và trả về text cuối cùng.
-        response = chat_session.send_message(text)
+        with tool_registry.turn(user_id=chat_id), telemetry.span("agent.chat_llm", model=current_model_name):
+            response = chat_session.send_message(text)
+        _record_usage(response)
         # [FIX BUG] Bẫy lỗi an toàn cho NoneType
         if response.text:
             reply_text = response.text
@@ -1,63 +1,271 @@
 import os
 import json
+import time
+import zlib
 import logging
 import asyncio
-import io
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
 
-from app.agents.coach.strava_client import StravaClient
-from app.agents.coach.utils import calculate_trimp, calculate_efficiency_factor, analyze_decoupling
+from app.agents.coach.strava_client import StravaClient, pack_streams, unpack_streams
+from app.agents.coach.utils import calculate_trimp, trimp_intensity_level
+from app.agents.coach.load_engine import compute_stream_load, load_from_histogram
+from app.agents.coach.mean_max import mean_max_curve
+from app.agents.coach.stream_analytics import analyze_streams
+from app.agents.coach.segmentation import segment_run
 from app.core.config import load_config
-from app.core.database import init_db, upsert_user, save_run_activity, save_message, get_db_connection
+from app.core.database import (
+    init_db, upsert_user, get_user, save_run_activity, save_strava_credentials, get_active_users,
+    get_activity_load, save_activity_load, has_mean_max_curve, save_mean_max_curve,
+    get_stream_metrics, save_stream_metrics, save_activity_streams, get_activity_streams_blob,
+    get_activity_segments, save_activity_segments, get_activity_laps, save_activity_laps
+)
 from app.core.notification import send_telegram_msg
+from app.core.events import event_bus, HARVEST_COMPLETED
+from app.core.telemetry import telemetry
 from app.services.rag_memory import rag_db
 
 logger = logging.getLogger("AI_COACH")
 
-def harvest_data():
-    """Luồng Auto-harvest chạy ngầm theo lịch Cron"""
-    logger.info("[HARVEST] Starting Strava data harvest process...")
-    init_db()
-    strava_client = StravaClient()
-    config = load_config()
-    
+RUN_TYPES = ['Run', 'TrailRun', 'VirtualRun']
+
+# ==========================================
+# 👥 MULTI-TENANT HELPERS
+# ==========================================
+def seed_primary_user(config: Dict):
+    """Đưa Tenant chính (.env + config.json) vào bảng users để đi chung luồng fan-out."""
     chat_id = os.getenv("TELEGRAM_CHAT_ID")
-    athlete_id = os.getenv("STRAVA_ATHLETE_ID")
+    if not chat_id:
+        return
+    upsert_user(
+        user_id=chat_id, name="Primary Runner",
+        max_hr=int(config.get("max_hr", 185)), rest_hr=int(config.get("rest_hr", 55)),
+        race_date=config.get("race_date") or None, current_goal=config.get("current_goal") or None,
+        sex=config.get("sex") or None,
+    )
+    user = get_user(chat_id) or {}
+    refresh_token = os.getenv("STRAVA_REFRESH_TOKEN")
+    # Chỉ lấy token từ .env lần đầu; về sau token đã xoay vòng nằm trong DB
+    if refresh_token and not user.get("strava_refresh_token"):
+        save_strava_credentials(chat_id, os.getenv("STRAVA_ATHLETE_ID"), refresh_token)
+
+def get_strava_client(user: Optional[Dict]) -> StravaClient:
+    """StravaClient gắn với token của 1 VĐV, token mới (khi refresh) được ghi ngược lại DB."""
+    if not user or not user.get("strava_refresh_token"):
+        return StravaClient()
+    user_id = user["user_id"]
+
+    def persist(refresh_token, access_token, expires_at, athlete_id=None):
+        # Tenant chính thường không khai STRAVA_ATHLETE_ID -> lấy athlete.id ngay lần refresh đầu,
+        # nếu không Webhook (luôn có owner_id) sẽ không tra ra user
+        if not athlete_id and not user.get("strava_athlete_id"):
+            athlete_id = client.get_athlete_id()
+        if athlete_id:
+            user["strava_athlete_id"] = str(athlete_id)
+        save_strava_credentials(user_id, athlete_id, refresh_token, access_token, expires_at)
+
+    client = StravaClient(
+        refresh_token=user["strava_refresh_token"],
+        access_token=user.get("strava_access_token"),
+        expires_at=user.get("strava_token_expires_at") or 0,
+        on_token_refresh=persist,
+    )
+    return client
+
+def harvest_offset(user_id: str, window_s: int) -> int:
+    """Vị trí cố định (giây) của VĐV trong cửa sổ harvest: băm ổn định -> dàn đều tải, không dồn vào phút :15."""
+    return zlib.crc32(str(user_id).encode()) % max(1, window_s)
+
+def _to_activity_data(activity: Dict, max_hr: int, rest_hr: int, sex: str = "M") -> Dict:
+    dist_km = activity.get('distance', 0) / 1000
+    moving_min = activity.get('moving_time', 0) / 60
+    avg_hr = activity.get('average_heartrate', 0)
+    trimp_data = calculate_trimp(moving_min, avg_hr, max_hr, rest_hr, sex)
+    return {
+        'activity_id': str(activity.get('id')),
+        'name': activity.get('name', 'Unknown Run'),
+        'start_date': activity.get('start_date_local'),
+        'distance_km': round(dist_km, 2),
+        'moving_time_min': round(moving_min, 2),
+        'avg_hr': int(avg_hr),
+        'max_hr': int(activity.get('max_heartrate', 0)),
+        'suffer_score': int(activity.get('suffer_score', 0) or 0),
+        'trimp_score': trimp_data.get('trimp', 0.0),
+        'intensity_level': trimp_data.get('intensity_level'),
+    }
+
+def fetch_streams(strava_client: StravaClient, user_id: str, activity_id: str) -> Optional[Dict]:
+    """Stream của 1 bài: bản đã lưu trong SQLite trước, chưa có mới gọi Strava (rồi lưu lại)."""
+    activity_id = str(activity_id)
+    blob = get_activity_streams_blob(activity_id)
+    if blob:
+        return unpack_streams(blob)
+    streams = strava_client.get_activity_streams(activity_id)
+    if streams and "time" in streams:
+        save_activity_streams(activity_id, user_id, len(streams["time"]), pack_streams(streams))
+    return streams
+
+def apply_stream_load(strava_client: StravaClient, user_id: str, activity_data: Dict,
+                      max_hr: int, rest_hr: int, sex: str) -> Optional[Dict]:
+    """
+    Thay TRIMP theo nhịp tim TB bằng TRIMP tích phân từ stream từng giây (bài interval không bị đánh giá thấp).
+    Stream chỉ được tải 1 lần/bài; lần sau tính lại từ histogram đã lưu theo thông số hiện tại.
+    """
+    if not activity_data.get('avg_hr'):
+        return None  # Không đeo HR -> giữ TRIMP 0 như cũ
+    activity_id = activity_data['activity_id']
+    stored = get_activity_load(activity_id)
+    if stored and stored.get("bpm_seconds"):
+        load = load_from_histogram(stored["bpm_start"], stored["bpm_seconds"], max_hr, rest_hr, sex)
+    else:
+        streams = fetch_streams(strava_client, user_id, activity_id)
+        if not streams or "heartrate" not in streams:
+            return None
+        with telemetry.span("load_engine.stream_load", samples=len(streams["heartrate"])):
+            load = compute_stream_load(streams.get("time"), streams["heartrate"], max_hr, rest_hr, sex)
+        if not load:
+            return None
+        save_activity_load(activity_id, user_id, load, max_hr, rest_hr, sex)
+    activity_data['trimp_score'] = load['bannister_trimp']
+    activity_data['intensity_level'] = trimp_intensity_level(load['bannister_trimp'])
+    return load
+
+def apply_mean_max(strava_client: StravaClient, user_id: str, activity_data: Dict):
+    """Curve tốc độ tốt nhất theo thời lượng (1 lần/bài, dùng chung stream đã cache với load engine)."""
+    activity_id = activity_data['activity_id']
+    if not activity_data.get('distance_km') or has_mean_max_curve(activity_id):
+        return
+    streams = fetch_streams(strava_client, user_id, activity_id)
+    if not streams or "time" not in streams or "distance" not in streams:
+        return
+    with telemetry.span("mean_max.curve", samples=len(streams["time"])):
+        curve = mean_max_curve(streams["time"], streams["distance"], streams.get("heartrate"))
+    save_mean_max_curve(activity_id, user_id, activity_data.get('start_date'), curve)
+
+def apply_stream_analytics(strava_client: StravaClient, user_id: str, activity_id: str) -> Optional[Dict]:
+    """Decoupling/GAP/drift/độ ổn định của 1 bài: đọc bản đã lưu, chưa có thì tính từ stream rồi lưu."""
+    activity_id = str(activity_id)
+    metrics = get_stream_metrics(activity_id)
+    if metrics:
+        return metrics
+    streams = fetch_streams(strava_client, user_id, activity_id)
+    if not streams:
+        return None
+    with telemetry.span("stream_analytics.analyze", samples=len(streams.get("time", []))):
+        metrics = analyze_streams(streams)
+    if metrics:
+        save_stream_metrics(activity_id, user_id, metrics)
+    return metrics
+
+def fetch_laps(strava_client: StravaClient, activity_id: str, laps: Optional[List[Dict]] = None) -> List[Dict]:
+    """
+    Lap bấm tay của 1 bài (gọi sau fetch_streams, lưu cùng hàng stream để relabel dùng lại):
+    `laps` có sẵn (Webhook đã tải Activity Detail) -> lưu; chưa lưu -> tải Activity Detail 1 lần.
+    """
+    if laps is None:
+        laps = get_activity_laps(activity_id)
+        if laps is not None:
+            return laps
+        laps = strava_client.get_activity_laps(activity_id)
+        if laps is None:
+            return []  # Lỗi mạng/quota: segment theo stream, lần sau thử tải lại
+    save_activity_laps(activity_id, laps)
+    return laps
+
+def apply_segmentation(strava_client: StravaClient, user_id: str, activity_data: Dict,
+                       max_hr: int, rest_hr: int, laps: Optional[List[Dict]] = None) -> Optional[Dict]:
+    """Cấu trúc bài + nhãn buổi tập (easy/long/tempo/interval) có gợi ý từ lap bấm tay, tính 1 lần/bài."""
+    activity_id = activity_data['activity_id']
+    stored = get_activity_segments(activity_id)
+    if stored:
+        return stored
+    streams = fetch_streams(strava_client, user_id, activity_id)
+    if not streams:
+        return None
+    laps = fetch_laps(strava_client, activity_id, laps)
+    with telemetry.span("segmentation.segment_run", samples=len(streams.get("time", []))):
+        result = segment_run(streams, max_hr, rest_hr, laps)
+    if result:
+        save_activity_segments([segment_row(activity_id, user_id, activity_data.get('start_date'), result)])
+    return result
 
-    if not chat_id or not athlete_id: return
+def segment_row(activity_id: str, user_id: str, start_date: Optional[str], result: Dict) -> tuple:
+    return (str(activity_id), str(user_id), start_date, result["session_type"], result["work_count"],
+            result["work_time_s"], result["source"], json.dumps(result["segments"], separators=(",", ":")))
 
-    max_hr = int(config.get("max_hr", 185))
-    rest_hr = int(config.get("rest_hr", 55))
-    upsert_user(user_id=chat_id, name="Primary Runner", max_hr=max_hr, rest_hr=rest_hr)
+def enrich_from_streams(strava_client: StravaClient, user_id: str, activity_data: Dict,
+                        max_hr: int, rest_hr: int, sex: str) -> Optional[Dict]:
+    """Mọi chỉ số dựa trên stream của 1 bài (TRIMP tích phân, mean-max, cấu trúc, analytics) - stream tải 1 lần."""
+    apply_stream_load(strava_client, user_id, activity_data, max_hr, rest_hr, sex)
+    apply_mean_max(strava_client, user_id, activity_data)
+    apply_segmentation(strava_client, user_id, activity_data, max_hr, rest_hr)
+    return apply_stream_analytics(strava_client, user_id, activity_data['activity_id'])
 
-    athlete_stats = strava_client.get_athlete_stats(athlete_id)
-    if athlete_stats:
-        os.makedirs("data", exist_ok=True)
-        with open("data/athlete_stats.json", "w", encoding="utf-8") as file:
-            json.dump(athlete_stats, file, indent=4)
+# ==========================================
+# 🌾 AUTO-HARVEST (FAN-OUT)
+# ==========================================
+@telemetry.traced("harvest.user")
+def harvest_user(user: Dict):
+    """Thu hoạch dữ liệu Strava của 1 VĐV."""
+    chat_id = user["user_id"]
+    max_hr = int(user.get("max_hr") or 185)
+    rest_hr = int(user.get("rest_hr") or 55)
+    sex = user.get("sex") or "M"
+    strava_client = get_strava_client(user)
 
     recent_activities = strava_client.get_recent_activities(limit=10)
     for activity in reversed(recent_activities):
-        if activity.get('type') in ['Run', 'TrailRun', 'VirtualRun']:
-            dist_km = activity.get('distance', 0) / 1000
-            moving_min = activity.get('moving_time', 0) / 60
-            avg_hr = activity.get('average_heartrate', 0)
-            trimp_data = calculate_trimp(moving_min, avg_hr, max_hr, rest_hr)
-            
-            activity_data = {
-                'activity_id': str(activity.get('id')),
-                'name': activity.get('name', 'Unknown Run'),
-                'start_date': activity.get('start_date_local'),
-                'distance_km': round(dist_km, 2),
-                'moving_time_min': round(moving_min, 2),
-                'avg_hr': int(avg_hr),
-                'max_hr': int(activity.get('max_heartrate', 0)),
-                'suffer_score': int(activity.get('suffer_score', 0) or 0),
-                'trimp_score': trimp_data.get('trimp', 0.0)
-            }
+        if activity.get('type') in RUN_TYPES:
+            activity_data = _to_activity_data(activity, max_hr, rest_hr, sex)
+            enrich_from_streams(strava_client, chat_id, activity_data, max_hr, rest_hr, sex)
             save_run_activity(user_id=chat_id, activity_data=activity_data)
-    logger.info("[HARVEST] Cron Auto-Harvest complete.")
+    event_bus.publish(HARVEST_COMPLETED, user_id=chat_id)
+
+def plan_harvest(config: Dict) -> List[Tuple[Dict, int]]:
+    """VĐV đang active kèm offset (giây) của họ trong cửa sổ `harvest_window_minutes`, sắp theo offset."""
+    users = get_active_users()
+    window_s = int(float(config.get("scheduler", {}).get("harvest_window_minutes", 30)) * 60) if len(users) > 1 else 0
+    return sorted(((u, harvest_offset(u["user_id"], window_s)) for u in users), key=lambda p: p[1])
+
+def harvest_data(schedule: Optional[Callable[[Dict, int], None]] = None):
+    """
+    Luồng Auto-harvest chạy ngầm theo lịch Cron, fan-out qua mọi VĐV đang active.
+    Mỗi VĐV có 1 offset cố định trong cửa sổ `harvest_window_minutes` (dàn đều tải):
+    - Có `schedule(user, offset_s)` (scheduler): chỉ lên lịch từng VĐV rồi trả về ngay,
+      không giữ thread của pool suốt cửa sổ.
+    - Không có (chạy tay từ CLI): harvest ngay mọi VĐV, song song tối đa `harvest_concurrency`.
+    Số request luôn bị chặn bởi rate limiter dùng chung của Strava App.
+    """
+    logger.info("[HARVEST] Starting Strava data harvest process...")
+    init_db()
+    config = load_config()
+    seed_primary_user(config)
+
+    plan = plan_harvest(config)
+    if not plan:
+        logger.info("[HARVEST] No active users with Strava credentials.")
+        return
+
+    if schedule:
+        for user, offset_s in plan:
+            schedule(user, offset_s)
+        logger.info(f"[HARVEST] Scheduled {len(plan)} users over {plan[-1][1]}s.")
+        return
+
+    concurrency = max(1, int(config.get("scheduler", {}).get("harvest_concurrency", 4)))
+    start = time.monotonic()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="harvest") as pool:
+        futures = {pool.submit(telemetry.bind(harvest_user), user): user["user_id"] for user, _ in plan}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(f"[HARVEST] User {futures[future]} failed: {e}")
+
+    logger.info(f"[HARVEST] Auto-Harvest complete: {len(plan) - failed}/{len(plan)} users in {time.monotonic() - start:.1f}s.")
 
 async def execute_manual_sync(chat_id: str, limit: int = 3, days_back: int = None):
     """Luồng đồng bộ lịch sử chạy tay: Bảo vệ Quota, cấy Ký ức Python trực tiếp."""
@@ -65,10 +273,14 @@ async def execute_manual_sync(chat_id: str, limit: int = 3, days_back: int = Non
     send_telegram_msg(chat_id, f"⏳ Đang thu hoạch dữ liệu Strava ({'30 ngày qua' if days_back else f'{limit} bài gần nhất'})...")
     
     init_db()
-    strava_client = StravaClient()
     config = load_config()
-    max_hr = int(config.get("max_hr", 185))
-    rest_hr = int(config.get("rest_hr", 55))
+    if chat_id == os.getenv("TELEGRAM_CHAT_ID"):
+        seed_primary_user(config)
+    user = get_user(chat_id) or {}
+    strava_client = get_strava_client(user)
+    max_hr = int(user.get("max_hr") or config.get("max_hr", 185))
+    rest_hr = int(user.get("rest_hr") or config.get("rest_hr", 55))
+    sex = user.get("sex") or config.get("sex") or "M"
     
     recent_activities = strava_client.get_recent_activities(limit=limit)
     target_activities = []
@@ -91,25 +303,14 @@ async def execute_manual_sync(chat_id: str, limit: int = 3, days_back: int = Non
     analyzed_count = 0
     for activity in reversed(target_activities):
         act_id = str(activity.get('id'))
-        if activity.get('type') not in ['Run', 'TrailRun', 'VirtualRun']: continue
+        if activity.get('type') not in RUN_TYPES: continue
 
         # 1. Luôn tính toán và cập nhật SQLite (Lệnh REPLACE sẽ tự động chữa lành/ghi đè an toàn)
         dist_km = activity.get('distance', 0) / 1000
         moving_min = activity.get('moving_time', 0) / 60
         avg_hr = activity.get('average_heartrate', 0)
-        trimp_data = calculate_trimp(moving_min, avg_hr, max_hr, rest_hr)
-        
-        activity_data = {
-            'activity_id': act_id,
-            'name': activity.get('name', 'Unknown Run'),
-            'start_date': activity.get('start_date_local'),
-            'distance_km': round(dist_km, 2),
-            'moving_time_min': round(moving_min, 2),
-            'avg_hr': int(avg_hr),
-            'max_hr': int(activity.get('max_heartrate', 0)),
-            'suffer_score': int(activity.get('suffer_score', 0) or 0),
-            'trimp_score': trimp_data.get('trimp', 0.0)
-        }
+        activity_data = _to_activity_data(activity, max_hr, rest_hr, sex)
+        stream_metrics = enrich_from_streams(strava_client, chat_id, activity_data, max_hr, rest_hr, sex) or {}
         save_run_activity(user_id=chat_id, activity_data=activity_data)
         loaded_count += 1
         
@@ -117,35 +318,21 @@ async def execute_manual_sync(chat_id: str, limit: int = 3, days_back: int = Non
         existing_memory = rag_db.collection.get(ids=[act_id])
         if existing_memory and existing_memory['ids']:
             logger.info(f"[SYNC] Bỏ qua RAG cho {act_id} vì Ký ức đã tồn tại trong não bộ.")
-            continue # Nếu có rồi thì bỏ qua phần tính Streams bên dưới để tiết kiệm CPU
+            continue
             
-        # 3. Nạp Ký ức Python cho những bài chạy bị thiếu (như các bài bị lỗi 429 trước đây)
+        # 3. Nạp Ký ức Python cho những bài chạy bị thiếu (chỉ số stream đã tính sẵn ở bước 1, không tải lại CSV)
         logger.info(f"[SYNC] Đang vá lỗ hổng Ký ức cho bài chạy {act_id}...")
-        act_name, csv_data, meta_data = strava_client.get_activity_data(act_id)
-        ef_val, decoupling_val, cadence_avg, stride_avg = 0.0, 0.0, 0, 0.0
+        act_name = activity_data['name']
+        ef_val = stream_metrics.get('ef') or 0.0
+        decoupling_val = stream_metrics.get('decoupling_pct') or 0.0
+        cadence_avg = int(stream_metrics.get('cadence_avg') or 0)
+        stride_avg = stream_metrics.get('stride_avg_m') or 0.0
         pace_str = f"{int(moving_min/dist_km)}:{int(((moving_min/dist_km)%1)*60):02d}" if dist_km > 0 else "0:00"
 
-        if csv_data:
-            try:
-                df = pd.read_csv(io.StringIO(csv_data))
-                if not df.empty:
-                    decoupling_val = analyze_decoupling(df)
-                    ef_val = calculate_efficiency_factor(df['Velocity_m_s'].mean() * 60, df['HR_bpm'].mean())
-                    
-                    # [FIX BUG] Xử lý an toàn cho Cadence (Tránh lỗi NaN)
-                    c_mean = df['Cadence_spm'].mean() if 'Cadence_spm' in df.columns else 0
-                    cadence_avg = int(c_mean) if pd.notna(c_mean) else 0
-                    
-                    # [FIX BUG] Xử lý an toàn cho Stride
-                    s_mean = df['Stride_m'].mean() if 'Stride_m' in df.columns else 0.0
-                    stride_avg = round(s_mean, 2) if pd.notna(s_mean) else 0.0
-            except Exception as e:
-                logger.error(f"[SYNC] Lỗi phân tích Streams cho {act_id}: {e}")
-
         memory_content = (
             f"[HỒ SƠ BÀI CHẠY LỊCH SỬ]\n"
             f"- Cơ bản: Ngày {activity_data['start_date'][:10]}, '{act_name}'. Quãng đường {dist_km:.2f}km, thời gian {moving_min:.1f} phút.\n"
-            f"- Tải trọng (Load): Tim TB {int(avg_hr)} bpm (Max {int(activity_data['max_hr'])}). TRIMP: {activity_data['trimp_score']} ({trimp_data.get('intensity_level')}).\n"
+            f"- Tải trọng (Load): Tim TB {int(avg_hr)} bpm (Max {int(activity_data['max_hr'])}). TRIMP: {activity_data['trimp_score']} ({activity_data['intensity_level']}).\n"
             f"- Hiệu suất (Performance): Pace TB {pace_str} min/km. Chỉ số hiệu quả (EF): {ef_val}. Độ trôi nhịp tim (Decoupling): {decoupling_val}%.\n"
             f"- Kỹ thuật (Form): Cadence {cadence_avg} spm, Sải chân {stride_avg} mét."
         )
@@ -159,6 +346,7 @@ async def execute_manual_sync(chat_id: str, limit: int = 3, days_back: int = Non
         analyzed_count += 1
         await asyncio.sleep(1)
 
+    event_bus.publish(HARVEST_COMPLETED, user_id=chat_id)
     send_telegram_msg(chat_id, f"🎉 **Hoàn tất Đồng bộ Lịch sử!**\nĐã bổ sung {loaded_count} bài chạy vào Cơ sở dữ liệu và cấy {analyzed_count} Gói Ký ức (EF, Decoupling, TRIMP) vào não bộ AI. Số liệu ACWR đã được cân bằng.")
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import logging
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.agents.coach.utils import banister_coefficients
+from app.core.config import hr_zones
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# ❤️ STREAM LOAD ENGINE (tải trọng từ nhịp tim từng giây)
+# ==========================================
+# Mọi chỉ số được suy ra từ 1 histogram "số giây theo từng bpm" (np.bincount, O(n) trên stream):
+# Bannister tích phân, Edwards, thời gian theo vùng đều chỉ còn là phép tính trên ~200 ô.
+# Histogram được lưu lại -> đổi Max/Rest HR hay giới tính chỉ cần tính lại từ histogram, không gọi Strava.
+
+MAX_GAP_S = 10.0       # Khoảng trống lớn hơn (auto-pause, mất tín hiệu) chỉ tính tối đa 10 giây
+MIN_VALID_BPM = 30
+MAX_VALID_BPM = 250
+EDWARDS_ZONES = ((0.50, 1), (0.60, 2), (0.70, 3), (0.80, 4), (0.90, 5))  # (% HRmax tối thiểu, hệ số)
+
+def bpm_histogram(time_s: Optional[Sequence[float]], hr: Sequence[float]) -> Tuple[int, np.ndarray]:
+    """
+    Số giây ở mỗi mức bpm. Mẫu i được gán thời lượng t[i] - t[i-1] (mẫu đầu: 1 giây), cắt ở MAX_GAP_S.
+    Returns (bpm_start, seconds) với seconds[k] = số giây ở (bpm_start + k) bpm.
+    """
+    hr = np.asarray(hr, dtype=np.float64)
+    if time_s is None or len(time_s) != len(hr):
+        dt = np.ones(len(hr))
+    else:
+        t = np.asarray(time_s, dtype=np.float64)
+        dt = np.empty(len(t))
+        if len(t):
+            dt[0] = 1.0
+            np.subtract(t[1:], t[:-1], out=dt[1:])
+        np.clip(dt, 0.0, MAX_GAP_S, out=dt)
+
+    valid = np.isfinite(hr) & (hr >= MIN_VALID_BPM) & (hr <= MAX_VALID_BPM)
+    if not valid.any():
+        return 0, np.zeros(0)
+    bpm = np.rint(hr[valid]).astype(np.int64)
+    start = int(bpm.min())
+    seconds = np.bincount(bpm - start, weights=dt[valid])
+    return start, seconds
+
+def load_from_histogram(bpm_start: int, seconds: Sequence[float], max_hr: int, rest_hr: int,
+                        sex: str = "M") -> Dict:
+    """Bannister TRIMP tích phân + Edwards TRIMP + thời gian theo vùng Karvonen từ histogram bpm."""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    zone_names = [name for name, _, _ in hr_zones(max_hr, rest_hr)]
+    if seconds.size == 0 or seconds.sum() == 0:
+        return {"bannister_trimp": 0.0, "edwards_trimp": 0.0, "hr_seconds": 0,
+                "zone_seconds": {"Z0": 0, **{name: 0 for name in zone_names}}}
+    bpm = np.arange(bpm_start, bpm_start + seconds.size, dtype=np.float64)
+    minutes = seconds / 60.0
+
+    # Bannister: sum(dt * HRR * a * e^(b * HRR)) trên từng giây
+    a, b = banister_coefficients(sex)
+    hrr = np.clip((bpm - rest_hr) / max(1, max_hr - rest_hr), 0.0, None)
+    bannister = float(np.sum(minutes * hrr * a * np.exp(b * hrr)))
+
+    # Edwards: phút ở mỗi vùng %HRmax x hệ số 1..5 (dưới 50% không tính)
+    pct_max = bpm / max_hr
+    thresholds = np.array([t for t, _ in EDWARDS_ZONES])
+    factors = np.concatenate(([0], [f for _, f in EDWARDS_ZONES]))
+    edwards = float(np.sum(minutes * factors[np.searchsorted(thresholds, pct_max, side="right")]))
+
+    # Vùng Karvonen (giống Dashboard/prompt): Z0 = dưới Z1, trên Max HR tính vào Z5
+    bounds = np.array([lo for _, lo, _ in hr_zones(max_hr, rest_hr)])
+    zone_idx = np.searchsorted(bounds, bpm, side="right")  # 0 = Z0, 1..5 = Z1..Z5
+    per_zone = np.bincount(zone_idx, weights=seconds, minlength=len(bounds) + 1)
+    zone_seconds = {"Z0": int(round(per_zone[0]))}
+    zone_seconds.update({name: int(round(per_zone[i + 1])) for i, name in enumerate(zone_names)})
+
+    return {
+        "bannister_trimp": round(bannister, 2),
+        "edwards_trimp": round(edwards, 2),
+        "hr_seconds": int(round(seconds.sum())),
+        "zone_seconds": zone_seconds,
+    }
+
+def compute_stream_load(time_s: Optional[Sequence[float]], hr: Sequence[float], max_hr: int, rest_hr: int,
+                        sex: str = "M") -> Optional[Dict]:
+    """Tải trọng 1 bài chạy từ stream nhịp tim. None nếu không có nhịp tim hợp lệ."""
+    if hr is None or len(hr) == 0:
+        return None
+    bpm_start, seconds = bpm_histogram(time_s, hr)
+    if seconds.size == 0:
+        return None
+    metrics = load_from_histogram(bpm_start, seconds, max_hr, rest_hr, sex)
+    metrics.update(bpm_start=bpm_start, bpm_seconds=np.round(seconds, 1).tolist())
+    return metrics
@@ -0,0 +1,65 @@
+import logging
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 🏅 MEAN-MAX CURVE (tốc độ tốt nhất theo thời lượng)
+# ==========================================
+# Stream được nội suy về lưới 1 giây; quãng đường Strava vốn là mảng cộng dồn nên tốc độ tốt nhất
+# trong cửa sổ d giây = max(dist[t+d] - dist[t]) / d -> O(n) cho mỗi thời lượng, không vòng lặp lồng.
+# Nhịp tim đi kèm = nhịp tim TB trong đúng cửa sổ đó (tổng cộng dồn) -> cặp pace/HR để so thể lực.
+
+DURATIONS_S = (5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 5400, 7200)
+MAX_SPEED_MPS = 12.0  # Nhanh hơn ~1:23/km là nhiễu GPS, bỏ qua
+
+def format_duration(seconds: int) -> str:
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}min"
+    return f"{seconds / 3600:g}h"
+
+def format_pace(speed_mps: float) -> str:
+    if not speed_mps:
+        return "-"
+    sec_per_km = 1000 / speed_mps
+    return f"{int(sec_per_km // 60)}:{int(round(sec_per_km % 60)):02d}/km"
+
+def mean_max_curve(time_s: Sequence[float], distance_m: Sequence[float],
+                   hr: Optional[Sequence[float]] = None,
+                   durations: Sequence[int] = DURATIONS_S) -> Dict[int, Dict]:
+    """
+    {duration_s: {"speed_mps", "hr_bpm"}} cho các thời lượng ngắn hơn bài chạy.
+    time_s / distance_m là stream Strava (distance cộng dồn, time tính cả lúc dừng).
+    """
+    t = np.asarray(time_s, dtype=np.float64)
+    dist = np.asarray(distance_m, dtype=np.float64)
+    if t.size < 2 or t.size != dist.size:
+        return {}
+    grid = np.arange(t[0], t[-1] + 1)
+    dist_1s = np.interp(grid, t, dist)
+
+    hr_cum = None
+    if hr is not None and len(hr) == t.size:
+        hr_1s = np.interp(grid, t, np.asarray(hr, dtype=np.float64))
+        hr_cum = np.concatenate(([0.0], np.cumsum(hr_1s)))
+
+    curve = {}
+    for d in durations:
+        if d >= grid.size:
+            break
+        gains = dist_1s[d:] - dist_1s[:-d]
+        speeds = gains / d
+        speeds[speeds > MAX_SPEED_MPS] = 0.0
+        best = int(np.argmax(speeds))
+        if speeds[best] <= 0:
+            continue
+        point = {"speed_mps": round(float(speeds[best]), 3), "hr_bpm": None}
+        if hr_cum is not None:
+            # Cửa sổ quãng đường [best, best + d] tương ứng các mẫu HR best+1 .. best+d
+            point["hr_bpm"] = round(float(hr_cum[best + d + 1] - hr_cum[best + 1]) / d, 1)
+        curve[d] = point
+    return curve
@@ -0,0 +1,121 @@
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.agents.coach.load_engine import compute_stream_load
+from app.agents.coach.mean_max import mean_max_curve, format_duration, format_pace
+from app.agents.coach.stream_analytics import analyze_streams, format_stream_metrics
+from app.agents.coach.segmentation import segment_run, format_structure, rolling_mean, runs
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 🧾 PRE-ANALYSIS REPORT (đặc trưng tính sẵn cho prompt)
+# ==========================================
+# Python tính chính xác các con số (split, vùng tim, drift, cấu trúc bài, sự kiện) rồi đưa vào prompt
+# dưới dạng báo cáo gọn; LLM chỉ còn việc diễn giải. CSV thô chỉ gửi khi bật `prompt_raw_samples`.
+
+MIN_PAUSE_S = 60
+REPORT_PEAKS_S = (60, 300, 1200)
+
+def _events(t: np.ndarray, velocity: np.ndarray, hr: Optional[np.ndarray], max_hr: int,
+            streams: Dict[str, np.ndarray]) -> List[str]:
+    events = []
+    stopped = velocity < 0.5
+    pauses = [(s, e) for s, e in runs(stopped) if t[min(e, t.size - 1)] - t[s] >= MIN_PAUSE_S]
+    gaps = np.flatnonzero(np.diff(t) >= MIN_PAUSE_S)  # Auto-pause: thiết bị ngừng ghi
+    if pauses or gaps.size:
+        total = sum(float(t[min(e, t.size - 1)] - t[s]) for s, e in pauses) + float(np.diff(t)[gaps].sum())
+        events.append(f"{len(pauses) + gaps.size} pause(s) >= {MIN_PAUSE_S}s, total {total / 60:.1f} min")
+    if hr is not None:
+        peak = int(hr.max())
+        if peak >= max_hr:
+            events.append(f"HR peak {peak} bpm >= profile Max HR {max_hr} (check Max HR or sensor spike)")
+        dropouts = [(s, e) for s, e in runs(hr < 30) if e - s >= 10]
+        if dropouts:
+            events.append(f"HR sensor dropout x{len(dropouts)}")
+        # Gai nhịp tim: nhảy > 25 bpm trong 5 giây (thường do dây đeo/quang học)
+        jumps = np.abs(hr[5:] - hr[:-5]) > 25 if hr.size > 5 else np.zeros(0, dtype=bool)
+        if jumps.sum() >= 3:
+            events.append(f"HR spikes/jumps detected ({int(jumps.sum())} samples) - optical HR may be unreliable")
+    watts = streams.get("watts")
+    if watts is not None and len(watts) == t.size and np.any(watts > 0):
+        events.append(f"Power max {int(np.max(watts))} W, avg {int(np.mean(watts[watts > 0]))} W")
+    altitude = streams.get("altitude")
+    if altitude is not None and len(altitude) == t.size:
+        alt = rolling_mean(np.asarray(altitude, dtype=np.float64), 5)
+        gain = float(np.clip(np.diff(alt), 0, None).sum())
+        if gain >= 30:
+            events.append(f"Elevation gain ~{int(gain)} m")
+    return events
+
+def build_run_report(streams: Optional[Dict[str, np.ndarray]], meta: Dict, max_hr: int, rest_hr: int,
+                     sex: str = "M", stream_metrics: Optional[Dict] = None,
+                     all_time_bests: Optional[Dict[int, float]] = None,
+                     structure: Optional[Dict] = None) -> Optional[Dict]:
+    """
+    Báo cáo đặc trưng của 1 bài chạy. None nếu không có stream (caller tự fallback sang CSV).
+    all_time_bests: {duration_s: speed_mps} (envelope) để đánh dấu PR.
+    """
+    if not streams or streams.get("time") is None or len(streams["time"]) < 2:
+        return None
+    t = np.asarray(streams["time"], dtype=np.float64)
+    n = t.size
+
+    def stream(key):
+        values = streams.get(key)
+        return np.asarray(values, dtype=np.float64) if values is not None and len(values) == n else None
+
+    velocity = stream("velocity_smooth")
+    if velocity is None:
+        return None
+    hr = stream("heartrate")
+    metrics = stream_metrics or analyze_streams(streams) or {}
+
+    report = {"metrics": metrics, "zones": None, "splits": meta.get("splits") or [], "laps": meta.get("laps") or [],
+              "structure": structure or segment_run(streams, max_hr, rest_hr, meta.get("laps")), "peaks": [], "events": _events(t, velocity, hr, max_hr, streams)}
+    if hr is not None:
+        load = compute_stream_load(t, hr, max_hr, rest_hr, sex)
+        if load:
+            report["zones"] = {"seconds": load["zone_seconds"], "bannister_trimp": load["bannister_trimp"],
+                               "edwards_trimp": load["edwards_trimp"]}
+    distance = stream("distance")
+    if distance is not None:
+        curve = mean_max_curve(t, distance, hr, durations=REPORT_PEAKS_S)
+        for duration_s, point in curve.items():
+            best = (all_time_bests or {}).get(duration_s)
+            report["peaks"].append({"duration_s": duration_s, **point,
+                                    "is_pr": best is not None and point["speed_mps"] >= best})
+    return report
+
+def format_run_report(report: Dict) -> str:
+    """Báo cáo dạng text gọn (mỗi mục 1-2 dòng) cho prompt."""
+    lines = [f"Stream metrics: {format_stream_metrics(report.get('metrics'))}"]
+
+    zones = report.get("zones")
+    if zones:
+        total = sum(zones["seconds"].values()) or 1
+        zone_txt = ", ".join(f"{name} {sec / 60:.0f}' ({sec / total * 100:.0f}%)"
+                             for name, sec in zones["seconds"].items() if sec)
+        lines.append(f"HR zones (Karvonen): {zone_txt} | TRIMP {zones['bannister_trimp']} | Edwards {zones['edwards_trimp']}")
+
+    if report.get("splits"):
+        split_txt = " ".join(f"{s['km']}:{format_pace(s['pace']).replace('/km', '')}@{int(s['hr'] or 0)}"
+                             for s in report["splits"])
+        lines.append(f"Km splits (km:pace@HR): {split_txt}")
+    if report.get("laps") and len(report["laps"]) > 1:
+        lap_txt = " | ".join(f"{int(l['distance'] or 0)}m {format_pace(l['pace'])} HR {int(l['hr'] or 0)}"
+                             for l in report["laps"])
+        lines.append(f"Device laps: {lap_txt}")
+
+    lines.append(f"Workout structure: {format_structure(report.get('structure'))}")
+
+    if report.get("peaks"):
+        peak_txt = ", ".join(f"{format_duration(p['duration_s'])} {format_pace(p['speed_mps'])}"
+                             + (f" HR {p['hr_bpm']:.0f}" if p.get("hr_bpm") else "") + (" (ALL-TIME PR)" if p["is_pr"] else "")
+                             for p in report["peaks"])
+        lines.append(f"Peak efforts: {peak_txt}")
+    if report.get("events"):
+        lines.append(f"Notable events: {'; '.join(report['events'])}")
+    return "\n".join(f"- {line}" for line in lines)
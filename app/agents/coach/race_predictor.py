@@ -0,0 +1,187 @@
+import re
+import math
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 🔮 RACE PREDICTOR (Riegel + VDOT + Critical Speed + xu hướng tải)
+# ==========================================
+# Đầu vào là mean-max bests trong WINDOW_DAYS ngày (đã lưu sẵn theo từng bài) và chuỗi TRIMP theo ngày:
+# 1. Riegel: T2 = T1 x (D2/D1)^1.06 từ các nỗ lực >= 10 phút, lấy dự đoán nhanh nhất (nỗ lực trong bài tập là cận dưới).
+# 2. VDOT (Daniels-Gilbert): VDOT tốt nhất từ các nỗ lực đó, giải ngược thời gian cho cự ly đích.
+# 3. Critical Speed: hồi quy tuyến tính quãng đường = CS x t + D' trên các điểm 3-30 phút;
+#    vượt quá CS_HOLD_S thì nối tiếp bằng Riegel (CS không giữ được tới 1h30).
+# Kết quả = trung vị các phương pháp, hiệu chỉnh theo xu hướng CTL 4 tuần; độ lệch giữa các phương pháp
+# quyết định độ rộng dải tin cậy, GCS = xác suất (phân phối chuẩn) về đích dưới thời gian mục tiêu.
+# Có ngày đua: xu hướng CTL được ngoại suy tới race day (hiệu chỉnh lớn dần theo số ngày còn lại, có trần)
+# và dải tin cậy nới rộng theo căn bậc hai số tuần còn lại -> dự đoán/GCS mô tả ngày đua, không phải hôm nay.
+
+HM_DISTANCE_M = 21097.5
+RACE_DISTANCES = {"5k": 5000.0, "10k": 10000.0, "hm": HM_DISTANCE_M, "fm": 42195.0}
+RIEGEL_EXPONENT = 1.06
+WINDOW_DAYS = 90
+MIN_EFFORT_S = 600
+CS_MIN_S, CS_MAX_S = 180, 1800
+CS_HOLD_S = 1800
+CTL_TREND_DAYS = 28
+MAX_TREND_ADJUST = 0.02      # Xu hướng tải chỉnh tối đa ±2% thời gian dự đoán
+BASE_SIGMA = 0.025           # Sai số nền của các mô hình ngoại suy (~2.5%)
+MAX_HORIZON_DAYS = 112       # Ngoại suy tới race day tối đa 16 tuần (xa hơn coi như 16 tuần)
+MAX_PROJECTION_ADJUST = 0.03 # Xu hướng tải ngoại suy tới race day chỉnh thêm tối đa ±3%
+HORIZON_SIGMA = 0.004        # Sai số cộng thêm mỗi căn bậc hai tuần còn lại tới race day
+BAND_Z = 1.2816              # Dải 80%
+
+_GOAL_DISTANCES = (
+    (r"\b(hm|half|21k|21[.,]1)", "hm"),
+    (r"\b(fm|full|marathon|42k|42[.,]2)", "fm"),
+    (r"\b10\s?k", "10k"),
+    (r"\b5\s?k", "5k"),
+)
+
+def format_race_time(seconds: Optional[float]) -> str:
+    if not seconds:
+        return "-"
+    s = int(round(seconds))
+    return f"{s // 3600}:{s % 3600 // 60:02d}:{s % 60:02d}" if s >= 3600 else f"{s // 60}:{s % 60:02d}"
+
+def parse_goal(goal: Optional[str]) -> Tuple[float, Optional[int]]:
+    """'Sub 1:45 HM' -> (21097.5, 6300). Không rõ cự ly -> bán marathon; không rõ giờ -> target None."""
+    text = (goal or "").lower()
+    key = next((k for pattern, k in _GOAL_DISTANCES if re.search(pattern, text)), "hm")
+    distance = RACE_DISTANCES[key]
+    match = re.search(r"(\d{1,2}):(\d{2})(?::(\d{2}))?", text)
+    if match:
+        a, b, c = int(match.group(1)), int(match.group(2)), match.group(3)
+        if c is not None:
+            return distance, a * 3600 + b * 60 + int(c)
+        # h:mm cho HM/FM, mm:ss cho 5K/10K
+        return distance, (a * 3600 + b * 60) if distance >= HM_DISTANCE_M else (a * 60 + b)
+    match = re.search(r"sub\s*(\d{1,3})", text)
+    if match:
+        value = int(match.group(1))
+        return distance, value * 3600 if distance >= HM_DISTANCE_M and value <= 6 else value * 60
+    return distance, None
+
+def riegel_time(distance_m: float, time_s: float, target_m: float, exponent: float = RIEGEL_EXPONENT) -> float:
+    return time_s * (target_m / distance_m) ** exponent
+
+def vdot(distance_m, time_s):
+    """VDOT (Daniels-Gilbert) từ thành tích, vectorized."""
+    t_min = np.asarray(time_s, dtype=np.float64) / 60
+    v = np.asarray(distance_m, dtype=np.float64) / t_min
+    vo2 = -4.60 + 0.182258 * v + 0.000104 * v ** 2
+    pct_max = 0.8 + 0.1894393 * np.exp(-0.012778 * t_min) + 0.2989558 * np.exp(-0.1932605 * t_min)
+    return vo2 / pct_max
+
+def time_from_vdot(target_vdot: float, distance_m: float) -> float:
+    """Giải ngược thời gian cho cự ly (VDOT giảm đơn điệu theo thời gian -> chia đôi)."""
+    lo, hi = distance_m / 10.0, distance_m / 1.0  # 10 m/s .. 1 m/s
+    for _ in range(50):
+        mid = (lo + hi) / 2
+        if vdot(distance_m, mid) > target_vdot:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+def critical_speed(durations_s: Sequence[float], speeds_mps: Sequence[float]) -> Optional[Tuple[float, float]]:
+    """(CS m/s, D' m) từ hồi quy quãng đường theo thời gian trên các điểm CS_MIN_S..CS_MAX_S."""
+    t = np.asarray(durations_s, dtype=np.float64)
+    v = np.asarray(speeds_mps, dtype=np.float64)
+    keep = (t >= CS_MIN_S) & (t <= CS_MAX_S) & (v > 0)
+    if keep.sum() < 3:
+        return None
+    cs, d_prime = np.polyfit(t[keep], t[keep] * v[keep], 1)
+    if cs <= 0 or d_prime < -1:
+        return None
+    return float(cs), max(0.0, float(d_prime))
+
+def cs_time(cs: float, d_prime: float, distance_m: float) -> float:
+    hold_distance = cs * CS_HOLD_S + d_prime
+    if distance_m <= hold_distance:
+        return (distance_m - d_prime) / cs
+    return riegel_time(hold_distance, CS_HOLD_S, distance_m)
+
+def ctl_trend(ctl_series: Sequence[float]) -> Tuple[float, Optional[float]]:
+    """(CTL hiện tại, % thay đổi so với CTL_TREND_DAYS ngày trước)."""
+    if not ctl_series:
+        return 0.0, None
+    now = float(ctl_series[-1])
+    before = float(ctl_series[-1 - CTL_TREND_DAYS]) if len(ctl_series) > CTL_TREND_DAYS else 0.0
+    return now, (round((now - before) / before * 100, 1) if before > 1 else None)
+
+def predict_race(bests: List[Dict], ctl_series: Sequence[float], distance_m: float = HM_DISTANCE_M,
+                 target_s: Optional[int] = None, days_to_race: Optional[int] = None) -> Optional[Dict]:
+    """
+    Dự đoán thời gian về đích cho `distance_m`.
+    bests: [{duration_s, speed_mps}] (mean-max trong cửa sổ), ctl_series: CTL theo ngày (cũ -> mới).
+    days_to_race > 0: chiếu dự đoán, dải tin cậy và GCS tới ngày đua; None/<= 0: thể lực hiện tại.
+    None nếu không có nỗ lực đủ dài và không fit được CS.
+    """
+    durations = np.array([b["duration_s"] for b in bests if b.get("speed_mps")], dtype=np.float64)
+    speeds = np.array([b["speed_mps"] for b in bests if b.get("speed_mps")], dtype=np.float64)
+    result = {"distance_m": distance_m, "riegel_s": None, "vdot": None, "vdot_s": None,
+              "cs_mps": None, "d_prime_m": None, "cs_s": None}
+
+    long_efforts = durations >= MIN_EFFORT_S
+    if long_efforts.any():
+        effort_d, effort_t = durations[long_efforts] * speeds[long_efforts], durations[long_efforts]
+        result["riegel_s"] = round(float(np.min(riegel_time(effort_d, effort_t, distance_m))), 1)
+        best_vdot = float(np.max(vdot(effort_d, effort_t)))
+        result["vdot"] = round(best_vdot, 1)
+        result["vdot_s"] = round(time_from_vdot(best_vdot, distance_m), 1)
+    cs = critical_speed(durations, speeds)
+    if cs:
+        result["cs_mps"], result["d_prime_m"] = round(cs[0], 3), round(cs[1], 1)
+        result["cs_s"] = round(cs_time(cs[0], cs[1], distance_m), 1)
+
+    estimates = [result[k] for k in ("riegel_s", "vdot_s", "cs_s") if result[k]]
+    if not estimates:
+        return None
+    ctl, ctl_change = ctl_trend(ctl_series)
+    # Xu hướng 4 tuần giữ nguyên tới race day: hiệu chỉnh tăng theo (28 + số ngày còn lại) / 28, có trần
+    horizon = min(max(days_to_race or 0, 0), MAX_HORIZON_DAYS)
+    limit = MAX_TREND_ADJUST + MAX_PROJECTION_ADJUST * horizon / MAX_HORIZON_DAYS
+    adjust = float(np.clip((ctl_change or 0) / 100 * 0.1 * (1 + horizon / CTL_TREND_DAYS), -limit, limit))
+    predicted = float(np.median(estimates)) * (1 - adjust)
+
+    # Sai số tương đối: nền + độ lệch giữa các phương pháp + phạt khi ít phương pháp / ngoại suy xa
+    # + độ bất định của thể lực tới race day
+    sigma = BASE_SIGMA + (float(np.std(estimates)) / predicted if len(estimates) > 1 else 0.02)
+    longest = float(durations.max()) if durations.size else 0.0
+    if longest and predicted / longest > 3:
+        sigma += 0.01
+    sigma += HORIZON_SIGMA * math.sqrt(horizon / 7)
+    result.update({
+        "predicted_s": round(predicted, 1),
+        "low_s": round(predicted * (1 - BAND_Z * sigma), 1),
+        "high_s": round(predicted * (1 + BAND_Z * sigma), 1),
+        "sigma_pct": round(sigma * 100, 2),
+        "ctl": round(ctl, 1), "ctl_change_pct": ctl_change,
+        "target_s": target_s, "gcs": None, "days_to_race": days_to_race if horizon else None,
+    })
+    if target_s:
+        z = (target_s - predicted) / (sigma * predicted)
+        # Kẹp 1-99%: mô hình ngoại suy không bao giờ chắc chắn tuyệt đối
+        result["gcs"] = int(min(99, max(1, round(50 * (1 + math.erf(z / math.sqrt(2)))))))
+    return result
+
+def format_prediction(p: Optional[Dict]) -> str:
+    """1 dòng cho prompt / tool."""
+    if not p:
+        return "N/A (chưa đủ nỗ lực >= 10 phút có stream trong 90 ngày)"
+    dist_label = next((k.upper() for k, d in RACE_DISTANCES.items() if d == p["distance_m"]), f"{p['distance_m'] / 1000:g}K")
+    parts = [f"{dist_label} {format_race_time(p['predicted_s'])} (80%: {format_race_time(p['low_s'])}-{format_race_time(p['high_s'])})",
+             f"Riegel {format_race_time(p['riegel_s'])}",
+             f"VDOT {p['vdot'] or '-'} -> {format_race_time(p['vdot_s'])}",
+             (f"CS {p['cs_mps']} m/s, D' {p['d_prime_m']:.0f} m -> {format_race_time(p['cs_s'])}" if p.get("cs_mps") else "CS -"),
+             f"CTL {p['ctl']}" + (f" ({p['ctl_change_pct']:+.0f}% / 4 tuần)" if p.get("ctl_change_pct") is not None else "")]
+    if p.get("days_to_race"):
+        parts.append(f"Chiếu tới ngày đua (còn {p['days_to_race']} ngày)")
+    if p.get("target_s"):
+        parts.append(f"Target {format_race_time(p['target_s'])} -> GCS {p['gcs']}%")
+    return " | ".join(parts)
@@ -0,0 +1,210 @@
+import logging
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.agents.coach.mean_max import format_pace
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 🧩 SEGMENTATION (khởi động / rep / nghỉ / thả lỏng + nhãn buổi tập)
+# ==========================================
+# 1. Làm mượt tốc độ (trung bình trượt bằng cumsum), tìm mức chậm (p20) / nhanh (p90).
+# 2. Điểm đổi nhịp = ngưỡng có trễ (hysteresis) giữa 2 mức, vectorized bằng forward-fill.
+# 3. Lap bấm tay (nếu có và không phải auto-lap 1 km/1 mile) được ưu tiên làm ranh giới.
+# 4. Bài đều (không có rep): khởi động kết thúc khi HR đạt mức ổn định, thả lỏng = đoạn chậm hẳn ở cuối.
+# Chỉ dùng numpy trên mảng ~10k mẫu -> vài ms/bài, đủ rẻ để gắn nhãn lại toàn bộ lịch sử.
+
+SMOOTH_S = 15
+MIN_WORK_S = 30              # Rep ngắn hơn -> nhiễu (vượt người, đổ dốc)
+MERGE_GAP_S = 10             # Tụt tốc < 10 giây giữa rep không tính là nghỉ
+MIN_SPEED_CONTRAST = 0.15    # (nhanh - chậm) / nhanh dưới 15% -> bài đều
+MIN_MOVING_SPEED = 0.5
+MAX_WARMUP_S = 900
+MIN_COOLDOWN_S = 60
+LONG_RUN_S = 75 * 60
+TEMPO_HRR = 0.70             # %HRR TB của phần chính để tính là Tempo/Threshold
+INTERVAL_MAX_REP_S = 12 * 60
+AUTO_LAP_DISTANCES = (1000.0, 1609.34)
+
+SESSION_TYPES = ("easy", "long", "tempo", "interval")
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Trung bình trượt căn giữa bằng cumsum (O(n))."""
+    if values.size < window or window <= 1:
+        return values
+    cum = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(values.size)
+    lo = np.clip(idx - window // 2, 0, values.size)
+    hi = np.clip(idx + window - window // 2, 0, values.size)
+    return (cum[hi] - cum[lo]) / (hi - lo)
+
+def runs(mask: np.ndarray) -> List[tuple]:
+    """Các đoạn liên tiếp True -> [(start, end_exclusive)]."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+def _hysteresis(smooth: np.ndarray, lower: float, upper: float) -> np.ndarray:
+    """True khi đã vượt upper và chưa rơi xuống dưới lower (forward-fill trạng thái gần nhất)."""
+    state = np.full(smooth.size, -1, dtype=np.int8)
+    state[smooth >= upper] = 1
+    state[smooth <= lower] = 0
+    idx = np.where(state >= 0, np.arange(smooth.size), 0)
+    np.maximum.accumulate(idx, out=idx)
+    return state[idx] == 1
+
+def _lap_mask(laps: Sequence[Dict], n: int) -> Optional[np.ndarray]:
+    """Mask rep theo lap bấm tay; None nếu không có lap dùng được (auto-lap, quá ít lap, không chênh tốc)."""
+    laps = [l for l in laps or [] if l.get("start_index") is not None and l.get("end_index") is not None]
+    if len(laps) < 3:
+        return None
+    full = [l.get("distance") or 0 for l in laps[:-1]]
+    if sum(any(abs(d - a) <= a * 0.02 for a in AUTO_LAP_DISTANCES) for d in full) >= 0.8 * len(full):
+        return None
+    speeds = np.array([l.get("pace") or 0 for l in laps], dtype=np.float64)
+    if speeds.max() <= 0 or (speeds.max() - speeds.min()) / speeds.max() < MIN_SPEED_CONTRAST:
+        return None
+    threshold = (speeds.max() + speeds.min()) / 2
+    mask = np.zeros(n, dtype=bool)
+    for lap, speed in zip(laps, speeds):
+        if speed > threshold:
+            mask[max(0, int(lap["start_index"])):min(n, int(lap["end_index"]) + 1)] = True
+    return mask
+
+def _clean(mask: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """Gộp khe nghỉ quá ngắn, bỏ rep quá ngắn."""
+    for start, end in runs(~mask):
+        if start > 0 and end < mask.size and t[end] - t[start] < MERGE_GAP_S:
+            mask[start:end] = True
+    for start, end in runs(mask):
+        if t[min(end, t.size - 1)] - t[start] < MIN_WORK_S:
+            mask[start:end] = False
+    return mask
+
+def _steady_bounds(t: np.ndarray, smooth: np.ndarray, hr: Optional[np.ndarray], moving: np.ndarray) -> tuple:
+    """(warmup_end, cooldown_start) cho bài đều."""
+    n = t.size
+    limit = int(np.searchsorted(t, t[0] + MAX_WARMUP_S))
+    if hr is not None and np.any(hr[limit:] > 0):
+        target = 0.9 * np.median(hr[limit:][hr[limit:] > 0])
+        reached = np.flatnonzero(rolling_mean(hr, SMOOTH_S)[:limit] >= target)
+    else:
+        target = 0.9 * np.median(smooth[moving])
+        reached = np.flatnonzero(smooth[:limit] >= target)
+    warmup_end = int(reached[0]) if reached.size else limit
+    main_speed = np.median(smooth[warmup_end:][moving[warmup_end:]]) if moving[warmup_end:].any() else 0
+    fast_enough = np.flatnonzero(smooth >= 0.85 * main_speed)
+    cooldown_start = int(fast_enough[-1]) + 1 if fast_enough.size else n
+    if t[-1] - t[min(cooldown_start, n - 1)] < MIN_COOLDOWN_S or t[-1] - t[min(cooldown_start, n - 1)] > MAX_WARMUP_S:
+        cooldown_start = n
+    return warmup_end, max(cooldown_start, warmup_end)
+
+def _segment_stats(phase: str, start: int, end: int, t: np.ndarray, velocity: np.ndarray,
+                   distance: Optional[np.ndarray], hr: Optional[np.ndarray]) -> Dict:
+    last = min(end, t.size - 1)
+    duration = float(t[last] - t[start])
+    if distance is not None:
+        dist = float(distance[last] - distance[start])
+    else:
+        dist = float(np.sum(velocity[start:last] * np.diff(t[start:last + 1])))
+    seg = {"phase": phase, "start_s": int(t[start] - t[0]), "duration_s": int(round(duration)),
+           "distance_m": int(round(dist)), "speed_mps": round(dist / duration, 3) if duration > 0 else 0.0,
+           "avg_hr": None}
+    if hr is not None:
+        valid = hr[start:end][hr[start:end] > 0]
+        seg["avg_hr"] = int(round(valid.mean())) if valid.size else None
+    return seg
+
+def classify_session(segments: List[Dict], moving_time_s: float, max_hr: int, rest_hr: int) -> str:
+    work = [s for s in segments if s["phase"] == "work"]
+    if len(work) >= 2 and np.median([s["duration_s"] for s in work]) <= INTERVAL_MAX_REP_S:
+        return "interval"
+    main = work or [s for s in segments if s["phase"] == "steady"]
+    main_time = sum(s["duration_s"] for s in main)
+    if main_time >= 600 and all(s["avg_hr"] for s in main):
+        avg_hr = sum(s["avg_hr"] * s["duration_s"] for s in main) / main_time
+        if (avg_hr - rest_hr) / max(1, max_hr - rest_hr) >= TEMPO_HRR:
+            return "tempo"
+    if moving_time_s >= LONG_RUN_S:
+        return "long"
+    return "easy"
+
+def segment_run(streams: Dict[str, np.ndarray], max_hr: int, rest_hr: int,
+                laps: Optional[Sequence[Dict]] = None) -> Optional[Dict]:
+    """
+    Cấu trúc bài chạy: {"session_type", "segments": [{phase, start_s, duration_s, distance_m, speed_mps, avg_hr}],
+    "work_count", "work_time_s", "source"} với phase thuộc warmup / work / recovery / steady / cooldown.
+    """
+    t = streams.get("time")
+    velocity = streams.get("velocity_smooth")
+    if t is None or velocity is None or len(t) < 2 or len(velocity) != len(t):
+        return None
+    t = np.asarray(t, dtype=np.float64)
+    n = t.size
+    velocity = np.asarray(velocity, dtype=np.float64)
+    hr = streams.get("heartrate")
+    hr = np.asarray(hr, dtype=np.float64) if hr is not None and len(hr) == n else None
+    distance = streams.get("distance")
+    distance = np.asarray(distance, dtype=np.float64) if distance is not None and len(distance) == n else None
+    moving = velocity >= MIN_MOVING_SPEED
+    if moving.sum() < 2 * MIN_WORK_S:
+        return None
+    moving_time_s = float(np.sum(np.diff(t)[moving[1:]]))
+
+    smooth = rolling_mean(velocity, SMOOTH_S)
+    slow, fast = np.percentile(smooth[moving], [20, 90])
+    mask, source = _lap_mask(laps, n), "laps"
+    if mask is None:
+        source = "streams"
+        if fast > 0 and (fast - slow) / fast >= MIN_SPEED_CONTRAST:
+            band = fast - slow
+            mask = _hysteresis(smooth, slow + 0.4 * band, slow + 0.6 * band)
+        else:
+            mask = np.zeros(n, dtype=bool)
+    mask = _clean(mask, t)
+
+    work_runs = runs(mask)
+    bounds = []
+    if work_runs:
+        bounds.append(("warmup", 0, work_runs[0][0]))
+        for i, (start, end) in enumerate(work_runs):
+            bounds.append(("work", start, end))
+            next_start = work_runs[i + 1][0] if i + 1 < len(work_runs) else None
+            bounds.append(("recovery", end, next_start) if next_start is not None else ("cooldown", end, n))
+    else:
+        warmup_end, cooldown_start = _steady_bounds(t, smooth, hr, moving)
+        bounds = [("warmup", 0, warmup_end), ("steady", warmup_end, cooldown_start), ("cooldown", cooldown_start, n)]
+
+    segments = [_segment_stats(phase, start, end, t, velocity, distance, hr)
+                for phase, start, end in bounds if end > start]
+    segments = [s for s in segments if s["duration_s"] > 0]
+    work = [s for s in segments if s["phase"] == "work"]
+    return {
+        "session_type": classify_session(segments, moving_time_s, max_hr, rest_hr),
+        "segments": segments,
+        "work_count": len(work),
+        "work_time_s": sum(s["duration_s"] for s in work),
+        "source": source,
+    }
+
+def format_structure(result: Optional[Dict]) -> str:
+    """VD: 'INTERVAL (streams): WU 15:00 5:57/km | 6x work [3:00@3:47/HR170 ...] (rec avg 2:00) | CD 10:00 ...'."""
+    if not result:
+        return "N/A"
+    mmss = lambda s: f"{s // 60}:{s % 60:02d}"
+    parts = []
+    for seg in result["segments"]:
+        if seg["phase"] in ("work", "recovery"):
+            continue
+        label = {"warmup": "WU", "cooldown": "CD", "steady": "Main"}[seg["phase"]]
+        parts.append(f"{label} {mmss(seg['duration_s'])} {format_pace(seg['speed_mps'])}"
+                     + (f" HR {seg['avg_hr']}" if seg["avg_hr"] else ""))
+    work = [s for s in result["segments"] if s["phase"] == "work"]
+    if work:
+        recs = [s["duration_s"] for s in result["segments"] if s["phase"] == "recovery"]
+        reps = " ".join(f"{mmss(s['duration_s'])}@{format_pace(s['speed_mps']).replace('/km', '')}"
+                        + (f"/HR{s['avg_hr']}" if s["avg_hr"] else "") for s in work)
+        rec_txt = f" (rec avg {mmss(int(np.mean(recs)))})" if recs else ""
+        parts.insert(1 if parts and parts[0].startswith("WU") else 0, f"{len(work)}x work [{reps}]{rec_txt}")
+    return f"{result['session_type'].upper()} ({result['source']}): " + " | ".join(parts)
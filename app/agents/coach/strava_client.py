@@ -1,24 +1,163 @@
+import io
 import os
+import time
 import logging
+import threading
 import requests
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 
+from app.core.telemetry import telemetry
+
 # Initialize logging
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+class StravaRateLimiter:
+    """
+    Token bucket dùng chung cho toàn bộ app (1 Strava App = 1 quota cho mọi user).
+    Mặc định theo quota đọc của Strava: 100 request / 15 phút và 1000 request / ngày.
+    Tự hiệu chỉnh theo header X-RateLimit-Usage mà Strava trả về.
+    """
+    def __init__(self, per_15min: int = 100, per_day: int = 1000):
+        self.per_15min = per_15min
+        self.per_day = per_day
+        self._lock = threading.Lock()
+        self._short_tokens = float(per_15min)
+        self._short_updated = time.monotonic()
+        self._day_used = 0
+        self._day_key = time.strftime("%Y-%m-%d", time.gmtime())
+
+    def acquire(self):
+        """Block cho tới khi còn quota (refill liên tục theo tốc độ per_15min / 900s)."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                rate = self.per_15min / 900.0
+                self._short_tokens = min(self.per_15min, self._short_tokens + (now - self._short_updated) * rate)
+                self._short_updated = now
+                day_key = time.strftime("%Y-%m-%d", time.gmtime())
+                if day_key != self._day_key:
+                    self._day_key, self._day_used = day_key, 0
+
+                if self._day_used >= self.per_day:
+                    raise RuntimeError("Strava daily rate limit exhausted")
+                if self._short_tokens >= 1:
+                    self._short_tokens -= 1
+                    self._day_used += 1
+                    return
+                wait = (1 - self._short_tokens) / rate
+            time.sleep(min(wait, 5.0))
+
+    def update_from_headers(self, headers):
+        """Đồng bộ với số liệu thật từ Strava (quota bị chia sẻ với các process/app khác)."""
+        usage = headers.get("X-RateLimit-Usage") or headers.get("X-ReadRateLimit-Usage")
+        if not usage:
+            return
+        try:
+            short_used, day_used = (int(x) for x in usage.split(",")[:2])
+        except ValueError:
+            return
+        with self._lock:
+            self._short_tokens = min(self._short_tokens, max(0.0, self.per_15min - short_used))
+            self._day_used = max(self._day_used, day_used)
+
+# Singleton instance (chia sẻ giữa mọi StravaClient trong process)
+rate_limiter = StravaRateLimiter(
+    per_15min=int(os.getenv("STRAVA_RATE_LIMIT_15MIN", "100")),
+    per_day=int(os.getenv("STRAVA_RATE_LIMIT_DAILY", "1000")),
+)
+
+# Streams đầy đủ cho mọi phân tích (1 request/bài); 'latlng' (2 chiều) không cần nên bỏ
+STREAM_KEYS = ("time", "distance", "heartrate", "velocity_smooth", "cadence", "grade_smooth", "altitude", "moving", "watts")
+
+class StreamCache:
+    """
+    LRU nhỏ cho streams (dùng chung mọi StravaClient trong process): webhook, harvest và /sync
+    cùng chạm 1 bài chạy trong vài phút chỉ tốn 1 request. Lưu numpy float32 (~40 KB / 1k mẫu / key).
+    """
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Dict[str, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> Optional[Dict[str, np.ndarray]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Tuple, value: Dict[str, np.ndarray]):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+stream_cache = StreamCache()
+
+def pack_streams(streams: Dict[str, np.ndarray]) -> bytes:
+    """Nén dict stream (float32) thành 1 blob để lưu SQLite -> phân tích lại lịch sử không cần gọi Strava."""
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **streams)
+    return buf.getvalue()
+
+def unpack_streams(blob: bytes) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(blob)) as data:
+        return {key: data[key] for key in data.files}
+
+# Metrics
+strava_requests = telemetry.counter("strava_requests_total", "Strava API requests theo status code")
+strava_rate_limited = telemetry.counter("strava_rate_limited_total", "Số lần Strava trả 429")
+strava_limiter_wait = telemetry.histogram("strava_rate_limiter_wait_seconds", "Thời gian chờ quota của rate limiter")
+strava_token_refreshes = telemetry.counter("strava_token_refreshes_total", "Số lần refresh access token")
+cache_lookups = telemetry.counter("cache_lookups_total", "Tra cứu cache theo tầng và kết quả")
+
+def summarize_laps(laps: List[Dict]) -> List[Dict]:
+    """Lap của Activity Detail -> dạng gọn dùng cho prompt và segmentation."""
+    return [{
+        "lap_name": l.get('name'),
+        "distance": l.get('distance'),
+        "pace": l.get('average_speed'),
+        "hr": l.get('average_heartrate', 0),
+        "start_index": l.get('start_index'),  # Vị trí trong stream -> gợi ý ranh giới rep cho segmentation
+        "end_index": l.get('end_index'),
+    } for l in laps or []]
+
 class StravaClient:
-    def __init__(self):
+    def __init__(self, refresh_token: Optional[str] = None, access_token: Optional[str] = None,
+                 expires_at: Optional[int] = None, on_token_refresh: Optional[Callable] = None):
         self.client_id = os.getenv("STRAVA_CLIENT_ID")
         self.client_secret = os.getenv("STRAVA_CLIENT_SECRET")
-        self.refresh_token = os.getenv("STRAVA_REFRESH_TOKEN")
+        # Mặc định dùng token của Primary Runner trong .env; multi-tenant truyền token của từng user
+        self.refresh_token = refresh_token or os.getenv("STRAVA_REFRESH_TOKEN")
+        self.access_token = access_token
+        self.expires_at = expires_at or 0
+        self.on_token_refresh = on_token_refresh
         self.auth_url = "https://www.strava.com/oauth/token"
         self.base_url = "https://www.strava.com/api/v3"
 
+    def _request(self, method: str, url: str, **kwargs):
+        """Mọi API call đi qua rate limiter dùng chung."""
+        waited = time.perf_counter()
+        rate_limiter.acquire()
+        strava_limiter_wait.observe(time.perf_counter() - waited)
+        response = requests.request(method, url, **kwargs)
+        rate_limiter.update_from_headers(response.headers)
+        strava_requests.inc(method=method, status=response.status_code)
+        if response.status_code == 429:
+            strava_rate_limited.inc()
+            logger.warning(f"[STRAVA] 429 Rate limit hit: {url}")
+        return response
+
     def get_access_token(self):
-        """Refresh and retrieve a valid access token."""
+        """Refresh and retrieve a valid access token (cached until it expires)."""
+        if self.access_token and self.expires_at - 60 > time.time():
+            return self.access_token
         payload = {
             'client_id': self.client_id,
             'client_secret': self.client_secret,
@@ -26,9 +165,21 @@ class StravaClient:
             'grant_type': 'refresh_token'
         }
         try:
-            response = requests.post(self.auth_url, data=payload)
+            strava_token_refreshes.inc()
+            with telemetry.span("strava.token_refresh"):
+                response = requests.post(self.auth_url, data=payload)
             response.raise_for_status()
-            return response.json().get('access_token')
+            data = response.json()
+            self.access_token = data.get('access_token')
+            self.expires_at = int(data.get('expires_at', 0))
+            # Strava có thể xoay vòng refresh token -> báo lại để lưu vào DB
+            if data.get('refresh_token'):
+                self.refresh_token = data['refresh_token']
+            if self.on_token_refresh:
+                # Response refresh thường không kèm "athlete" (chỉ có ở lần authorization_code) -> có thể là None
+                athlete_id = (data.get('athlete') or {}).get('id')
+                self.on_token_refresh(self.refresh_token, self.access_token, self.expires_at, athlete_id)
+            return self.access_token
         except Exception as e:
             logger.error(f"[STRAVA] Failed to refresh token: {e}")
             return None
@@ -46,7 +197,8 @@ class StravaClient:
         try:
             # 1. Lấy Activity Detail (Chứa Laps, Splits, Best Efforts)
             act_url = f"{self.base_url}/activities/{activity_id}"
-            act_res = requests.get(act_url, headers=headers)
+            with telemetry.span("strava.activity_detail"):
+                act_res = self._request("GET", act_url, headers=headers)
             if act_res.status_code != 200:
                 logger.error(f"[STRAVA] Error fetching activity: {act_res.text}")
                 return None, None, None
@@ -71,15 +223,7 @@ class StravaClient:
                 })
 
             # Laps (Nếu có bấm Lap)
-            laps = act_data.get('laps', [])
-            laps_summary = []
-            for l in laps:
-                laps_summary.append({
-                    "lap_name": l.get('name'),
-                    "distance": l.get('distance'),
-                    "pace": l.get('average_speed'),
-                    "hr": l.get('average_heartrate', 0)
-                })
+            laps_summary = summarize_laps(act_data.get('laps', []))
 
             # Đóng gói dữ liệu bổ sung (Metadata)
             extended_meta = {
@@ -89,52 +233,53 @@ class StravaClient:
                 "suffer_score": act_data.get('suffer_score'),
                 "device_name": act_data.get('device_name'),
                 "splits": splits_summary,
+                "laps": laps_summary,
                 "best_efforts": act_data.get('best_efforts', [])
             }
             # 3. Lấy Streams (Dữ liệu từng giây)
-            streams_url = f"{act_url}/streams?keys=time,heartrate,velocity_smooth,cadence,grade_smooth,watts&key_by_type=true"
-            streams_res = requests.get(streams_url, headers=headers).json()
-
-            # 4. Xử lý DataFrame Pandas (PHẦN QUAN TRỌNG ĐÃ BỊ THIẾU TRƯỚC ĐÓ)
-            data = {
-                'Time_sec': streams_res.get('time', {}).get('data', []),
-                'HR_bpm': streams_res.get('heartrate', {}).get('data', []),
-                'Velocity_m_s': streams_res.get('velocity_smooth', {}).get('data', []),
-                'Cadence_spm': streams_res.get('cadence', {}).get('data', []),
-                'Grade_pct': streams_res.get('grade_smooth', {}).get('data', []),
-                'Power_watts': streams_res.get('watts', {}).get('data', []) # New: Power
-            }
-            
-            # Create DataFrame safely
-            df = pd.DataFrame({'Time_sec': data['Time_sec']})
-            
-            for col, values in data.items():
-                if col != 'Time_sec':
-                    s = pd.Series(values)
-                    df[col] = s.reindex(df.index)
+            streams = self.get_activity_streams(activity_id) or {}
+            with telemetry.span("strava.process_streams", samples=len(streams.get('time', []))):
+                # 4. Xử lý DataFrame Pandas (PHẦN QUAN TRỌNG ĐÃ BỊ THIẾU TRƯỚC ĐÓ)
+                as_int = lambda key: streams[key].astype(np.int64) if key in streams else []
+                data = {
+                    'Time_sec': as_int('time'),
+                    'HR_bpm': as_int('heartrate'),
+                    'Velocity_m_s': streams.get('velocity_smooth', []),
+                    'Cadence_spm': as_int('cadence'),
+                    'Grade_pct': streams.get('grade_smooth', []),
+                    'Power_watts': as_int('watts') # New: Power
+                }
 
-            # Clean data
-            df.dropna(subset=['HR_bpm', 'Velocity_m_s'], inplace=True)
-            
-            # Feature Engineering: Calculate Stride Length
-            # Formula: Stride (m) = Speed (m/s) * 60 / Cadence (spm)
-            df['Stride_m'] = df.apply(
-                lambda row: (row['Velocity_m_s'] * 60 / row['Cadence_spm']) if row['Cadence_spm'] > 0 else 0, 
-                axis=1
-            )
-
-            # Fill missing Power with 0
-            if 'Power_watts' in df.columns:
-                df['Power_watts'] = df['Power_watts'].fillna(0)
-            
-            # Round for cleaner CSV token usage
-            df = df.round({'Velocity_m_s': 2, 'Stride_m': 2, 'Grade_pct': 1})
-
-            # [NEW] DOWNSAMPLING: Lấy mẫu 5 giây/lần để giảm 80% Token rác.
-            # Cực kỳ quan trọng để bảo vệ Quota cho các bài chạy dài (Long Run).
-            df = df.iloc[::5, :]
-            # Convert to CSV string for Gemini
-            csv_data = df.to_csv(index=False)
+                # Create DataFrame safely
+                df = pd.DataFrame({'Time_sec': data['Time_sec']})
+
+                for col, values in data.items():
+                    if col != 'Time_sec':
+                        s = pd.Series(values)
+                        df[col] = s.reindex(df.index)
+
+                # Clean data
+                df.dropna(subset=['HR_bpm', 'Velocity_m_s'], inplace=True)
+
+                # Feature Engineering: Calculate Stride Length
+                # Formula: Stride (m) = Speed (m/s) * 60 / Cadence (spm)
+                df['Stride_m'] = df.apply(
+                    lambda row: (row['Velocity_m_s'] * 60 / row['Cadence_spm']) if row['Cadence_spm'] > 0 else 0, 
+                    axis=1
+                )
+
+                # Fill missing Power with 0
+                if 'Power_watts' in df.columns:
+                    df['Power_watts'] = df['Power_watts'].fillna(0)
+
+                # Round for cleaner CSV token usage
+                df = df.round({'Velocity_m_s': 2, 'Stride_m': 2, 'Grade_pct': 1})
+
+                # [NEW] DOWNSAMPLING: Lấy mẫu 5 giây/lần để giảm 80% Token rác.
+                # Cực kỳ quan trọng để bảo vệ Quota cho các bài chạy dài (Long Run).
+                df = df.iloc[::5, :]
+                # Convert to CSV string for Gemini
+                csv_data = df.to_csv(index=False)
             logger.info(f"[STRAVA] Successfully processed CSV data with Dynamics for {activity_id}")
             
             return activity_name, csv_data, extended_meta
@@ -143,6 +288,38 @@ class StravaClient:
             logger.error(f"[STRAVA] Error processing activity data: {e}")
             return None, None, None
 
+    def get_activity_streams(self, activity_id: str, keys: Tuple[str, ...] = STREAM_KEYS) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Streams từng giây của 1 bài chạy dạng {key: np.ndarray float32} (key không có trên thiết bị thì vắng mặt).
+        Có cache LRU dùng chung; None nếu lỗi.
+        """
+        cache_key = (str(activity_id), tuple(keys))
+        cached = stream_cache.get(cache_key)
+        cache_lookups.inc(cache="strava_streams", result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+
+        token = self.get_access_token()
+        if not token: return None
+        url = f"{self.base_url}/activities/{activity_id}/streams"
+        params = {"keys": ",".join(keys), "key_by_type": "true"}
+        try:
+            with telemetry.span("strava.streams", activity_id=str(activity_id)):
+                response = self._request("GET", url, headers={'Authorization': f'Bearer {token}'}, params=params)
+            if response.status_code != 200:
+                logger.error(f"[STRAVA] Error fetching streams for {activity_id}: {response.status_code}")
+                return None
+            payload = response.json()
+            streams = {
+                key: np.asarray(payload[key].get("data", []), dtype=np.float32)
+                for key in keys if isinstance(payload.get(key), dict)
+            }
+            stream_cache.put(cache_key, streams)
+            return streams
+        except Exception as e:
+            logger.error(f"[STRAVA] Error processing streams for {activity_id}: {e}")
+            return None
+
     def update_activity_description(self, activity_id: str, description: str):
         """Update the description of a Strava activity."""
         token = self.get_access_token()
@@ -153,7 +330,7 @@ class StravaClient:
         payload = {'description': description}
 
         try:
-            response = requests.put(url, headers=headers, json=payload)
+            response = self._request("PUT", url, headers=headers, json=payload)
             if response.status_code == 200:
                 logger.info(f"[STRAVA] Description updated for {activity_id}")
                 return True
@@ -164,26 +341,6 @@ class StravaClient:
             logger.error(f"[STRAVA] Error updating description: {e}")
             return False
 
-    def get_athlete_stats(self, athlete_id):
-        """Lấy tổng km chạy (Tuần/Tháng/Năm/Tổng)"""
-        token = self.get_access_token() 
-        url = f"https://www.strava.com/api/v3/athletes/{athlete_id}/stats"
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        try:
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    "recent_run_totals": data["recent_run_totals"]["distance"] / 1000,
-                    "ytd_run_totals": data["ytd_run_totals"]["distance"] / 1000,
-                    "all_run_totals": data["all_run_totals"]["distance"] / 1000
-                }
-            logger.error(f"Error fetching stats: {response.status_code}")
-        except Exception as e:
-            logger.error(f"Stats Exception: {e}")
-        return None
-
     def get_recent_activities(self, limit=10):
         """Lấy danh sách các bài tập gần nhất"""
         token = self.get_access_token()
@@ -192,9 +349,38 @@ class StravaClient:
         params = {"per_page": limit}
         
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = self._request("GET", url, headers=headers, params=params)
             if response.status_code == 200:
                 return response.json()
         except Exception as e:
             logger.error(f"Activities Exception: {e}")
-        return []
\ No newline at end of file
+        return []
+
+    def get_activity_laps(self, activity_id: str) -> Optional[List[Dict]]:
+        """Chỉ lấy lap của 1 bài (Activity Detail, không kèm stream); None nếu lỗi."""
+        token = self.get_access_token()
+        if not token: return None
+        try:
+            with telemetry.span("strava.activity_detail"):
+                response = self._request("GET", f"{self.base_url}/activities/{activity_id}",
+                                         headers={"Authorization": f"Bearer {token}"})
+            if response.status_code == 200:
+                return summarize_laps(response.json().get('laps', []))
+            logger.error(f"[STRAVA] Failed to fetch laps for {activity_id}: {response.text}")
+        except Exception as e:
+            logger.error(f"[STRAVA] Error fetching laps for {activity_id}: {e}")
+        return None
+
+    def get_athlete_id(self) -> Optional[str]:
+        """Strava athlete id của chủ token (GET /athlete), dùng để khớp owner_id của Webhook."""
+        token = self.get_access_token()
+        if not token: return None
+        try:
+            response = self._request("GET", f"{self.base_url}/athlete", headers={"Authorization": f"Bearer {token}"})
+            if response.status_code == 200:
+                athlete_id = response.json().get("id")
+                return str(athlete_id) if athlete_id else None
+            logger.error(f"[STRAVA] Failed to fetch athlete: {response.text}")
+        except Exception as e:
+            logger.error(f"[STRAVA] Error fetching athlete: {e}")
+        return None
@@ -0,0 +1,155 @@
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 📐 STREAM ANALYTICS (decoupling, GAP, drift trên thời gian di chuyển)
+# ==========================================
+# Làm việc trực tiếp trên stream Strava gốc (1 mẫu ~ 1 giây, chưa downsample).
+# Mỗi mẫu có trọng số dt (cắt ở MAX_GAP_S) và chỉ tính khi đang di chuyển -> auto-pause, đứng chờ đèn đỏ
+# không làm lệch các nửa bài hay cửa sổ trượt. Mọi phép tính là numpy vectorized (cumsum + searchsorted).
+
+MAX_GAP_S = 10.0
+MIN_MOVING_SPEED = 0.5     # m/s, dùng khi thiết bị không có stream "moving"
+WARMUP_S = 600             # Bỏ 10 phút khởi động khi đo drift / rolling decoupling
+ROLLING_WINDOW_S = 300     # Cửa sổ EF trượt 5 phút (theo thời gian di chuyển)
+MIN_VALID_BPM = 30
+MINETTI_MAX_GRADE = 0.45   # Ngoài ±45% đa thức Minetti không còn hợp lệ
+MINETTI_FLAT_COST = 3.6    # J/kg/m trên đường bằng
+
+def minetti_cost(grade):
+    """Năng lượng chạy (J/kg/m) theo độ dốc dạng phân số (Minetti et al. 2002), vectorized."""
+    i = np.clip(np.asarray(grade, dtype=np.float64), -MINETTI_MAX_GRADE, MINETTI_MAX_GRADE)
+    return ((((155.4 * i - 30.4) * i - 43.3) * i + 46.3) * i + 19.5) * i + MINETTI_FLAT_COST
+
+def grade_adjusted_speed(velocity_mps, grade_pct):
+    """Tốc độ tương đương trên đường bằng (GAP) = v x C(i) / C(0)."""
+    return np.asarray(velocity_mps, dtype=np.float64) * minetti_cost(np.asarray(grade_pct, dtype=np.float64) / 100) / MINETTI_FLAT_COST
+
+def _weighted_mean(values: np.ndarray, weights: np.ndarray) -> Optional[float]:
+    total = weights.sum()
+    return float(np.dot(values, weights) / total) if total > 0 else None
+
+def _cv_pct(values: np.ndarray, weights: np.ndarray) -> Optional[float]:
+    mean = _weighted_mean(values, weights)
+    if not mean:
+        return None
+    var = _weighted_mean((values - mean) ** 2, weights)
+    return round(float(np.sqrt(var)) / mean * 100, 2)
+
+def _ef(speed_sum: float, hr_sum: float) -> Optional[float]:
+    """EF = tốc độ (m/phút) / nhịp tim, từ 2 tổng có cùng trọng số thời gian."""
+    return round(speed_sum * 60 / hr_sum, 3) if hr_sum > 0 else None
+
+def _pct_drop(first: Optional[float], last: Optional[float]) -> Optional[float]:
+    if not first or last is None:
+        return None
+    return round((first - last) / first * 100, 2)
+
+def analyze_streams(streams: Dict[str, np.ndarray]) -> Optional[Dict]:
+    """
+    Chỉ số của 1 bài chạy từ dict stream (time, distance, heartrate, velocity_smooth, cadence, grade_smooth, moving).
+    None nếu không đủ dữ liệu (thiếu time hoặc tốc độ).
+    """
+    t = streams.get("time")
+    if t is None or len(t) < 2:
+        return None
+    t = np.asarray(t, dtype=np.float64)
+    n = t.size
+
+    def stream(key):
+        values = streams.get(key)
+        return np.asarray(values, dtype=np.float64) if values is not None and len(values) == n else None
+
+    dt = np.empty(n)
+    dt[0] = 0.0
+    np.clip(np.diff(t), 0.0, MAX_GAP_S, out=dt[1:])
+
+    velocity = stream("velocity_smooth")
+    if velocity is None:
+        dist = stream("distance")
+        if dist is None:
+            return None
+        velocity = np.zeros(n)
+        np.divide(np.diff(dist), np.diff(t), out=velocity[1:], where=np.diff(t) > 0)
+    moving = stream("moving")
+    moving = moving > 0 if moving is not None else velocity >= MIN_MOVING_SPEED
+    grade = stream("grade_smooth")
+    gap = grade_adjusted_speed(velocity, grade) if grade is not None else velocity
+
+    w = np.where(moving, dt, 0.0)
+    moving_time = np.cumsum(w)
+    total_s = float(moving_time[-1])
+    if total_s <= 0:
+        return None
+
+    metrics = {
+        "moving_time_s": int(round(total_s)),
+        "avg_speed_mps": round(_weighted_mean(velocity, w), 3),
+        "gap_speed_mps": round(_weighted_mean(gap, w), 3),
+        "avg_hr": None, "ef": None, "decoupling_pct": None, "rolling_decoupling_pct": None,
+        "ef_windows": [], "hr_drift_bpm_h": None,
+        "cadence_avg": None, "cadence_cv_pct": None, "stride_avg_m": None, "stride_cv_pct": None,
+    }
+
+    hr = stream("heartrate")
+    if hr is not None:
+        w_hr = np.where(hr >= MIN_VALID_BPM, w, 0.0)
+        speed_cum = np.cumsum(gap * w_hr)
+        hr_cum = np.cumsum(hr * w_hr)
+        metrics["avg_hr"] = round(_weighted_mean(hr, w_hr), 1) if w_hr.sum() > 0 else None
+        metrics["ef"] = _ef(speed_cum[-1], hr_cum[-1])
+
+        # Pa:HR decoupling theo 2 nửa THỜI GIAN DI CHUYỂN (không phải nửa số mẫu)
+        half = int(np.searchsorted(moving_time, total_s / 2))
+        ef1 = _ef(speed_cum[half], hr_cum[half])
+        ef2 = _ef(speed_cum[-1] - speed_cum[half], hr_cum[-1] - hr_cum[half])
+        metrics["decoupling_pct"] = _pct_drop(ef1, ef2)
+
+        # EF trên các cửa sổ liền kề ROLLING_WINDOW_S (xu hướng trong bài, gọn cho prompt)
+        edges = np.searchsorted(moving_time, np.arange(0, total_s + 1, ROLLING_WINDOW_S))
+        metrics["ef_windows"] = [
+            _ef(speed_cum[b] - speed_cum[a], hr_cum[b] - hr_cum[a]) for a, b in zip(edges[:-1], edges[1:])
+        ]
+
+        # Rolling decoupling: EF cửa sổ trượt ngay sau khởi động so với cửa sổ cuối bài
+        if total_s >= WARMUP_S + 2 * ROLLING_WINDOW_S:
+            first_end = int(np.searchsorted(moving_time, WARMUP_S + ROLLING_WINDOW_S))
+            first_start = int(np.searchsorted(moving_time, WARMUP_S))
+            last_start = int(np.searchsorted(moving_time, total_s - ROLLING_WINDOW_S))
+            ef_first = _ef(speed_cum[first_end] - speed_cum[first_start], hr_cum[first_end] - hr_cum[first_start])
+            ef_last = _ef(speed_cum[-1] - speed_cum[last_start], hr_cum[-1] - hr_cum[last_start])
+            metrics["rolling_decoupling_pct"] = _pct_drop(ef_first, ef_last)
+
+        # Cardiac drift: hệ số góc HR theo thời gian di chuyển (bpm/giờ), sau khởi động
+        steady = (w_hr > 0) & (moving_time > WARMUP_S)
+        if steady.sum() > 60:
+            slope = np.polyfit(moving_time[steady] / 3600, hr[steady], 1)[0]
+            metrics["hr_drift_bpm_h"] = round(float(slope), 2)
+
+    cadence = stream("cadence")
+    if cadence is not None:
+        w_cad = np.where(cadence > 0, w, 0.0)
+        if w_cad.sum() > 0:
+            metrics["cadence_avg"] = round(_weighted_mean(cadence, w_cad), 1)
+            metrics["cadence_cv_pct"] = _cv_pct(cadence, w_cad)
+            # Cùng công thức với cột Stride_m trong CSV: v * 60 / cadence
+            stride = np.divide(velocity * 60, cadence, out=np.zeros(n), where=cadence > 0)
+            metrics["stride_avg_m"] = round(_weighted_mean(stride, w_cad), 2)
+            metrics["stride_cv_pct"] = _cv_pct(stride, w_cad)
+    return metrics
+
+def format_stream_metrics(metrics: Optional[Dict]) -> str:
+    """1 dòng tóm tắt cho prompt / ký ức."""
+    if not metrics:
+        return "N/A"
+    def val(key, unit=""):
+        v = metrics.get(key)
+        return "N/A" if v is None else f"{v}{unit}"
+    return (f"Moving {metrics['moving_time_s'] // 60} min | GAP speed {val('gap_speed_mps', ' m/s')} | EF {val('ef')} | "
+            f"Decoupling (halves) {val('decoupling_pct', '%')} | Rolling decoupling {val('rolling_decoupling_pct', '%')} | "
+            f"HR drift {val('hr_drift_bpm_h', ' bpm/h')} | Cadence {val('cadence_avg')} (CV {val('cadence_cv_pct', '%')}) | "
+            f"Stride {val('stride_avg_m', ' m')} (CV {val('stride_cv_pct', '%')})")
@@ -0,0 +1,163 @@
+import time
+import inspect
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, Iterable, Optional, Tuple
+
+from app.core.events import event_bus
+from app.core.telemetry import telemetry
+
+logger = logging.getLogger("AI_COACH")
+cache_lookups = telemetry.counter("cache_lookups_total", "Tra cứu cache theo tầng và kết quả")
+tool_seconds = telemetry.histogram("agent_tool_seconds", "Thời gian gọi tool của agent (kể cả cache)")
+
+class _ToolEntry:
+    """Trạng thái cache + thống kê của một tool."""
+
+    def __init__(self, func: Callable, ttl: float):
+        self.func = func
+        self.name = func.__name__
+        self.signature = inspect.signature(func)
+        self.ttl = ttl
+        self.cache: Dict[Tuple, Tuple[float, Any]] = {}
+        # Thế hệ cache theo user (+ 1 bộ đếm chung khi xóa toàn bộ), giống RecallCache:
+        # kết quả tính xong sau 1 lần invalidate xen giữa sẽ không được ghi vào cache
+        self.generations: Dict[str, int] = {}
+        self.global_generation = 0
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.turn_hits = 0
+        self.ttl_hits = 0
+        self.total_time = 0.0
+
+    def make_key(self, args, kwargs) -> Tuple:
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return tuple((k, str(v)) for k, v in bound.arguments.items())
+
+    def generation(self, key: Tuple) -> Tuple[int, int]:
+        """Gọi khi đang giữ lock."""
+        return self.global_generation, self.generations.get(dict(key).get("user_id"), 0)
+
+    def invalidate(self, user_id: Optional[str] = None, **_):
+        """Xóa cache TTL của 1 user (hoặc toàn bộ nếu không biết user)."""
+        with self.lock:
+            if user_id is None:
+                self.global_generation += 1
+                self.cache.clear()
+                return
+            self.generations[str(user_id)] = self.generations.get(str(user_id), 0) + 1
+            for key in [k for k in self.cache if ("user_id", str(user_id)) in k]:
+                del self.cache[key]
+
+class ToolRegistry:
+    """
+    Lớp bọc (memoization) cho các tool của Gemini AFC.
+    - Per-turn cache: cùng tool + cùng tham số trong 1 lượt chat chỉ chạy 1 lần.
+    - TTL cache: giữ kết quả ngắn hạn giữa các lượt, bị xóa khi có data event (activity_saved, harvest_completed...).
+    - Tenant binding: tham số `user_id` do server gắn theo lượt chat (turn(user_id=...)), bị ẩn khỏi signature
+      mà model thấy -> prompt không thể đọc dữ liệu của VĐV khác.
+    Wrapper giữ nguyên __name__, docstring và phần signature còn lại để SDK sinh FunctionDeclaration đúng.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, _ToolEntry] = {}
+        self._turn_cache: contextvars.ContextVar = contextvars.ContextVar("tool_turn_cache", default=None)
+        self._tenant: contextvars.ContextVar = contextvars.ContextVar("tool_tenant", default=None)
+
+    def tool(self, ttl: float = 0, invalidate_on: Iterable[str] = ()):
+        def decorator(func: Callable) -> Callable:
+            entry = _ToolEntry(func, ttl)
+            self._entries[entry.name] = entry
+            for event in invalidate_on:
+                event_bus.subscribe(event, entry.invalidate)
+
+            tenant_bound = "user_id" in entry.signature.parameters
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if tenant_bound:
+                    user_id = self._tenant.get()
+                    if user_id is None:
+                        raise RuntimeError(f"Tool {entry.name} called outside tool_registry.turn(user_id=...)")
+                    kwargs["user_id"] = user_id  # Luôn ghi đè: model không được chọn VĐV
+                return self._call(entry, args, kwargs)
+
+            if tenant_bound:
+                # SDK đọc inspect.signature + get_type_hints -> bỏ user_id khỏi khai báo gửi cho model
+                wrapper.__signature__ = entry.signature.replace(
+                    parameters=[p for name, p in entry.signature.parameters.items() if name != "user_id"])
+                wrapper.__annotations__ = {k: v for k, v in func.__annotations__.items() if k != "user_id"}
+                del wrapper.__wrapped__
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def turn(self, user_id: Optional[str] = None):
+        """Bao quanh 1 lượt chat (send_message): bật memoization theo lượt và gắn VĐV cho các tool."""
+        token = self._turn_cache.set({})
+        tenant_token = self._tenant.set(str(user_id) if user_id is not None else None)
+        try:
+            yield
+        finally:
+            self._tenant.reset(tenant_token)
+            self._turn_cache.reset(token)
+
+    def _call(self, entry: _ToolEntry, args, kwargs):
+        start = time.perf_counter()
+        key = entry.make_key(args, kwargs)
+        turn_cache = self._turn_cache.get()
+        source = "miss"
+
+        if turn_cache is not None and (entry.name, key) in turn_cache:
+            result = turn_cache[(entry.name, key)]
+            source = "turn"
+        else:
+            with entry.lock:
+                cached = entry.cache.get(key)
+                generation = entry.generation(key)
+            if cached and cached[0] > time.monotonic():
+                result = cached[1]
+                source = "ttl"
+            else:
+                result = entry.func(*args, **kwargs)
+                if entry.ttl > 0:
+                    with entry.lock:
+                        # Harvest/memorize xen giữa lúc đang tính -> kết quả có thể đã cũ, không cache
+                        if entry.generation(key) == generation:
+                            entry.cache[key] = (time.monotonic() + entry.ttl, result)
+            if turn_cache is not None:
+                turn_cache[(entry.name, key)] = result
+
+        elapsed = time.perf_counter() - start
+        with entry.lock:
+            entry.calls += 1
+            entry.total_time += elapsed
+            if source == "turn":
+                entry.turn_hits += 1
+            elif source == "ttl":
+                entry.ttl_hits += 1
+        cache_lookups.inc(cache="agent_tool", result=source)  # turn / ttl / miss
+        tool_seconds.observe(elapsed, tool=entry.name, source=source)
+        if source != "miss":
+            logger.info(f"[TOOL-USE] ♻️ {entry.name} served from {source} cache ({elapsed * 1000:.2f} ms)")
+        else:
+            logger.info(f"[TOOL-USE] ⏱️ {entry.name} executed in {elapsed * 1000:.1f} ms")
+        return result
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "calls": e.calls,
+                "turn_hits": e.turn_hits,
+                "ttl_hits": e.ttl_hits,
+                "avg_ms": round(e.total_time / e.calls * 1000, 3) if e.calls else 0.0,
+            }
+            for name, e in self._entries.items()
+        }
+
+# Singleton instance
+tool_registry = ToolRegistry()
@@ -1,9 +1,39 @@
 import numpy as np
 import logging
+from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 
-def calculate_trimp(duration_minutes: float, avg_hr: float, max_hr: int = 185, rest_hr: int = 55) -> dict:
+# Hệ số Bannister (a, b) theo giới tính: weight = a * e^(b * HRR)
+BANISTER_COEFFICIENTS = {"M": (0.64, 1.92), "F": (0.86, 1.67)}
+
+def banister_coefficients(sex: str = "M") -> tuple:
+    return BANISTER_COEFFICIENTS.get((sex or "M").upper()[:1], BANISTER_COEFFICIENTS["M"])
+
+def calculate_trimp_batch(duration_minutes, avg_hr, max_hr: int = 185, rest_hr: int = 55, sex: str = "M") -> np.ndarray:
+    """
+    Bannister TRIMP cho cả mảng bài chạy trong 1 phép tính numpy (dùng khi tính lại toàn bộ lịch sử).
+    avg_hr = 0 / None hoặc thời lượng = 0 -> TRIMP 0. Kết quả làm tròn 2 chữ số như calculate_trimp.
+    """
+    duration = np.nan_to_num(np.asarray(duration_minutes, dtype=np.float64))
+    hr = np.nan_to_num(np.asarray(avg_hr, dtype=np.float64))
+    a, b = banister_coefficients(sex)
+    reserve = max(1, max_hr - rest_hr)
+    hrr = np.clip((hr - rest_hr) / reserve, 0.0, None)
+    trimp = duration * hrr * a * np.exp(b * hrr)
+    trimp[(hr <= 0) | (duration <= 0)] = 0.0
+    return np.round(trimp, 2)
+
+def trimp_intensity_level(trimp: float) -> str:
+    """Evaluate intensity zone from a TRIMP score."""
+    if trimp > 120:
+        return "High (Severe Load)"
+    if trimp > 70:
+        return "Medium (Tempo/Threshold)"
+    return "Easy/Recovery"
+
+def calculate_trimp(duration_minutes: float, avg_hr: float, max_hr: int = 185, rest_hr: int = 55,
+                    sex: str = "M") -> dict:
     """
     Calculate Training Impulse (TRIMP) using Bannister's method.
     Returns a dictionary containing TRIMP score and evaluated intensity.
@@ -16,19 +46,13 @@ def calculate_trimp(duration_minutes: float, avg_hr: float, max_hr: int = 185, r
         hrr = (avg_hr - rest_hr) / (max_hr - rest_hr)
         hrr = max(0, hrr) # Ensure HRR is not negative
         
-        # Bannister's formula for males
-        weight = 0.64 * np.exp(1.92 * hrr)
+        # Bannister's formula (hệ số theo giới tính)
+        a, b = banister_coefficients(sex)
+        weight = a * np.exp(b * hrr)
         trimp = duration_minutes * hrr * weight
         trimp_rounded = round(trimp, 2)
         
-        # Evaluate intensity zone
-        intensity = "Easy/Recovery"
-        if trimp_rounded > 120:
-            intensity = "High (Severe Load)"
-        elif trimp_rounded > 70:
-            intensity = "Medium (Tempo/Threshold)"
-            
-        return {"trimp": trimp_rounded, "intensity_level": intensity}
+        return {"trimp": trimp_rounded, "intensity_level": trimp_intensity_level(trimp_rounded)}
     except Exception as e:
         logger.error(f"[UTILS] TRIMP calculation error: {e}")
         return {"trimp": 0, "intensity_level": "Error"}
@@ -58,36 +82,33 @@ def calculate_acwr(acute_load_7d: float, chronic_load_28d: float) -> dict:
         
     return {"acwr": acwr, "status": status}
 
-def calculate_efficiency_factor(avg_speed_mpm: float, avg_hr: float) -> float:
-    """Efficiency Factor (EF) = Speed (meters/min) / HR"""
-    if avg_hr == 0: return 0.0
-    return round(avg_speed_mpm / avg_hr, 2)
-
-def calculate_grade_adjusted_pace(velocity_ms, grade_pct):
+def fill_daily_series(rows: list, start, end) -> list:
     """
-    Công thức đơn giản hóa của Minetti để tính GAP.
-    Cost of running phụ thuộc vào độ dốc.
+    Chuyển các dòng {day, trimp, distance_km} (chỉ có ngày có chạy) thành chuỗi liên tục
+    từ start tới end (datetime.date), ngày nghỉ có tải = 0.
     """
-    # Đây là logic phức tạp, AI Coach có thể ước lượng:
-    # Mỗi 1% dốc tương đương giảm pace khoảng 2-3 giây/km (quy tắc ngón tay cái)
-    cost = 1 + (grade_pct * 0.045) # Ước lượng
-    gap_velocity = velocity_ms * cost
-    return gap_velocity
+    by_day = {r["day"]: r for r in rows}
+    series = []
+    for i in range((end - start).days + 1):
+        day = (start + timedelta(days=i)).isoformat()
+        row = by_day.get(day) or {}
+        series.append({"day": day, "trimp": row.get("trimp") or 0.0, "km": row.get("distance_km") or 0.0})
+    return series
 
-def analyze_decoupling(df):
+def calculate_fitness_fatigue(daily_loads: list, ctl_days: int = 42, atl_days: int = 7) -> list:
     """
-    Chia bài chạy làm 2 nửa, so sánh tỷ lệ EF (Efficiency Factor).
-    Nếu nửa sau kém hơn nửa đầu > 5% => Decoupling (Chưa đủ bền).
+    Banister Fitness-Fatigue (EWMA) trên chuỗi tải theo ngày liên tục.
+    Returns list of {"ctl", "atl", "tsb"} (Form TSB = CTL - ATL) cho từng ngày.
     """
-    half_point = len(df) // 2
-    first_half = df.iloc[:half_point]
-    second_half = df.iloc[half_point:]
-    
-    ef1 = calculate_efficiency_factor(first_half['Velocity_m_s'].mean() * 60, first_half['HR_bpm'].mean())
-    ef2 = calculate_efficiency_factor(second_half['Velocity_m_s'].mean() * 60, second_half['HR_bpm'].mean())
-    
-    decoupling = 0
-    if ef1 > 0:
-        decoupling = (ef1 - ef2) / ef1 * 100
-        
-    return round(decoupling, 2)
+    ctl = atl = 0.0
+    out = []
+    for load in daily_loads:
+        ctl += (load - ctl) / ctl_days
+        atl += (load - atl) / atl_days
+        out.append({"ctl": ctl, "atl": atl, "tsb": ctl - atl})
+    return out
+
+def calculate_efficiency_factor(avg_speed_mpm: float, avg_hr: float) -> float:
+    """Efficiency Factor (EF) = Speed (meters/min) / HR"""
+    if avg_hr == 0: return 0.0
+    return round(avg_speed_mpm / avg_hr, 2)
@@ -1,20 +1,240 @@
-import json
 import os
+import copy
+import json
+import logging
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import pytz
 from dotenv import load_dotenv
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
 
 # Load env từ root
 load_dotenv()
 
 CONFIG_PATH = "data/config.json"
+TZ_VN = pytz.timezone('Asia/Ho_Chi_Minh')
+logger = logging.getLogger("AI_COACH")
 
-def load_config():
-    if os.path.exists(CONFIG_PATH):
+# ==========================================
+# 📐 SCHEMA (Pydantic v2)
+# ==========================================
+class SchedulerSettings(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    briefing_time: str = "06:00"
+    backup_time: str = "02:00"
+    harvest_hours: str = "0,6,12,18"
+    harvest_minute: str = "15"
+    harvest_window_minutes: float = Field(30, ge=0)
+    harvest_concurrency: int = Field(4, ge=1)
+
+    @field_validator("harvest_minute", mode="before")
+    @classmethod
+    def _minute_as_str(cls, v):
+        return str(v)
+
+class EmailSettings(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    enabled: bool = False
+    smtp_server: str = "smtp.gmail.com"
+    smtp_port: int = 587
+
+class AppConfig(BaseModel):
+    """Các khóa đã biết được kiểm tra kiểu; khóa lạ (prompt mới...) vẫn được giữ nguyên."""
+    model_config = ConfigDict(extra="allow")
+
+    system_instruction: Optional[str] = None
+    user_profile: Optional[str] = None
+    task_description: Optional[str] = None
+    analysis_requirements: Optional[str] = None
+    output_format: Optional[str] = None
+    model_name: str = "models/gemini-2.0-flash"
+    debug_mode: bool = False
+    prompt_raw_samples: bool = False  # Gửi kèm CSV stream thô vào prompt phân tích (mặc định chỉ gửi báo cáo tính sẵn)
+    max_hr: int = Field(185, ge=100, le=250)
+    rest_hr: int = Field(55, ge=20, le=120)
+    sex: str = Field("M", pattern="^[MF]$")  # Chọn hệ số Bannister cho TRIMP
+    race_date: Optional[str] = None  # YYYY-MM-DD; sai định dạng thì periodization báo 'Invalid race date format.'
+    current_goal: Optional[str] = None
+    weekly_volume_km: Optional[float] = Field(None, ge=0)  # Volume kế hoạch/tuần cho bản tin sáng
+    email_config: EmailSettings = EmailSettings()
+    scheduler: SchedulerSettings = SchedulerSettings()
+
+# ==========================================
+# 🧮 DERIVED VALUES
+# ==========================================
+@dataclass(frozen=True)
+class Periodization:
+    race_date: Optional[date]
+    days_to_race: Optional[int]
+    weeks_to_race: Optional[int]
+    phase: str            # Nhãn ngắn: Tapering / Peak Training / Base/Build / Off-season
+    phase_detail: str     # Nhãn đầy đủ cho prompt phân tích
+    countdown_text: str
+
+@lru_cache(maxsize=256)
+def periodization(race_date_str: Optional[str], current_goal: Optional[str], today: date) -> Periodization:
+    """Giai đoạn tập luyện theo ngày đua (dùng chung cho prompt, briefing, dashboard)."""
+    goal = current_goal or "Duy trì thể lực (Maintenance)"
+    if not race_date_str:
+        return Periodization(None, None, None, "Off-season", "Off-season / Base Building",
+                             f"No race scheduled. Current Focus: {goal}.")
+    try:
+        race_day = datetime.strptime(race_date_str, "%Y-%m-%d").date()
+    except ValueError:
+        return Periodization(None, None, None, "Off-season", "Off-season / Maintenance", "Invalid race date format.")
+    days_to_race = (race_day - today).days
+    weeks_to_race = max(0, days_to_race // 7)
+    if weeks_to_race <= 2: phase, detail = "Tapering", "Tapering (Giảm tải, giữ điểm rơi)"
+    elif weeks_to_race <= 6: phase, detail = "Peak Training", "Peak Training (Tích lũy tối đa)"
+    else: phase, detail = "Base/Build", "Base/Build (Xây dựng nền tảng)"
+    return Periodization(race_day, days_to_race, weeks_to_race, phase, detail,
+                         f"{weeks_to_race} weeks ({days_to_race} days) remaining to Race Day.")
+
+# Vùng nhịp tim theo Karvonen (% Heart Rate Reserve)
+HR_ZONE_BOUNDS = (("Z1", 0.50, 0.60), ("Z2", 0.60, 0.70), ("Z3", 0.70, 0.80), ("Z4", 0.80, 0.90), ("Z5", 0.90, 1.00))
+
+@lru_cache(maxsize=256)
+def hr_zones(max_hr: int, rest_hr: int) -> Tuple[Tuple[str, int, int], ...]:
+    reserve = max_hr - rest_hr
+    return tuple((name, round(rest_hr + lo * reserve), round(rest_hr + hi * reserve)) for name, lo, hi in HR_ZONE_BOUNDS)
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Ảnh chụp bất biến của config.json + các giá trị dẫn xuất đã tính sẵn."""
+    data: Mapping[str, Any]           # Read-only view (dùng .get như dict)
+    settings: AppConfig
+    periodization: Periodization
+    hr_zones: Tuple[Tuple[str, int, int], ...]
+    mtime_ns: int
+    built_for: date
+    raw: Dict[str, Any] = field(repr=False, compare=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return copy.deepcopy(self.raw)
+
+# ==========================================
+# 🗂️ CONFIG SERVICE
+# ==========================================
+class ConfigService:
+    """
+    Cache config.json trong RAM, tự nạp lại khi mtime/size của file đổi (hoặc khi sang ngày mới
+    để giai đoạn tập luyện được tính lại). File hỏng/ghi dở -> giữ snapshot hợp lệ gần nhất.
+    """
+    def __init__(self, path: str = CONFIG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._file_key = None
+
+    def _stat_key(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def get(self) -> ConfigSnapshot:
+        key = self._stat_key()
+        today = datetime.now(TZ_VN).date()
+        snap = self._snapshot
+        if snap is not None and key == self._file_key and snap.built_for == today:
+            return snap
+        with self._lock:
+            if self._snapshot is None or key != self._file_key or self._snapshot.built_for != today:
+                self._snapshot = self._build(key, today)
+                self._file_key = key
+            return self._snapshot
+
+    def reload(self) -> ConfigSnapshot:
+        with self._lock:
+            self._file_key = None
+        return self.get()
+
+    def _read_raw(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return {}
         try:
-            with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            with open(self.path, "r", encoding="utf-8") as f:
                 return json.load(f)
-        except: return {}
-    return {}
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"[CONFIG] Cannot read {self.path}: {e}")
+            return None
+
+    def _build(self, key, today: date) -> ConfigSnapshot:
+        raw = self._read_raw()
+        settings = None
+        if raw is not None:
+            try:
+                settings = AppConfig.model_validate(raw)
+            except ValidationError as e:
+                logger.error(f"[CONFIG] Invalid config.json, keeping last good snapshot: {e}")
+        if settings is None:
+            if self._snapshot is not None:
+                return self._rebuild_derived(self._snapshot, today)
+            settings = AppConfig()
+
+        # Chỉ xuất lại các khóa có trong file (đã được ép kiểu), tránh chèn default làm đổi hành vi caller cũ
+        data = settings.model_dump(exclude_unset=True)
+        return self._make(data, settings, key[0] if key else 0, today)
+
+    def _rebuild_derived(self, snap: ConfigSnapshot, today: date) -> ConfigSnapshot:
+        return self._make(snap.raw, snap.settings, snap.mtime_ns, today)
+
+    @staticmethod
+    def _make(data: Dict[str, Any], settings: AppConfig, mtime_ns: int, today: date) -> ConfigSnapshot:
+        return ConfigSnapshot(
+            data=_freeze(data),
+            settings=settings,
+            periodization=periodization(settings.race_date, settings.current_goal, today),
+            hr_zones=hr_zones(settings.max_hr, settings.rest_hr),
+            mtime_ns=mtime_ns,
+            built_for=today,
+            raw=data,
+        )
+
+    def save(self, data: Dict[str, Any]) -> ConfigSnapshot:
+        """Kiểm tra rồi ghi nguyên tử (file tạm + os.replace): reader không bao giờ thấy file ghi dở."""
+        AppConfig.model_validate(data)
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".config.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return self.reload()
+
+# Singleton instance
+config_service = ConfigService()
+
+def get_config() -> ConfigSnapshot:
+    """Snapshot bất biến cho hot path (không I/O nếu file không đổi)."""
+    return config_service.get()
+
+def load_config():
+    """Bản sao dict có thể sửa (tương thích code cũ)."""
+    return config_service.get().to_dict()
 
 def save_config(data):
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
\ No newline at end of file
+    config_service.save(data)
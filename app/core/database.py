@@ -1,8 +1,13 @@
 import sqlite3
 import os
+import json
+import re
+import time
 import logging
-from typing import List, Dict, Optional
-from datetime import datetime
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+from datetime import date, datetime, timedelta
+
+from app.core.events import event_bus, ACTIVITY_SAVED, MESSAGE_SAVED
 
 logger = logging.getLogger("AI_COACH")
 DB_PATH = "data/os_core.db"  # Đổi tên file để đánh dấu kỷ nguyên mới (Multi-Tenant)
@@ -32,6 +37,20 @@ def init_db():
         )
     ''')
 
+    # Auto-migrate: Hồ sơ + token Strava riêng của từng VĐV (Multi-Tenant)
+    for column_def in (
+        "sex TEXT DEFAULT 'M'",
+        "strava_athlete_id TEXT",
+        "strava_refresh_token TEXT",
+        "strava_access_token TEXT",
+        "strava_token_expires_at INTEGER DEFAULT 0",
+    ):
+        try:
+            c.execute(f"ALTER TABLE users ADD COLUMN {column_def}")
+        except sqlite3.OperationalError:
+            pass # Bỏ qua nếu cột đã tồn tại
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_strava_athlete ON users (strava_athlete_id)")
+
 # 2. Table: run_activities
     c.execute('''
         CREATE TABLE IF NOT EXISTS run_activities (
@@ -68,6 +87,279 @@ def init_db():
         )
     ''')
 
+    # 4. Table: job_runs (Lần chạy gần nhất của từng Scheduler Job)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job_id TEXT PRIMARY KEY,
+            last_started_at DATETIME,
+            last_duration_s REAL,
+            last_status TEXT,
+            last_error TEXT,
+            run_count INTEGER DEFAULT 0,
+            failure_count INTEGER DEFAULT 0,
+            missed_count INTEGER DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 5. Table: leases (Leader Election giữa các uvicorn worker)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            expires_at REAL,
+            acquired_at REAL
+        )
+    ''')
+
+    # 6. Table: runtime_state (Trạng thái dùng chung giữa các worker, ví dụ service_active)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS runtime_state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 7. Keyword Index (FTS5): Tầng recall nhanh theo từ khóa cho chat_history + ký ức RAG
+    # remove_diacritics 2: "chan thuong" vẫn khớp "chấn thương"
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(
+            content,
+            user_id UNINDEXED,
+            source UNINDEXED,
+            ref_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    # Đồng bộ tự động với chat_history bằng trigger
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+            INSERT INTO memory_fts (content, user_id, source, ref_id)
+            VALUES (new.content, new.user_id, 'chat', 'chat:' || new.id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+            DELETE FROM memory_fts WHERE ref_id = 'chat:' || old.id;
+        END
+    ''')
+    # Backfill một lần cho DB cũ (chat_history có trước khi tạo index)
+    c.execute("SELECT COUNT(*) FROM memory_fts WHERE source = 'chat'")
+    if c.fetchone()[0] == 0:
+        c.execute('''
+            INSERT INTO memory_fts (content, user_id, source, ref_id)
+            SELECT content, user_id, 'chat', 'chat:' || id FROM chat_history
+        ''')
+
+    # 8. Table: email_outbox (Email được xếp hàng, worker nền gửi qua 1 kết nối SMTP dùng lại)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT,
+            subject TEXT,
+            html_content TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox (status, next_attempt_at)")
+
+    # 10. Table: user_data_versions (Bộ đếm phiên bản dữ liệu của từng user -> ETag cho Dashboard API)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_id TEXT PRIMARY KEY,
+            version INTEGER DEFAULT 0
+        )
+    ''')
+    # (Trigger tăng version được tạo ở cuối init_db, sau khi mọi bảng Dashboard đọc đã tồn tại)
+
+    # 9. Table: briefing_digests (Bản tin buổi sáng dựng sẵn sau mỗi lần harvest)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS briefing_digests (
+            user_id TEXT PRIMARY KEY,
+            for_date TEXT,
+            message TEXT,
+            payload TEXT,
+            built_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME
+        )
+    ''')
+
+    # 11. Table: activity_load_metrics (Tải trọng từ stream nhịp tim từng giây)
+    # bpm_seconds = histogram số giây theo bpm (JSON) -> tính lại TRIMP/vùng khi đổi HR mà không gọi Strava
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS activity_load_metrics (
+            activity_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            bannister_trimp REAL,
+            edwards_trimp REAL,
+            zone_seconds TEXT,
+            hr_seconds INTEGER,
+            bpm_start INTEGER,
+            bpm_seconds TEXT,
+            max_hr INTEGER,
+            rest_hr INTEGER,
+            sex TEXT,
+            computed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_load_metrics_user ON activity_load_metrics (user_id)")
+
+    # 12. Table: activity_mean_max (Tốc độ TB tốt nhất theo thời lượng của từng bài, kèm HR của cửa sổ đó)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS activity_mean_max (
+            activity_id TEXT,
+            user_id TEXT,
+            start_date TEXT,
+            duration_s INTEGER,
+            speed_mps REAL,
+            hr_bpm REAL,
+            PRIMARY KEY (activity_id, duration_s)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mean_max_user ON activity_mean_max (user_id, duration_s, start_date)")
+
+    # 13. Table: mean_max_envelope (Kỷ lục mọi thời điểm theo thời lượng, cập nhật dần mỗi khi lưu 1 bài)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS mean_max_envelope (
+            user_id TEXT,
+            duration_s INTEGER,
+            speed_mps REAL,
+            hr_bpm REAL,
+            activity_id TEXT,
+            start_date TEXT,
+            PRIMARY KEY (user_id, duration_s)
+        )
+    ''')
+
+    # 14. Table: activity_stream_metrics (Decoupling / GAP / drift / độ ổn định tính 1 lần từ stream gốc)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS activity_stream_metrics (
+            activity_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            moving_time_s INTEGER,
+            avg_speed_mps REAL,
+            gap_speed_mps REAL,
+            avg_hr REAL,
+            ef REAL,
+            decoupling_pct REAL,
+            rolling_decoupling_pct REAL,
+            ef_windows TEXT,
+            hr_drift_bpm_h REAL,
+            cadence_avg REAL,
+            cadence_cv_pct REAL,
+            stride_avg_m REAL,
+            stride_cv_pct REAL,
+            computed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 15. Table: activity_streams (Stream gốc nén npz -> tính lại mọi chỉ số/nhãn mà không gọi Strava)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS activity_streams (
+            activity_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            samples INTEGER,
+            data BLOB,
+            fetched_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_streams_user ON activity_streams (user_id)")
+    # Auto-migrate: lap bấm tay (JSON, gợi ý ranh giới rep cho segmentation) đi kèm stream; NULL = chưa tải
+    try:
+        c.execute("ALTER TABLE activity_streams ADD COLUMN laps TEXT DEFAULT NULL")
+    except sqlite3.OperationalError:
+        pass
+
+    # 16. Table: activity_segments (Cấu trúc bài: khởi động / rep / nghỉ / thả lỏng + nhãn buổi tập)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS activity_segments (
+            activity_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            start_date TEXT,
+            session_type TEXT,
+            work_count INTEGER,
+            work_time_s INTEGER,
+            source TEXT,
+            segments TEXT,
+            computed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_segments_user ON activity_segments (user_id, start_date)")
+
+    # 17. Table: race_predictions (Chuỗi dự đoán thành tích theo ngày: Riegel / VDOT / CS + GCS tất định)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS race_predictions (
+            user_id TEXT,
+            as_of DATE,
+            activity_id TEXT,
+            distance_m REAL,
+            predicted_s REAL,
+            low_s REAL,
+            high_s REAL,
+            riegel_s REAL,
+            vdot REAL,
+            vdot_s REAL,
+            cs_mps REAL,
+            d_prime_m REAL,
+            cs_s REAL,
+            ctl REAL,
+            ctl_change_pct REAL,
+            target_s INTEGER,
+            gcs INTEGER,
+            computed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, as_of)
+        )
+    ''')
+    # Auto-migrate: số ngày tới race day mà dự đoán được chiếu tới (NULL = thể lực hiện tại)
+    try:
+        c.execute("ALTER TABLE race_predictions ADD COLUMN days_to_race INTEGER DEFAULT NULL")
+    except sqlite3.OperationalError:
+        pass
+
+    # 18. Tables: volume_weekly / volume_monthly (Tổng volume theo tuần ISO (thứ 2) và tháng, cập nhật mỗi lần lưu bài)
+    for table, key in (("volume_weekly", "week_start DATE"), ("volume_monthly", "month TEXT")):
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id TEXT,
+                {key},
+                distance_km REAL,
+                moving_time_min REAL,
+                trimp REAL,
+                runs INTEGER,
+                long_run_km REAL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, {key.split()[0]})
+            )
+        ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_run_activities_user_date ON run_activities (user_id, start_date)")
+
+    # Trigger tăng user_data_versions: mọi bảng mà /api/v1 đọc (kể cả dự đoán/mean-max/rollup được ghi
+    # mà không chạm run_activities, VD refresh dự đoán sau HARVEST_COMPLETED) -> ETag không bị 304 cũ
+    version_events = [("users", "UPDATE", "new")] + [
+        (table, event, "old" if event == "DELETE" else "new")
+        for table in ("run_activities", "activity_mean_max", "mean_max_envelope", "race_predictions",
+                      "volume_weekly", "volume_monthly")
+        for event in ("INSERT", "UPDATE", "DELETE")
+    ]
+    for table, event, ref in version_events:
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                INSERT INTO user_data_versions (user_id, version) VALUES ({ref}.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+            END
+        ''')
+
+    # Backfill lần đầu cho DB cũ (bảng rollup mới tạo, run_activities đã có dữ liệu)
+    if not c.execute("SELECT 1 FROM volume_monthly LIMIT 1").fetchone() and c.execute("SELECT 1 FROM run_activities LIMIT 1").fetchone():
+        _rebuild_volume_rollups(c, None)
+
     conn.commit()
     conn.close()
     logger.info("[DATABASE] Relational DB initialized successfully (Multi-Tenant Ready).")
@@ -75,24 +367,78 @@ def init_db():
 # ==========================================
 # USERS CRUD
 # ==========================================
-def upsert_user(user_id: str, name: str = "Runner", max_hr: int = 185, rest_hr: int = 55):
-    """Insert a new user or update existing user."""
+def upsert_user(user_id: str, name: str = "Runner", max_hr: int = 185, rest_hr: int = 55,
+                race_date: Optional[str] = None, current_goal: Optional[str] = None, sex: Optional[str] = None):
+    """Insert a new user or update existing user. race_date/current_goal/sex = None giữ nguyên giá trị cũ."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
         c.execute('''
-            INSERT INTO users (user_id, name, max_hr, rest_hr)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO users (user_id, name, max_hr, rest_hr, race_date, current_goal, sex)
+            VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 'M'))
             ON CONFLICT(user_id) DO UPDATE SET
                 name=excluded.name,
                 max_hr=excluded.max_hr,
-                rest_hr=excluded.rest_hr
-        ''', (str(user_id), name, max_hr, rest_hr))
+                rest_hr=excluded.rest_hr,
+                race_date=COALESCE(excluded.race_date, users.race_date),
+                current_goal=COALESCE(excluded.current_goal, users.current_goal),
+                sex=CASE WHEN ? IS NULL THEN users.sex ELSE excluded.sex END
+        ''', (str(user_id), name, max_hr, rest_hr, race_date, current_goal, sex, sex))
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"[DB_ERROR] Failed to upsert user: {e}")
 
+def save_strava_credentials(user_id: str, athlete_id: Optional[str], refresh_token: str,
+                            access_token: Optional[str] = None, expires_at: int = 0):
+    """Lưu (hoặc xoay vòng) token Strava của 1 VĐV. Tạo user nếu chưa có."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO users (user_id, strava_athlete_id, strava_refresh_token, strava_access_token, strava_token_expires_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                strava_athlete_id=COALESCE(excluded.strava_athlete_id, users.strava_athlete_id),
+                strava_refresh_token=excluded.strava_refresh_token,
+                strava_access_token=excluded.strava_access_token,
+                strava_token_expires_at=excluded.strava_token_expires_at
+        ''', (str(user_id), str(athlete_id) if athlete_id else None, refresh_token, access_token, int(expires_at or 0)))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save Strava credentials: {e}")
+
+def get_active_users() -> List[Dict]:
+    """Danh sách VĐV đang active và đã kết nối Strava (đầu vào cho Harvest fan-out)."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT * FROM users
+            WHERE is_active = 1 AND strava_refresh_token IS NOT NULL AND strava_refresh_token != ''
+            ORDER BY user_id
+        ''')
+        rows = c.fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to list active users: {e}")
+        return []
+
+def get_user_by_athlete_id(athlete_id: str) -> Optional[Dict]:
+    """Tra user từ owner_id của Strava Webhook."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE strava_athlete_id = ?", (str(athlete_id),))
+        row = c.fetchone()
+        conn.close()
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get user by athlete id: {e}")
+        return None
+
 def get_user(user_id: str) -> Optional[Dict]:
     """Retrieve user physiology profile."""
     try:
@@ -115,17 +461,7 @@ def save_run_activity(user_id: str, activity_data: Dict):
         conn = get_db_connection()
         c = conn.cursor()
         
-        # Lấy GCS cũ nếu có để không bị mất điểm khi chạy Sync ghi đè
-        c.execute("SELECT gcs_score FROM run_activities WHERE activity_id = ?", (str(activity_data['activity_id']),))
-        row = c.fetchone()
-        existing_gcs = row['gcs_score'] if row else None
-
-        c.execute('''
-            INSERT OR REPLACE INTO run_activities 
-            (activity_id, user_id, name, start_date, distance_km, moving_time_min, avg_hr, max_hr, suffer_score, trimp_score, gcs_score)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            str(activity_data['activity_id']),
+        values = (
             str(user_id),
             activity_data.get('name', 'Untitled'),
             activity_data.get('start_date'),
@@ -135,23 +471,76 @@ def save_run_activity(user_id: str, activity_data: Dict):
             activity_data.get('max_hr', 0),
             activity_data.get('suffer_score', 0),
             activity_data.get('trimp_score', 0.0),
-            existing_gcs
-        ))
+        )
+        # Lấy GCS cũ nếu có để không bị mất điểm khi chạy Sync ghi đè
+        c.execute('''
+            SELECT user_id, name, start_date, distance_km, moving_time_min, avg_hr, max_hr, suffer_score, trimp_score, gcs_score
+            FROM run_activities WHERE activity_id = ?
+        ''', (str(activity_data['activity_id']),))
+        row = c.fetchone()
+        # Harvest lưu lại cùng ~10 bài mỗi lượt: hàng không đổi -> bỏ qua, không ghi (trigger version/ETag)
+        # và không phát ACTIVITY_SAVED (tránh tính lại predictor/digest vô ích)
+        if row and tuple(row)[:-1] == values:
+            conn.close()
+            return
+        existing_gcs = row['gcs_score'] if row else None
+        touched_dates = {row['start_date'] if row else None, activity_data.get('start_date')}
+
+        c.execute('''
+            INSERT OR REPLACE INTO run_activities 
+            (activity_id, user_id, name, start_date, distance_km, moving_time_min, avg_hr, max_hr, suffer_score, trimp_score, gcs_score)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (str(activity_data['activity_id']), *values, existing_gcs))
+        _refresh_volume_buckets(c, str(user_id), touched_dates)
         conn.commit()
         conn.close()
+        event_bus.publish(ACTIVITY_SAVED, user_id=str(user_id), activity_id=str(activity_data['activity_id']),
+                          start_date=activity_data.get('start_date'))
     except Exception as e:
         logger.error(f"[DB_ERROR] Failed to save run activity: {e}")
 
-def update_run_gcs_score(activity_id: str, gcs_score: int):
-    """Cập nhật điểm GCS sau khi AI phân tích xong."""
+def iter_activity_hr_chunks(user_id: str, chunk_size: int = 5000) -> Iterator[List[Tuple]]:
+    """
+    Duyệt toàn bộ bài chạy của 1 VĐV theo lô (keyset theo rowid, không OFFSET):
+    mỗi lô là list (activity_id, moving_time_min, avg_hr, trimp_score, bpm_start, bpm_seconds_json).
+    bpm_* là histogram nhịp tim từng giây (NULL nếu bài chưa có stream).
+    Dùng cho job tính lại TRIMP khi thông số sinh lý thay đổi.
+    """
+    conn = get_db_connection()
+    try:
+        last_rowid = 0
+        while True:
+            rows = conn.execute('''
+                SELECT r.rowid, r.activity_id, r.moving_time_min, r.avg_hr, r.trimp_score, m.bpm_start, m.bpm_seconds
+                FROM run_activities r LEFT JOIN activity_load_metrics m ON m.activity_id = r.activity_id
+                WHERE r.user_id = ? AND r.rowid > ? ORDER BY r.rowid LIMIT ?
+            ''', (str(user_id), last_rowid, chunk_size)).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [tuple(r)[1:] for r in rows]
+    finally:
+        conn.close()
+
+def bulk_update_trimp(updates: List[Tuple[float, str]]) -> int:
+    """Ghi hàng loạt (trimp_score, activity_id) trong 1 transaction. Trả về số dòng thực sự đổi."""
+    if not updates:
+        return 0
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("UPDATE run_activities SET gcs_score = ? WHERE activity_id = ?", (gcs_score, str(activity_id)))
+        # Bỏ qua dòng không đổi -> trigger phiên bản dữ liệu/ETag chỉ chạy khi cần
+        c.executemany(
+            "UPDATE run_activities SET trimp_score = ? WHERE activity_id = ? AND trimp_score IS NOT ?",
+            [(trimp, activity_id, trimp) for trimp, activity_id in updates],
+        )
+        changed = c.rowcount
         conn.commit()
         conn.close()
+        return changed
     except Exception as e:
-        logger.error(f"[DB_ERROR] Failed to update GCS: {e}")
+        logger.error(f"[DB_ERROR] Failed to bulk update TRIMP: {e}")
+        return 0
 # ==========================================
 # CHAT HISTORY CRUD
 # ==========================================
@@ -163,6 +552,7 @@ def save_message(user_id: str, role: str, text: str):
                   (str(user_id), role, text))
         conn.commit()
         conn.close()
+        event_bus.publish(MESSAGE_SAVED, user_id=str(user_id))
     except Exception as e:
         logger.error(f"[DB_ERROR] Save Message Error: {e}")
 
@@ -191,6 +581,7 @@ def clear_history(user_id: str):
         c.execute("DELETE FROM chat_history WHERE user_id = ?", (str(user_id),))
         conn.commit()
         conn.close()
+        event_bus.publish(MESSAGE_SAVED, user_id=str(user_id))
     except Exception as e:
         logger.error(f"[DB_ERROR] Clear History Error: {e}")
 # ==========================================
@@ -232,10 +623,11 @@ def get_recent_runs_log(user_id: str, limit: int = 5) -> str:
         conn = get_db_connection()
         c = conn.cursor()
         c.execute('''
-            SELECT start_date, name, distance_km, trimp_score, gcs_score 
-            FROM run_activities 
-            WHERE user_id = ? 
-            ORDER BY start_date DESC LIMIT ?
+            SELECT r.start_date, r.name, r.distance_km, r.trimp_score, r.gcs_score, s.session_type
+            FROM run_activities r
+            LEFT JOIN activity_segments s ON s.activity_id = r.activity_id
+            WHERE r.user_id = ? 
+            ORDER BY r.start_date DESC LIMIT ?
         ''', (str(user_id), limit))
         rows = c.fetchall()
         conn.close()
@@ -246,8 +638,784 @@ def get_recent_runs_log(user_id: str, limit: int = 5) -> str:
         for r in rows:
             date_str = r['start_date'][:10]
             gcs_text = f" | GCS: {r['gcs_score']}%" if r['gcs_score'] is not None else ""
-            log_lines.append(f"- {date_str}: {r['name']} | {r['distance_km']}km | TRIMP Load: {r['trimp_score']}{gcs_text}")
+            type_text = f" [{r['session_type'].upper()}]" if r['session_type'] else ""
+            log_lines.append(f"- {date_str}: {r['name']}{type_text} | {r['distance_km']}km | TRIMP Load: {r['trimp_score']}{gcs_text}")
         return "\n".join(log_lines)
     except Exception as e:
         logger.error(f"[DB_ERROR] Failed to get recent runs: {e}")
-        return "Error loading recent runs."
\ No newline at end of file
+        return "Error loading recent runs."
+
+def get_data_version(user_id: str) -> Optional[int]:
+    """Phiên bản dữ liệu của user (tăng bởi trigger mỗi khi run_activities/users hoặc bảng dẫn xuất thay đổi)."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT version FROM user_data_versions WHERE user_id = ?", (str(user_id),))
+        row = c.fetchone()
+        conn.close()
+        return row["version"] if row else 0
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get data version: {e}")
+        return None
+
+def get_activities(user_id: str, start: Optional[str] = None, end: Optional[str] = None, limit: int = 20) -> List[Dict]:
+    """Các bài chạy mới nhất trong khoảng ngày [start, end] (YYYY-MM-DD)."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT activity_id, start_date, name, distance_km, moving_time_min, avg_hr, max_hr, trimp_score, gcs_score
+            FROM run_activities
+            WHERE user_id = ? AND (? IS NULL OR start_date >= ?) AND (? IS NULL OR substr(start_date, 1, 10) <= ?)
+            ORDER BY start_date DESC LIMIT ?
+        ''', (str(user_id), start, start, end, end, limit))
+        rows = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get activities: {e}")
+        return []
+
+def get_daily_training(user_id: str, since: str, until: str) -> List[Dict]:
+    """Tổng TRIMP + km theo ngày (YYYY-MM-DD) trong khoảng [since, until]."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT substr(start_date, 1, 10) AS day, SUM(trimp_score) AS trimp, SUM(distance_km) AS distance_km
+            FROM run_activities
+            WHERE user_id = ? AND start_date >= ? AND substr(start_date, 1, 10) <= ?
+            GROUP BY day ORDER BY day
+        ''', (str(user_id), since, until))
+        rows = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get daily training: {e}")
+        return []
+
+# ==========================================
+# KEYWORD INDEX (FTS5)
+# ==========================================
+def index_memory_text(ref_id: str, user_id: Optional[str], content: str, source: str = "memory"):
+    """Ghi (hoặc ghi đè) văn bản của một ký ức RAG vào FTS5 index."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("DELETE FROM memory_fts WHERE ref_id = ?", (str(ref_id),))
+        c.execute("INSERT INTO memory_fts (content, user_id, source, ref_id) VALUES (?, ?, ?, ?)",
+                  (content, str(user_id) if user_id else None, source, str(ref_id)))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to index memory text: {e}")
+
+def _build_fts_query(query: str, operator: str = "AND") -> str:
+    """Chuyển câu hỏi tự do thành cú pháp FTS5 an toàn (mỗi từ được đặt trong dấu ngoặc kép)."""
+    tokens = re.findall(r"\w+", query, re.UNICODE)
+    return f" {operator} ".join(f'"{t}"' for t in tokens)
+
+def search_keyword_memory(user_id: str, query: str, limit: int = 5) -> List[Dict]:
+    """
+    Tìm kiếm từ khóa (BM25) trong chat_history và ký ức RAG của một user.
+    Thử khớp TẤT CẢ từ khóa trước, nếu không có kết quả thì nới lỏng sang khớp BẤT KỲ từ nào.
+    """
+    results = []
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        for operator in ("AND", "OR"):
+            fts_query = _build_fts_query(query, operator)
+            if not fts_query:
+                break
+            c.execute('''
+                SELECT ref_id, source, content, bm25(memory_fts) AS score
+                FROM memory_fts
+                WHERE memory_fts MATCH ? AND user_id = ?
+                ORDER BY score LIMIT ?
+            ''', (fts_query, str(user_id), limit))
+            results = [dict(row) for row in c.fetchall()]
+            if results:
+                break
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Keyword search failed: {e}")
+    return results
+
+# ==========================================
+# SCHEDULER JOB RUNS
+# ==========================================
+def record_job_run(job_id: str, status: str, started_at: Optional[str] = None,
+                   duration_s: Optional[float] = None, error: Optional[str] = None):
+    """Ghi kết quả lần chạy gần nhất của một job. status: success | failed | missed | skipped."""
+    ran = status in ("success", "failed")
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO job_runs (job_id, last_started_at, last_duration_s, last_status, last_error,
+                                  run_count, failure_count, missed_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(job_id) DO UPDATE SET
+                last_started_at = COALESCE(excluded.last_started_at, last_started_at),
+                last_duration_s = COALESCE(excluded.last_duration_s, last_duration_s),
+                last_status = excluded.last_status,
+                last_error = excluded.last_error,
+                run_count = run_count + excluded.run_count,
+                failure_count = failure_count + excluded.failure_count,
+                missed_count = missed_count + excluded.missed_count,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (
+            job_id, started_at, duration_s, status, error,
+            1 if ran else 0,
+            1 if status == "failed" else 0,
+            0 if ran else 1,
+        ))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to record job run: {e}")
+
+def get_job_runs() -> List[Dict]:
+    """Lấy trạng thái chạy gần nhất của tất cả job (cho Admin UI)."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT * FROM job_runs ORDER BY job_id")
+        rows = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get job runs: {e}")
+        return []
+
+# ==========================================
+# LEADER LEASES & SHARED RUNTIME STATE
+# ==========================================
+def try_acquire_lease(name: str, holder: str, ttl_seconds: float) -> bool:
+    """
+    Giành hoặc gia hạn lease. Thành công khi lease đang trống, đã hết hạn, hoặc chính holder đang giữ.
+    Câu lệnh UPSERT có điều kiện là nguyên tử nên an toàn giữa nhiều process.
+    """
+    now = time.time()
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO leases (name, holder, expires_at, acquired_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                expires_at = excluded.expires_at,
+                acquired_at = CASE WHEN leases.holder = excluded.holder THEN leases.acquired_at ELSE excluded.acquired_at END
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        ''', (name, holder, now + ttl_seconds, now, now))
+        conn.commit()
+        c.execute("SELECT holder FROM leases WHERE name = ?", (name,))
+        row = c.fetchone()
+        conn.close()
+        return bool(row and row["holder"] == holder)
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Lease '{name}' acquire failed: {e}")
+        return False
+
+def holds_lease(name: str, holder: str) -> bool:
+    """holder có đang giữ lease còn hạn không (job kiểm tra trước khi ghi, phòng Leader cũ bị treo quá TTL)."""
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        conn.close()
+        return bool(row and row["holder"] == holder and row["expires_at"] > time.time())
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Lease '{name}' check failed: {e}")
+        return False
+
+def release_lease(name: str, holder: str):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Lease '{name}' release failed: {e}")
+
+def get_runtime_state(key: str, default: Optional[str] = None) -> Optional[str]:
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT value FROM runtime_state WHERE key = ?", (key,))
+        row = c.fetchone()
+        conn.close()
+        return row["value"] if row else default
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to read runtime state '{key}': {e}")
+        return default
+
+def set_runtime_state(key: str, value: str):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO runtime_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+        ''', (key, str(value)))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to write runtime state '{key}': {e}")
+
+# ==========================================
+# EMAIL OUTBOX
+# ==========================================
+def enqueue_email(recipient: str, subject: str, html_content: str) -> Optional[int]:
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("INSERT INTO email_outbox (recipient, subject, html_content, next_attempt_at) VALUES (?, ?, ?, ?)",
+                  (recipient, subject, html_content, time.time()))
+        conn.commit()
+        email_id = c.lastrowid
+        conn.close()
+        return email_id
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to enqueue email: {e}")
+        return None
+
+def claim_pending_emails(limit: int = 20, stale_after: float = 600) -> List[Dict]:
+    """
+    Nhận 1 lô email đến hạn gửi (status -> 'sending'). Cập nhật có điều kiện nên 2 worker
+    không bao giờ nhận trùng 1 email; email 'sending' quá `stale_after` giây (worker chết) được nhận lại.
+    """
+    now = time.time()
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT id FROM email_outbox
+            WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND claimed_at < ?)
+            ORDER BY id LIMIT ?
+        ''', (now, now - stale_after, limit))
+        claimed = []
+        for row in c.fetchall():
+            c.execute('''
+                UPDATE email_outbox SET status = 'sending', claimed_at = ?, attempts = attempts + 1
+                WHERE id = ? AND ((status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND claimed_at < ?))
+            ''', (now, row["id"], now, now - stale_after))
+            if c.rowcount:
+                claimed.append(row["id"])
+        conn.commit()
+        emails = []
+        if claimed:
+            c.execute(f"SELECT * FROM email_outbox WHERE id IN ({','.join('?' * len(claimed))}) ORDER BY id", claimed)
+            emails = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return emails
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to claim emails: {e}")
+        return []
+
+def mark_email_sent(email_id: int):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("UPDATE email_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = ?", (email_id,))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to mark email {email_id} sent: {e}")
+
+def mark_email_failed(email_id: int, error: str, retry_at: Optional[float] = None):
+    """retry_at = None: lỗi vĩnh viễn (status 'failed'); ngược lại trả về 'pending' để thử lại sau."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        if retry_at is None:
+            c.execute("UPDATE email_outbox SET status = 'failed', last_error = ? WHERE id = ?", (error, email_id))
+        else:
+            c.execute("UPDATE email_outbox SET status = 'pending', last_error = ?, next_attempt_at = ? WHERE id = ?",
+                      (error, retry_at, email_id))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to update email {email_id}: {e}")
+
+def count_emails_by_status() -> Dict[str, int]:
+    """Số email trong outbox theo trạng thái (cho metrics)."""
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT status, COUNT(*) AS n FROM email_outbox GROUP BY status")
+        counts = {row["status"]: row["n"] for row in c.fetchall()}
+        conn.close()
+        return counts
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to count emails: {e}")
+        return {}
+
+# ==========================================
+# BRIEFING DIGESTS
+# ==========================================
+def save_briefing_digest(user_id: str, for_date: str, message: str, payload: str):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO briefing_digests (user_id, for_date, message, payload, built_at, sent_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, NULL)
+            ON CONFLICT(user_id) DO UPDATE SET
+                for_date = excluded.for_date,
+                message = excluded.message,
+                payload = excluded.payload,
+                built_at = CURRENT_TIMESTAMP,
+                sent_at = CASE WHEN briefing_digests.for_date = excluded.for_date THEN briefing_digests.sent_at END
+        ''', (str(user_id), for_date, message, payload))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save briefing digest: {e}")
+
+def get_briefing_digest(user_id: str) -> Optional[Dict]:
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT * FROM briefing_digests WHERE user_id = ?", (str(user_id),))
+        row = c.fetchone()
+        conn.close()
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get briefing digest: {e}")
+        return None
+
+def mark_briefing_sent(user_id: str):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("UPDATE briefing_digests SET sent_at = CURRENT_TIMESTAMP WHERE user_id = ?", (str(user_id),))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to mark briefing sent: {e}")
+
+# ==========================================
+# ACTIVITY LOAD METRICS (stream-based)
+# ==========================================
+def save_activity_load(activity_id: str, user_id: str, metrics: Dict, max_hr: int, rest_hr: int, sex: str):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR REPLACE INTO activity_load_metrics
+            (activity_id, user_id, bannister_trimp, edwards_trimp, zone_seconds, hr_seconds,
+             bpm_start, bpm_seconds, max_hr, rest_hr, sex, computed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (
+            str(activity_id), str(user_id), metrics["bannister_trimp"], metrics["edwards_trimp"],
+            json.dumps(metrics["zone_seconds"]), metrics["hr_seconds"], metrics["bpm_start"],
+            json.dumps(metrics["bpm_seconds"], separators=(",", ":")), max_hr, rest_hr, sex,
+        ))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save load metrics for {activity_id}: {e}")
+
+def get_activity_load(activity_id: str) -> Optional[Dict]:
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT * FROM activity_load_metrics WHERE activity_id = ?", (str(activity_id),))
+        row = c.fetchone()
+        conn.close()
+        if not row:
+            return None
+        data = dict(row)
+        data["zone_seconds"] = json.loads(data["zone_seconds"] or "{}")
+        data["bpm_seconds"] = json.loads(data["bpm_seconds"] or "[]")
+        return data
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get load metrics for {activity_id}: {e}")
+        return None
+
+def bulk_update_activity_load(rows: List[Tuple]) -> None:
+    """rows: (bannister_trimp, edwards_trimp, zone_seconds_json, max_hr, rest_hr, sex, activity_id)."""
+    if not rows:
+        return
+    try:
+        conn = get_db_connection()
+        conn.executemany('''
+            UPDATE activity_load_metrics SET bannister_trimp = ?, edwards_trimp = ?, zone_seconds = ?,
+                max_hr = ?, rest_hr = ?, sex = ?, computed_at = CURRENT_TIMESTAMP
+            WHERE activity_id = ?
+        ''', rows)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to bulk update load metrics: {e}")
+
+# ==========================================
+# MEAN-MAX CURVES (best efforts)
+# ==========================================
+def has_mean_max_curve(activity_id: str) -> bool:
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT 1 FROM activity_mean_max WHERE activity_id = ? LIMIT 1", (str(activity_id),)).fetchone()
+        conn.close()
+        return row is not None
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to check mean-max curve for {activity_id}: {e}")
+        return False
+
+def save_mean_max_curve(activity_id: str, user_id: str, start_date: str, curve: Dict[int, Dict]):
+    """
+    Ghi curve của 1 bài rồi cập nhật envelope của user: chỉ các thời lượng bài này vượt kỷ lục.
+    Nếu bài đang giữ kỷ lục bị ghi đè với giá trị thấp hơn -> dựng lại thời lượng đó từ activity_mean_max.
+    """
+    if not curve:
+        return
+    activity_id, user_id = str(activity_id), str(user_id)
+    rows = [(activity_id, user_id, start_date, d, p["speed_mps"], p.get("hr_bpm")) for d, p in curve.items()]
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("DELETE FROM activity_mean_max WHERE activity_id = ?", (activity_id,))
+        c.executemany('''
+            INSERT INTO activity_mean_max (activity_id, user_id, start_date, duration_s, speed_mps, hr_bpm)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        c.executemany('''
+            INSERT INTO mean_max_envelope (activity_id, user_id, start_date, duration_s, speed_mps, hr_bpm)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, duration_s) DO UPDATE SET
+                speed_mps = excluded.speed_mps, hr_bpm = excluded.hr_bpm,
+                activity_id = excluded.activity_id, start_date = excluded.start_date
+            WHERE excluded.speed_mps > mean_max_envelope.speed_mps
+        ''', rows)
+        # Kỷ lục cũ thuộc chính bài này nhưng giá trị mới thấp hơn (ghi đè/sửa dữ liệu)
+        c.execute('''
+            SELECT e.duration_s FROM mean_max_envelope e
+            LEFT JOIN activity_mean_max m ON m.activity_id = e.activity_id AND m.duration_s = e.duration_s
+            WHERE e.user_id = ? AND e.activity_id = ? AND (m.speed_mps IS NULL OR m.speed_mps < e.speed_mps)
+        ''', (user_id, activity_id))
+        for (duration_s,) in c.fetchall():
+            c.execute("DELETE FROM mean_max_envelope WHERE user_id = ? AND duration_s = ?", (user_id, duration_s))
+            c.execute('''
+                INSERT INTO mean_max_envelope (activity_id, user_id, start_date, duration_s, speed_mps, hr_bpm)
+                SELECT activity_id, user_id, start_date, duration_s, speed_mps, hr_bpm FROM activity_mean_max
+                WHERE user_id = ? AND duration_s = ? ORDER BY speed_mps DESC LIMIT 1
+            ''', (user_id, duration_s))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save mean-max curve for {activity_id}: {e}")
+
+def get_mean_max_bests(user_id: str, since: Optional[str] = None, until: Optional[str] = None) -> List[Dict]:
+    """
+    Nỗ lực tốt nhất theo từng thời lượng. since=None -> đọc envelope (kỷ lục mọi thời điểm),
+    since='YYYY-MM-DD' -> MAX trên activity_mean_max trong khoảng [since, until] (index user_id, duration_s, start_date).
+    """
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        if since is None:
+            c.execute('''
+                SELECT duration_s, speed_mps, hr_bpm, activity_id, start_date FROM mean_max_envelope
+                WHERE user_id = ? ORDER BY duration_s
+            ''', (str(user_id),))
+        else:
+            # SQLite: cột "trần" đi cùng MAX() lấy từ đúng dòng đạt MAX
+            c.execute('''
+                SELECT duration_s, MAX(speed_mps) AS speed_mps, hr_bpm, activity_id, start_date
+                FROM activity_mean_max
+                WHERE user_id = ? AND start_date >= ? AND (? IS NULL OR substr(start_date, 1, 10) <= ?)
+                GROUP BY duration_s ORDER BY duration_s
+            ''', (str(user_id), since, until, until))
+        rows = [dict(r) for r in c.fetchall()]
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get mean-max bests: {e}")
+        return []
+
+# ==========================================
+# STREAM ANALYTICS (cached per activity)
+# ==========================================
+STREAM_METRIC_COLUMNS = (
+    "moving_time_s", "avg_speed_mps", "gap_speed_mps", "avg_hr", "ef", "decoupling_pct", "rolling_decoupling_pct",
+    "ef_windows", "hr_drift_bpm_h", "cadence_avg", "cadence_cv_pct", "stride_avg_m", "stride_cv_pct",
+)
+
+def save_stream_metrics(activity_id: str, user_id: str, metrics: Dict):
+    try:
+        values = [json.dumps(metrics.get(col)) if col == "ef_windows" else metrics.get(col) for col in STREAM_METRIC_COLUMNS]
+        conn = get_db_connection()
+        conn.execute(f'''
+            INSERT OR REPLACE INTO activity_stream_metrics
+            (activity_id, user_id, {", ".join(STREAM_METRIC_COLUMNS)}, computed_at)
+            VALUES (?, ?, {", ".join("?" * len(STREAM_METRIC_COLUMNS))}, CURRENT_TIMESTAMP)
+        ''', (str(activity_id), str(user_id), *values))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save stream metrics for {activity_id}: {e}")
+
+def get_stream_metrics(activity_id: str) -> Optional[Dict]:
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT * FROM activity_stream_metrics WHERE activity_id = ?", (str(activity_id),)).fetchone()
+        conn.close()
+        if not row:
+            return None
+        data = dict(row)
+        data["ef_windows"] = json.loads(data["ef_windows"] or "[]")
+        return data
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get stream metrics for {activity_id}: {e}")
+        return None
+
+# ==========================================
+# RAW STREAMS & SEGMENTATION
+# ==========================================
+def save_activity_streams(activity_id: str, user_id: str, samples: int, blob: bytes):
+    try:
+        conn = get_db_connection()
+        conn.execute('''
+            INSERT INTO activity_streams (activity_id, user_id, samples, data, fetched_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(activity_id) DO UPDATE SET
+                user_id=excluded.user_id, samples=excluded.samples, data=excluded.data, fetched_at=excluded.fetched_at
+        ''', (str(activity_id), str(user_id), samples, sqlite3.Binary(blob)))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save streams for {activity_id}: {e}")
+
+def get_activity_streams_blob(activity_id: str) -> Optional[bytes]:
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT data FROM activity_streams WHERE activity_id = ?", (str(activity_id),)).fetchone()
+        conn.close()
+        return bytes(row["data"]) if row else None
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get streams for {activity_id}: {e}")
+        return None
+
+def save_activity_laps(activity_id: str, laps: List[Dict]):
+    """Ghi lap của 1 bài vào hàng stream đã lưu ([] = bài không có lap, khác NULL = chưa tải)."""
+    try:
+        conn = get_db_connection()
+        conn.execute("UPDATE activity_streams SET laps = ? WHERE activity_id = ?",
+                     (json.dumps(laps or [], separators=(",", ":")), str(activity_id)))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save laps for {activity_id}: {e}")
+
+def get_activity_laps(activity_id: str) -> Optional[List[Dict]]:
+    """Lap đã lưu của 1 bài; None nếu chưa tải (hoặc chưa có stream)."""
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT laps FROM activity_streams WHERE activity_id = ?", (str(activity_id),)).fetchone()
+        conn.close()
+        return json.loads(row["laps"]) if row and row["laps"] is not None else None
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get laps for {activity_id}: {e}")
+        return None
+
+def iter_stream_blobs(user_id: str, chunk_size: int = 200) -> Iterator[List[Tuple]]:
+    """Stream đã lưu của 1 user theo lô (keyset theo rowid): (activity_id, start_date, blob, laps | None)."""
+    conn = get_db_connection()
+    try:
+        last_rowid = 0
+        while True:
+            rows = conn.execute('''
+                SELECT s.rowid, s.activity_id, r.start_date, s.data, s.laps
+                FROM activity_streams s JOIN run_activities r ON r.activity_id = s.activity_id
+                WHERE s.user_id = ? AND s.rowid > ? ORDER BY s.rowid LIMIT ?
+            ''', (str(user_id), last_rowid, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            yield [(r[1], r[2], bytes(r[3]), json.loads(r[4]) if r[4] is not None else None) for r in rows]
+    finally:
+        conn.close()
+
+def save_activity_segments(rows: List[Tuple]) -> None:
+    """rows: (activity_id, user_id, start_date, session_type, work_count, work_time_s, source, segments_json)."""
+    if not rows:
+        return
+    try:
+        conn = get_db_connection()
+        conn.executemany('''
+            INSERT OR REPLACE INTO activity_segments
+            (activity_id, user_id, start_date, session_type, work_count, work_time_s, source, segments, computed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', rows)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save activity segments: {e}")
+
+def get_activity_segments(activity_id: str) -> Optional[Dict]:
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT * FROM activity_segments WHERE activity_id = ?", (str(activity_id),)).fetchone()
+        conn.close()
+        if not row:
+            return None
+        data = dict(row)
+        data["segments"] = json.loads(data["segments"] or "[]")
+        return data
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get segments for {activity_id}: {e}")
+        return None
+
+def get_session_mix(user_id: str, since: str, until: str) -> Dict[str, int]:
+    """Số buổi theo loại (easy/long/tempo/interval) trong khoảng ngày [since, until]."""
+    try:
+        conn = get_db_connection()
+        rows = conn.execute('''
+            SELECT session_type, COUNT(*) AS n FROM activity_segments
+            WHERE user_id = ? AND start_date >= ? AND substr(start_date, 1, 10) <= ?
+            GROUP BY session_type
+        ''', (str(user_id), since, until)).fetchall()
+        conn.close()
+        return {r["session_type"]: r["n"] for r in rows}
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get session mix: {e}")
+        return {}
+
+# ==========================================
+# RACE PREDICTIONS (time series)
+# ==========================================
+RACE_PREDICTION_COLUMNS = (
+    "activity_id", "distance_m", "predicted_s", "low_s", "high_s", "riegel_s", "vdot", "vdot_s",
+    "cs_mps", "d_prime_m", "cs_s", "ctl", "ctl_change_pct", "target_s", "gcs", "days_to_race",
+)
+
+def save_race_prediction(user_id: str, as_of: str, prediction: Dict):
+    """Ghi dự đoán của ngày `as_of` (ghi đè trong ngày) và GCS tất định vào bài vừa lưu (nếu có)."""
+    try:
+        values = [prediction.get(col) for col in RACE_PREDICTION_COLUMNS]
+        conn = get_db_connection()
+        conn.execute(f'''
+            INSERT OR REPLACE INTO race_predictions
+            (user_id, as_of, {", ".join(RACE_PREDICTION_COLUMNS)}, computed_at)
+            VALUES (?, ?, {", ".join("?" * len(RACE_PREDICTION_COLUMNS))}, CURRENT_TIMESTAMP)
+        ''', (str(user_id), as_of, *values))
+        if prediction.get("activity_id") and prediction.get("gcs") is not None:
+            conn.execute("UPDATE run_activities SET gcs_score = ? WHERE activity_id = ?",
+                         (prediction["gcs"], str(prediction["activity_id"])))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to save race prediction for {user_id}: {e}")
+
+def get_race_predictions(user_id: str, since: Optional[str] = None, until: Optional[str] = None) -> List[Dict]:
+    """Chuỗi dự đoán theo ngày (cũ -> mới) trong khoảng [since, until]."""
+    try:
+        conn = get_db_connection()
+        rows = conn.execute('''
+            SELECT * FROM race_predictions
+            WHERE user_id = ? AND (? IS NULL OR as_of >= ?) AND (? IS NULL OR as_of <= ?)
+            ORDER BY as_of
+        ''', (str(user_id), since, since, until, until)).fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get race predictions: {e}")
+        return []
+
+def get_latest_race_prediction(user_id: str) -> Optional[Dict]:
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT * FROM race_predictions WHERE user_id = ? ORDER BY as_of DESC LIMIT 1",
+                           (str(user_id),)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get latest race prediction: {e}")
+        return None
+
+# ==========================================
+# VOLUME ROLLUPS (tuần ISO / tháng)
+# ==========================================
+# Mỗi lần lưu bài chỉ tính lại đúng 1 tuần + 1 tháng chứa bài đó (index user_id, start_date);
+# rebuild toàn bộ bằng 1 câu INSERT ... SELECT GROUP BY cho mỗi bảng.
+_VOLUME_AGG = """COUNT(*) AS runs, SUM(COALESCE(distance_km, 0)) AS distance_km,
+    SUM(COALESCE(moving_time_min, 0)) AS moving_time_min, SUM(COALESCE(trimp_score, 0)) AS trimp,
+    MAX(COALESCE(distance_km, 0)) AS long_run_km"""
+_VOLUME_TABLES = {
+    "week": ("volume_weekly", "week_start", "date(substr(start_date, 1, 10), 'weekday 0', '-6 days')"),
+    "month": ("volume_monthly", "month", "substr(start_date, 1, 7)"),
+}
+
+def _volume_buckets(start_date: str) -> List[Tuple[str, str, str, str, str]]:
+    """(table, key_col, bucket, lo, hi) - khoảng [lo, hi) của tuần (bắt đầu thứ 2) và tháng chứa `start_date`."""
+    day = date.fromisoformat(start_date[:10])
+    week_start = day - timedelta(days=day.weekday())
+    month_start = day.replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    return [
+        ("volume_weekly", "week_start", week_start.isoformat(), week_start.isoformat(), (week_start + timedelta(days=7)).isoformat()),
+        ("volume_monthly", "month", month_start.isoformat()[:7], month_start.isoformat(), next_month.isoformat()),
+    ]
+
+def _refresh_volume_buckets(c, user_id: str, start_dates: Iterable[Optional[str]]):
+    """Tính lại các ô tuần/tháng bị ảnh hưởng (chạy trong transaction của caller)."""
+    buckets = {b for d in start_dates if d for b in _volume_buckets(d)}
+    for table, key_col, bucket, lo, hi in buckets:
+        row = c.execute(f"SELECT {_VOLUME_AGG} FROM run_activities WHERE user_id = ? AND start_date >= ? AND start_date < ?",
+                        (user_id, lo, hi)).fetchone()
+        if row["runs"]:
+            c.execute(f'''
+                INSERT OR REPLACE INTO {table} (user_id, {key_col}, distance_km, moving_time_min, trimp, runs, long_run_km, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (user_id, bucket, row["distance_km"], row["moving_time_min"], row["trimp"], row["runs"], row["long_run_km"]))
+        else:
+            c.execute(f"DELETE FROM {table} WHERE user_id = ? AND {key_col} = ?", (user_id, bucket))
+
+def _rebuild_volume_rollups(c, user_id: Optional[str]) -> int:
+    rows = 0
+    for table, key_col, bucket_sql in _VOLUME_TABLES.values():
+        c.execute(f"DELETE FROM {table} WHERE ? IS NULL OR user_id = ?", (user_id, user_id))
+        c.execute(f'''
+            INSERT INTO {table} (user_id, {key_col}, runs, distance_km, moving_time_min, trimp, long_run_km)
+            SELECT user_id, {bucket_sql} AS bucket, {_VOLUME_AGG}
+            FROM run_activities
+            WHERE start_date IS NOT NULL AND (? IS NULL OR user_id = ?)
+            GROUP BY user_id, bucket
+        ''', (user_id, user_id))
+        rows += c.rowcount
+    return rows
+
+def rebuild_volume_rollups(user_id: Optional[str] = None) -> int:
+    """Dựng lại rollup tuần/tháng từ run_activities (1 VĐV hoặc tất cả). Trả về số dòng rollup."""
+    try:
+        conn = get_db_connection()
+        rows = _rebuild_volume_rollups(conn.cursor(), str(user_id) if user_id else None)
+        conn.commit()
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to rebuild volume rollups: {e}")
+        return 0
+
+def get_volume_rollups(user_id: str, period: str = "week", since: Optional[str] = None,
+                       until: Optional[str] = None) -> List[Dict]:
+    """
+    Volume theo tuần (period='week', key week_start YYYY-MM-DD) hoặc tháng ('month', key YYYY-MM), cũ -> mới.
+    since/until so sánh trực tiếp với key (VD tháng: '2026-01' .. '2026-12').
+    """
+    table, key_col, _ = _VOLUME_TABLES[period]
+    try:
+        conn = get_db_connection()
+        rows = conn.execute(f'''
+            SELECT {key_col} AS period, ROUND(distance_km, 2) AS distance_km, ROUND(moving_time_min, 1) AS moving_time_min,
+                   ROUND(trimp, 1) AS trimp, runs, ROUND(long_run_km, 2) AS long_run_km FROM {table}
+            WHERE user_id = ? AND (? IS NULL OR {key_col} >= ?) AND (? IS NULL OR {key_col} <= ?)
+            ORDER BY {key_col}
+        ''', (str(user_id), since, since, until, until)).fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    except Exception as e:
+        logger.error(f"[DB_ERROR] Failed to get volume rollups: {e}")
+        return []
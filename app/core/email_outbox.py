@@ -0,0 +1,164 @@
+import os
+import time
+import atexit
+import smtplib
+import logging
+import threading
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from typing import Dict, Optional
+
+from app.core.config import get_config
+from app.core.database import claim_pending_emails, mark_email_sent, mark_email_failed
+from app.core.telemetry import telemetry
+
+logger = logging.getLogger("AI_COACH")
+emails_total = telemetry.counter("email_outbox_total", "Kết quả gửi email (sent/retry/failed)")
+smtp_send_seconds = telemetry.histogram("email_smtp_send_seconds", "Thời gian gửi 1 email qua SMTP (kể cả mở kết nối)")
+
+# Lỗi tạm thời (mạng, server bận, 4xx) -> thử lại; lỗi 5xx / sai mật khẩu / người nhận bị từ chối -> bỏ
+_TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, TimeoutError, OSError)
+
+class EmailOutbox:
+    """
+    Worker nền gửi email từ bảng email_outbox.
+    - Giữ 1 kết nối SMTP đã STARTTLS + login, dùng lại cho cả lô; tự đóng khi rảnh quá `idle_timeout`.
+    - Lỗi tạm thời được thử lại với backoff lũy thừa, tối đa `max_attempts` lần.
+    - Email nằm trong SQLite nên không mất khi restart; worker khởi động lại sẽ gửi tiếp.
+    """
+    def __init__(self, poll_interval: float = 30.0, idle_timeout: float = 60.0,
+                 batch_size: int = 20, max_attempts: int = 5):
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._smtp_key = None
+        self._last_used = 0.0
+
+    # ---------- Lifecycle ----------
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Báo worker có email mới (khởi động worker nếu chưa chạy)."""
+        self.start()
+        self._wake.set()
+
+    def shutdown(self, timeout: float = 10.0):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    # ---------- SMTP connection ----------
+    @staticmethod
+    def _settings() -> Dict:
+        email_cfg = get_config().settings.email_config
+        return {
+            "server": email_cfg.smtp_server,
+            "port": email_cfg.smtp_port,
+            "sender": os.getenv("EMAIL_SENDER"),
+            "password": os.getenv("EMAIL_PASSWORD"),
+        }
+
+    def _connection(self, settings: Dict) -> smtplib.SMTP:
+        key = (settings["server"], settings["port"], settings["sender"])
+        if self._smtp is not None and self._smtp_key == key:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except smtplib.SMTPException:
+                pass
+        self._close()
+        smtp = smtplib.SMTP(settings["server"], settings["port"], timeout=30)
+        smtp.starttls()
+        smtp.login(settings["sender"], settings["password"])
+        self._smtp, self._smtp_key = smtp, key
+        return smtp
+
+    def _close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+        self._smtp, self._smtp_key = None, None
+
+    # ---------- Worker ----------
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.drain()
+            except Exception as e:
+                logger.error(f"[EMAIL] Outbox worker error: {e}")
+                sent = 0
+            if sent:
+                continue  # Còn email thì gửi tiếp ngay
+            if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self._close()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+        self._close()
+
+    def drain(self) -> int:
+        """Gửi 1 lô email đến hạn. Trả về số email đã xử lý."""
+        emails = claim_pending_emails(limit=self.batch_size)
+        if not emails:
+            return 0
+        settings = self._settings()
+        for email in emails:
+            started = time.perf_counter()
+            try:
+                smtp = self._connection(settings)
+                msg = MIMEMultipart()
+                msg['From'] = settings["sender"]
+                msg['To'] = email["recipient"]
+                msg['Subject'] = email["subject"]
+                msg.attach(MIMEText(email["html_content"], 'html'))
+                smtp.send_message(msg)
+                self._last_used = time.monotonic()
+                smtp_send_seconds.observe(time.perf_counter() - started)
+                emails_total.inc(status="sent")
+                mark_email_sent(email["id"])
+                logger.info(f"[EMAIL] Sent report to {email['recipient']}")
+            except Exception as e:
+                self._handle_failure(email, e)
+        return len(emails)
+
+    def _handle_failure(self, email: Dict, error: Exception):
+        if isinstance(error, smtplib.SMTPResponseException):
+            transient = 400 <= error.smtp_code < 500
+        else:
+            # SMTPException kế thừa OSError -> chỉ coi là tạm thời nếu là lỗi kết nối
+            transient = isinstance(error, _TRANSIENT_ERRORS) and (
+                not isinstance(error, smtplib.SMTPException)
+                or isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError))
+            )
+        if transient:
+            self._close()  # Kết nối có thể đã hỏng, lần sau mở lại
+        if transient and email["attempts"] < self.max_attempts:
+            delay = min(3600, 30 * 2 ** (email["attempts"] - 1))
+            logger.warning(f"[EMAIL] Send failed (attempt {email['attempts']}), retry in {delay}s: {error}")
+            emails_total.inc(status="retry")
+            mark_email_failed(email["id"], str(error), retry_at=time.time() + delay)
+        else:
+            emails_total.inc(status="failed")
+            logger.error(f"[EMAIL] Failed to send email {email['id']}: {error}")
+            mark_email_failed(email["id"], str(error))
+
+# Singleton instance
+email_outbox = EmailOutbox()
+atexit.register(email_outbox.shutdown)
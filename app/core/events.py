@@ -0,0 +1,37 @@
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 📣 DATA EVENTS (Dùng để invalidate cache)
+# ==========================================
+ACTIVITY_SAVED = "activity_saved"        # payload: user_id, activity_id
+HARVEST_COMPLETED = "harvest_completed"  # payload: user_id (None = toàn hệ thống)
+MEMORY_WRITTEN = "memory_written"        # payload: user_id, doc_id
+MESSAGE_SAVED = "message_saved"          # payload: user_id
+
+class EventBus:
+    """Pub/Sub đồng bộ, in-process. Handler lỗi chỉ bị log, không làm hỏng luồng phát sự kiện."""
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Callable]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def subscribe(self, event: str, handler: Callable):
+        with self._lock:
+            self._subscribers[event].append(handler)
+
+    def publish(self, event: str, **payload):
+        with self._lock:
+            handlers = list(self._subscribers.get(event, []))
+        for handler in handlers:
+            try:
+                handler(**payload)
+            except Exception as e:
+                logger.error(f"[EVENTS] Handler for '{event}' failed: {e}")
+
+# Singleton instance
+event_bus = EventBus()
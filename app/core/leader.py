@@ -0,0 +1,75 @@
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from app.core.database import try_acquire_lease, release_lease, holds_lease
+
+logger = logging.getLogger("AI_COACH")
+
+class LeaderElector:
+    """
+    Bầu Leader dựa trên lease trong SQLite: trong nhiều uvicorn worker chỉ 1 worker giữ lease và chạy Scheduler.
+    Leader gia hạn lease mỗi `renew_interval` giây; nếu leader chết, lease hết hạn sau `ttl` giây
+    và worker khác sẽ tiếp quản (failover).
+    Callback (on_elected/on_demoted/on_tick) có I/O SQLite -> chạy trong thread, không chặn event loop
+    đang gia hạn lease.
+    """
+    def __init__(self, name: str = "scheduler", ttl: float = 30, renew_interval: float = 10):
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+        self._on_elected: Optional[Callable] = None
+        self._on_demoted: Optional[Callable] = None
+        self._on_tick: Optional[Callable] = None
+
+    async def _run(self):
+        while True:
+            try:
+                acquired = await asyncio.to_thread(try_acquire_lease, self.name, self.holder, self.ttl)
+                if acquired and not self.is_leader:
+                    self.is_leader = True
+                    logger.info(f"[LEADER] {self.holder} elected leader for '{self.name}'.")
+                    await asyncio.to_thread(self._on_elected)
+                elif not acquired and self.is_leader:
+                    self.is_leader = False
+                    logger.warning(f"[LEADER] {self.holder} lost lease '{self.name}'. Stepping down.")
+                    await asyncio.to_thread(self._on_demoted)
+                if self.is_leader and self._on_tick:
+                    await asyncio.to_thread(self._on_tick)
+            except Exception as e:
+                logger.error(f"[LEADER] Election loop error: {e}")
+            await asyncio.sleep(self.renew_interval)
+
+    def holds_lease(self) -> bool:
+        """Kiểm tra trực tiếp trong DB (không tin cờ is_leader có thể đã cũ nếu event loop bị treo)."""
+        return holds_lease(self.name, self.holder)
+
+    def start(self, on_elected: Callable, on_demoted: Callable, on_tick: Optional[Callable] = None):
+        """Gọi trong startup event (cần event loop đang chạy)."""
+        self._on_elected, self._on_demoted, self._on_tick = on_elected, on_demoted, on_tick
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.is_leader:
+            self.is_leader = False
+            await asyncio.to_thread(self._on_demoted)
+            # Nhả lease ngay để worker khác tiếp quản không cần chờ hết TTL
+            await asyncio.to_thread(release_lease, self.name, self.holder)
+
+# Singleton instance
+leader = LeaderElector(
+    ttl=float(os.getenv("LEADER_LEASE_TTL", "30")),
+    renew_interval=float(os.getenv("LEADER_RENEW_INTERVAL", "10")),
+)
@@ -1,31 +1,166 @@
+import re
+import time
+import asyncio
 import logging
+import threading
 from collections import deque
+from typing import Dict, List, NamedTuple, Optional
 
-# Bộ đệm lưu 50 dòng log cuối cùng để hiển thị lên Web Admin
-log_capture_string = deque(maxlen=50)
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
 
-class ListHandler(logging.Handler):
-    """Custom Handler để đẩy log vào deque"""
-    def emit(self, record):
+# Quy ước log của dự án: "[TAG] nội dung" -> tách TAG làm trường để lọc
+_TAG_RE = re.compile(r"^\[([A-Za-z0-9_\-]+)\]")
+# Các trường `extra=` được giữ lại trong bản ghi (nếu có)
+_EXTRA_KEYS = ("user_id", "activity_id", "job_id")
+
+def level_number(level: Optional[str]) -> int:
+    """'warning' -> 30; None -> 0. Level không hợp lệ -> ValueError."""
+    if not level:
+        return 0
+    value = logging.getLevelName(level.upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level: {level}")
+    return value
+
+class LogEntry(NamedTuple):
+    """Bản ghi gọn (tuple) trong ring buffer: không giữ LogRecord/traceback để tiết kiệm RAM."""
+    seq: int
+    created: float
+    levelno: int
+    logger: str
+    tag: Optional[str]
+    message: str
+    fields: Optional[Dict[str, str]]
+
+    def to_dict(self) -> Dict:
+        return {
+            "seq": self.seq,
+            "time": self.created,
+            "level": logging.getLevelName(self.levelno),
+            "logger": self.logger,
+            "tag": self.tag,
+            "message": self.message,
+            **({"fields": self.fields} if self.fields else {}),
+        }
+
+    def format(self) -> str:
+        ts = time.strftime(LOG_DATEFMT, time.localtime(self.created))
+        return f"{ts} [{logging.getLevelName(self.levelno)}] {self.message}"
+
+class LogRingBuffer(logging.Handler):
+    """
+    Handler gắn vào root logger, giữ `capacity` bản ghi gần nhất (level, logger, tag, message).
+    - query(): lọc theo level / logger / tag / chuỗi con / seq (dùng cho API tra cứu).
+    - subscribe(): hàng đợi asyncio nhận bản ghi mới (dùng cho SSE). Subscriber chậm bị bỏ bớt bản ghi,
+      không bao giờ chặn thread đang ghi log.
+    """
+    def __init__(self, capacity: int = 5000, level: int = logging.NOTSET):
+        super().__init__(level)
+        self._records: deque = deque(maxlen=capacity)
+        self._seq = 0
+        self._subscribers: List = []
+        self._sub_lock = threading.Lock()
+        self._interned: Dict[str, str] = {}
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def emit(self, record: logging.LogRecord):
         try:
-            msg = self.format(record)
-            log_capture_string.append(msg)
+            message = record.getMessage()
+            if record.exc_info and record.exc_info[0] is not None:
+                message = f"{message} ({record.exc_info[0].__name__}: {record.exc_info[1]})"
+            match = _TAG_RE.match(message)
+            fields = {k: str(getattr(record, k)) for k in _EXTRA_KEYS if hasattr(record, k)} or None
+            name = self._interned.setdefault(record.name, record.name)
+            with self.lock:
+                self._seq += 1
+                entry = LogEntry(self._seq, record.created, record.levelno, name,
+                                 match.group(1) if match else None, message, fields)
+                self._records.append(entry)
+            if self._subscribers:
+                self._publish(entry)
         except Exception:
             self.handleError(record)
 
+    def _publish(self, entry: LogEntry):
+        with self._sub_lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, entry)
+            except RuntimeError:
+                self.unsubscribe(queue)  # Event loop đã đóng
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, entry: LogEntry):
+        if queue.full():
+            return  # Client đọc chậm: bỏ bản ghi, client có thể bù bằng query(since_seq)
+        queue.put_nowait(entry)
+
+    def subscribe(self, maxsize: int = 1000) -> asyncio.Queue:
+        """Phải gọi từ trong event loop (endpoint async)."""
+        queue = asyncio.Queue(maxsize=maxsize)
+        with self._sub_lock:
+            self._subscribers.append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._sub_lock:
+            self._subscribers = [(l, q) for l, q in self._subscribers if q is not queue]
+
+    def query(self, level: Optional[str] = None, logger_name: Optional[str] = None,
+              tag: Optional[str] = None, contains: Optional[str] = None,
+              since_seq: int = 0, limit: int = 200) -> List[LogEntry]:
+        """Các bản ghi khớp bộ lọc, cũ -> mới, tối đa `limit` bản ghi mới nhất."""
+        min_level = level_number(level)
+        tag = tag.upper() if tag else None
+        needle = contains.lower() if contains else None
+        with self.lock:
+            snapshot = list(self._records)
+
+        result = []
+        for entry in reversed(snapshot):
+            if entry.seq <= since_seq or len(result) >= limit:
+                break
+            if entry.levelno < min_level:
+                continue
+            if logger_name and not entry.logger.startswith(logger_name):
+                continue
+            if tag and (entry.tag or "").upper() != tag:
+                continue
+            if needle and needle not in entry.message.lower():
+                continue
+            result.append(entry)
+        result.reverse()
+        return result
+
+    def tail(self, n: int = 50) -> List[str]:
+        """n dòng cuối dạng text (cho lần render đầu của trang Admin)."""
+        with self.lock:
+            entries = list(self._records)[-n:]
+        return [e.format() for e in entries]
+
+    def stats(self) -> Dict:
+        return {"capacity": self._records.maxlen, "size": len(self._records),
+                "last_seq": self._seq, "subscribers": len(self._subscribers)}
+
+# Singleton: bộ đệm log cho Web Admin
+log_buffer = LogRingBuffer()
+
 def setup_logging():
     """Khởi tạo logging cho toàn bộ ứng dụng"""
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
+        format=LOG_FORMAT,
+        datefmt=LOG_DATEFMT
     )
-    
-    logger = logging.getLogger("AI_COACH")
-    
-    # Thêm ListHandler để capture log cho Admin UI
-    list_handler = ListHandler()
-    list_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-    logger.addHandler(list_handler)
-    
-    return logger
\ No newline at end of file
+
+    # Gắn ring buffer vào root để bắt cả log của uvicorn/apscheduler/httpx
+    root = logging.getLogger()
+    if log_buffer not in root.handlers:
+        root.addHandler(log_buffer)
+
+    return logging.getLogger("AI_COACH")
@@ -1,48 +1,21 @@
 import os
 import logging
-import requests
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
 
+from app.core.telegram_delivery import telegram_delivery
+from app.core.email_outbox import email_outbox
+from app.core.database import enqueue_email
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 def send_telegram_msg(chat_id, text):
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
-        logger.error("[TELEGRAM] No token found in environment variables.")
-        return
-
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    
-    # Payload mặc định sử dụng Markdown
-    payload = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "Markdown" 
-    }
-    
-    try:
-        response = requests.post(url, json=payload)
-        
-        # [CƠ CHẾ FALLBACK] Nếu Telegram báo lỗi định dạng (HTTP 400 + parse entities)
-        if response.status_code == 400 and "parse entities" in response.text:
-            logger.warning("[TELEGRAM] Markdown parse failed. Cứu nét bằng văn bản thô (Plain Text)...")
-            # Xóa parse_mode đi và gửi lại
-            payload.pop("parse_mode") 
-            response = requests.post(url, json=payload)
-            
-        if response.status_code != 200:
-            logger.error(f"[TELEGRAM] Failed to send message: {response.text}")
-            
-    except Exception as e:
-        logger.error(f"[TELEGRAM] Connection error: {e}")
+    """Xếp hàng tin nhắn Telegram (cắt chunk, rate limit, retry ở telegram_delivery) và trả về ngay."""
+    telegram_delivery.enqueue(chat_id, text)
 
 def send_html_email(subject, html_content, config):
     """
-    Sends an HTML email report using SMTP configuration.
+    Xếp hàng email báo cáo HTML vào email_outbox; worker nền (app.core.email_outbox) gửi qua SMTP.
     """
     email_cfg = config.get("email_config", {})
     if not email_cfg.get("enabled"): return
@@ -55,21 +28,6 @@ def send_html_email(subject, html_content, config):
         logger.error("[EMAIL] Missing EMAIL_SENDER/PASSWORD/RECEIVER in .env")
         return
 
-    try:
-        smtp_server = email_cfg.get('smtp_server', 'smtp.gmail.com')
-        smtp_port = int(email_cfg.get('smtp_port', 587))
-
-        msg = MIMEMultipart()
-        msg['From'] = env_sender       
-        msg['To'] = env_receiver       
-        msg['Subject'] = subject
-        msg.attach(MIMEText(html_content, 'html'))
-
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(env_sender, env_password)
-        server.send_message(msg)
-        server.quit()
-        logger.info(f"[EMAIL] Sent report to {env_receiver}")
-    except Exception as e:
-        logger.error(f"[EMAIL] Failed to send email: {e}")
\ No newline at end of file
+    if enqueue_email(env_receiver, subject, html_content):
+        email_outbox.wake()
+        logger.info(f"[EMAIL] Queued report for {env_receiver}")
@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Dict, List
+
+logger = logging.getLogger("AI_COACH")
+
+# Stack dừng ở các hàm này = thread đang ngủ/chờ I/O, không tốn CPU (bỏ qua mặc định)
+_IDLE_LEAVES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+    ("queue.py", "get"), ("socket.py", "accept"), ("socket.py", "readinto"), ("ssl.py", "read"),
+    ("connection.py", "_recv"), ("connection.py", "poll"), ("base_events.py", "_run_once"),
+}
+
+def _is_idle(code) -> bool:
+    return (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES
+
+class ProfilerBusy(RuntimeError):
+    """Đã có 1 phiên profile đang chạy."""
+
+class SamplingProfiler:
+    """
+    Sampling profiler cho process đang chạy (không cần restart, không cần thư viện ngoài).
+    - Thread gọi profile() đọc sys._current_frames() mỗi `interval` giây, đếm các stack giống nhau.
+    - Kết quả: collapsed stacks (định dạng flamegraph.pl / speedscope) + bảng top hàm (self / total).
+    - Tùy chọn tracemalloc: snapshot trước/sau và diff theo dòng code.
+    Chi phí ~ số thread x độ sâu stack mỗi lần lấy mẫu; với interval 10ms gần như không ảnh hưởng app.
+    """
+    def __init__(self, max_depth: int = 64):
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_label(code) -> str:
+        filename = code.co_filename
+        # Rút gọn đường dẫn: "app/..." cho code của dự án, phần sau "site-packages/" cho thư viện
+        idx = filename.rfind(f"{os.sep}app{os.sep}")
+        if idx != -1:
+            filename = filename[idx + 1:]
+        else:
+            idx = filename.rfind(f"site-packages{os.sep}")
+            if idx != -1:
+                filename = filename[idx + len("site-packages") + 1:]
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+    def _sample(self, own_ident: int, stacks: Counter, thread_names: Dict[int, str], include_idle: bool):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or (not include_idle and _is_idle(frame.f_code)):
+                continue
+            codes = []
+            while frame is not None and len(codes) < self.max_depth:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()  # root -> leaf
+            stacks[(thread_names.get(ident) or f"thread-{ident}", tuple(codes))] += 1
+
+    def profile(self, seconds: float = 10.0, interval: float = 0.01, memory: bool = False,
+                top: int = 30, include_idle: bool = False) -> Dict:
+        """Chạy profile trong `seconds` giây (block caller). Trả về dict kết quả."""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("A profiling session is already running")
+        started_tracemalloc = False
+        try:
+            if memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(25)
+                    started_tracemalloc = True
+                mem_before = tracemalloc.take_snapshot()
+
+            own_ident = threading.get_ident()
+            stacks: Counter = Counter()
+            samples = 0
+            deadline = time.perf_counter() + seconds
+            next_tick = time.perf_counter()
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                # Tên thread đọc lại mỗi vòng (thread mới có thể xuất hiện trong lúc profile)
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+                self._sample(own_ident, stacks, thread_names, include_idle)
+                samples += 1
+                next_tick += interval
+                delay = next_tick - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_tick = time.perf_counter()  # Không đuổi kịp -> bỏ nhịp thay vì dồn mẫu
+
+            result = {
+                "seconds": seconds,
+                "interval_ms": round(interval * 1000, 3),
+                "samples": samples,
+                "include_idle": include_idle,
+                "collapsed": self._collapsed(stacks),
+                "top_functions": self._top_functions(stacks, top),
+                "threads": self._thread_totals(stacks),
+            }
+            if memory:
+                mem_after = tracemalloc.take_snapshot()
+                result["memory"] = self._memory_report(mem_before, mem_after, top)
+            return result
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+            self._lock.release()
+
+    def _collapsed(self, stacks: Counter) -> str:
+        """Mỗi dòng: `thread;frame1;frame2;... count` (root -> leaf)."""
+        label = self._frame_label
+        lines = []
+        for (thread, codes), count in stacks.most_common():
+            frames = ";".join(label(c).replace(";", ":") for c in codes)
+            lines.append(f"{thread};{frames} {count}" if frames else f"{thread} {count}")
+        return "\n".join(lines)
+
+    def _top_functions(self, stacks: Counter, top: int) -> List[Dict]:
+        """self = hàm đang chạy ở đỉnh stack; total = hàm có mặt trong stack (đếm 1 lần/stack)."""
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for (_, codes), count in stacks.items():
+            if not codes:
+                continue
+            self_counts[codes[-1]] += count
+            for code in set(codes):
+                total_counts[code] += count
+        all_samples = sum(stacks.values()) or 1  # % trên tổng stack đã ghi (không gồm thread rảnh)
+        ranked = sorted(total_counts, key=lambda c: (self_counts[c], total_counts[c]), reverse=True)[:top]
+        return [{
+            "function": self._frame_label(code),
+            "self": self_counts[code],
+            "total": total_counts[code],
+            "self_pct": round(self_counts[code] / all_samples * 100, 2),
+            "total_pct": round(total_counts[code] / all_samples * 100, 2),
+        } for code in ranked]
+
+    @staticmethod
+    def _thread_totals(stacks: Counter) -> Dict[str, int]:
+        totals: Counter = Counter()
+        for (thread, _), count in stacks.items():
+            totals[thread] += count
+        return dict(totals.most_common())
+
+    @staticmethod
+    def _memory_report(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, top: int) -> Dict:
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        before, after = before.filter_traces(filters), after.filter_traces(filters)
+        diff = after.compare_to(before, "lineno")
+        return {
+            "current_bytes": sum(s.size for s in after.statistics("filename")),
+            "top_growth": [{
+                "location": str(stat.traceback[0]),
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "size_kb": round(stat.size / 1024, 1),
+                "count_diff": stat.count_diff,
+            } for stat in diff[:top]],
+            "top_allocations": [{
+                "location": str(stat.traceback[0]),
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+            } for stat in after.statistics("lineno")[:top]],
+        }
+
+# Singleton instance
+profiler = SamplingProfiler()
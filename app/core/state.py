@@ -1,11 +1,61 @@
+import time
+import sqlite3
+import threading
+
+from app.core.database import DB_PATH, set_runtime_state
+
 class AppState:
+    """
+    Trạng thái runtime dùng chung giữa các uvicorn worker.
+    Giá trị gốc nằm trong bảng runtime_state (SQLite); mỗi process giữ bản cache và chỉ đọc lại
+    khi `PRAGMA data_version` báo có commit mới từ connection khác (tối đa 1 lần/giây).
+    """
     _instance = None
-    service_active = True
+    REFRESH_INTERVAL = 1.0
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(AppState, cls).__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._conn = None
+            cls._instance._data_version = None
+            cls._instance._checked_at = 0.0
+            cls._instance._cache = {}
         return cls._instance
 
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.REFRESH_INTERVAL:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                if self._conn is None:
+                    # Connection riêng để data_version thay đổi với MỌI commit (kể cả của chính process này)
+                    self._conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+                version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+                if version != self._data_version:
+                    self._cache = dict(self._conn.execute("SELECT key, value FROM runtime_state").fetchall())
+                    self._data_version = version
+            except sqlite3.Error:
+                pass  # DB chưa init: dùng giá trị cache/mặc định
+
+    def get(self, key: str, default: str = None) -> str:
+        self._refresh()
+        return self._cache.get(key, default)
+
+    def set(self, key: str, value: str):
+        set_runtime_state(key, value)
+        with self._lock:
+            self._cache[key] = str(value)
+
+    @property
+    def service_active(self) -> bool:
+        return self.get("service_active", "1") == "1"
+
+    @service_active.setter
+    def service_active(self, value: bool):
+        self.set("service_active", "1" if value else "0")
+
 # Singleton instance
-state = AppState()
\ No newline at end of file
+state = AppState()
@@ -0,0 +1,269 @@
+import os
+import re
+import time
+import atexit
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+from app.core.telemetry import telemetry
+
+logger = logging.getLogger("AI_COACH")
+delivery_seconds = telemetry.histogram("telegram_delivery_seconds", "Thời gian từ lúc xếp hàng tới khi Telegram nhận tin")
+
+TELEGRAM_MAX_CHARS = 4096
+CHUNK_CHARS = 4000  # Chừa khoảng trống cho phần đánh số "(1/3)"
+
+# ==========================================
+# ✂️ CHUNKING + MARKDOWN
+# ==========================================
+def split_message(text: str, limit: int = CHUNK_CHARS) -> List[str]:
+    """Cắt tin nhắn dài theo ranh giới đoạn văn, rồi tới dòng, cuối cùng mới cắt cứng."""
+    if len(text) <= limit:
+        return [text]
+    chunks, current = [], ""
+    for part in text.split("\n\n"):
+        candidate = f"{current}\n\n{part}" if current else part
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        # Đoạn văn đơn lẻ vẫn quá dài -> cắt theo dòng / cắt cứng
+        while len(part) > limit:
+            cut = part.rfind("\n", 0, limit)
+            cut = cut if cut > 0 else limit
+            chunks.append(part[:cut])
+            part = part[cut:].lstrip("\n")
+        current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+_CODE_RE = re.compile(r"```.*?```|`[^`\n]*`", re.DOTALL)
+
+def is_valid_markdown(text: str) -> bool:
+    """
+    Kiểm tra nhanh cú pháp Telegram Markdown (legacy): mọi `*`, `_`, `` ` `` phải đóng mở đủ cặp
+    và link [text](url) phải hoàn chỉnh. Sai thì gửi dạng Plain Text ngay từ đầu (không gửi 2 lần).
+    """
+    if text.count("```") % 2:
+        return False
+    stripped = _CODE_RE.sub("", text)
+    if "`" in stripped:
+        return False
+    if stripped.count("*") % 2 or stripped.count("_") % 2:
+        return False
+    return stripped.count("[") == len(re.findall(r"\[[^\]]*\]\([^)]*\)", stripped))
+
+# ==========================================
+# 🪣 TOKEN BUCKET
+# ==========================================
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Lấy 1 token; trả về số giây cần chờ (0 nếu lấy được ngay)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+# ==========================================
+# 📬 DELIVERY QUEUE
+# ==========================================
+class TelegramDelivery:
+    """
+    Hàng đợi gửi Telegram chạy trên event loop riêng (thread nền) với 1 httpx.AsyncClient dùng lại kết nối.
+    - Caller chỉ enqueue rồi trả về ngay (gọi được từ thread job, BackgroundTasks hay coroutine).
+    - Mỗi chat có hàng đợi FIFO riêng (giữ thứ tự các chunk), các chat khác nhau gửi song song.
+    - Rate limit: token bucket theo chat (~1 msg/s) + toàn cục (~30 msg/s), 429 thì chờ đúng retry_after.
+    """
+    def __init__(self, per_chat_rate: float = 1.0, global_rate: float = 30.0,
+                 max_concurrency: int = 8, max_attempts: int = 4):
+        self.per_chat_rate = per_chat_rate
+        self.global_rate = global_rate
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stats = defaultdict(int)
+
+    # ---------- Lifecycle ----------
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="telegram-delivery", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run_loop(self, ready: threading.Event):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(15.0, connect=5.0))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.run_until_complete(self._client.aclose())
+            self._loop.close()
+
+    def shutdown(self, timeout: float = 10.0):
+        """Chờ gửi nốt tin đang xếp hàng (tối đa `timeout` giây) rồi dừng loop."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        if not self._idle.wait(timeout):
+            logger.warning(f"[TELEGRAM] Shutdown with {self._pending} messages still queued.")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    # ---------- Public API ----------
+    def enqueue(self, chat_id, text: str, parse_mode: Optional[str] = "Markdown"):
+        """Xếp hàng tin nhắn (tự cắt chunk + kiểm tra Markdown). Không block caller."""
+        if not text:
+            return
+        chunks = split_message(text)
+        if len(chunks) > 1:
+            chunks = [f"{chunk}\n\n({i}/{len(chunks)})" for i, chunk in enumerate(chunks, 1)]
+        items = []
+        for chunk in chunks:
+            mode = parse_mode if parse_mode and is_valid_markdown(chunk) else None
+            if parse_mode and mode is None:
+                self._stats["plain_fallbacks"] += 1
+            items.append({"chat_id": str(chat_id), "text": chunk, "parse_mode": mode, "enqueued_at": time.monotonic()})
+
+        self._ensure_started()
+        with self._lock:
+            self._pending += len(items)
+            self._idle.clear()
+        self._loop.call_soon_threadsafe(self._dispatch, items)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "queued": self._pending, "active_chats": len(self._workers)}
+
+    # ---------- Event loop side ----------
+    def _dispatch(self, items: List[Dict]):
+        for item in items:
+            chat_id = item["chat_id"]
+            queue = self._queues.setdefault(chat_id, asyncio.Queue())
+            queue.put_nowait(item)
+            if chat_id not in self._workers:
+                self._workers[chat_id] = self._loop.create_task(self._drain_chat(chat_id, queue))
+
+    async def _drain_chat(self, chat_id: str, queue: asyncio.Queue):
+        bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.per_chat_rate, 1))
+        try:
+            while not queue.empty():
+                item = queue.get_nowait()
+                try:
+                    async with self._semaphore:
+                        await self._send(item, bucket)
+                except Exception as e:
+                    # 1 tin lỗi không được kéo theo cả hàng đợi của chat
+                    logger.error(f"[TELEGRAM] Unexpected error sending to chat {chat_id}: {e}")
+                    self._stats["failed"] += 1
+                finally:
+                    self._done()
+        finally:
+            self._workers.pop(chat_id, None)
+            self._queues.pop(chat_id, None)
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending <= 0:
+                self._pending = 0
+                self._idle.set()
+
+    async def _throttle(self, bucket: TokenBucket):
+        for b in (bucket, self._global_bucket):
+            wait = b.delay()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = b.delay()
+
+    async def _send(self, item: Dict, bucket: TokenBucket):
+        token = os.getenv("TELEGRAM_BOT_TOKEN")
+        if not token:
+            logger.error("[TELEGRAM] No token found in environment variables.")
+            self._stats["failed"] += 1
+            return
+        url = f"https://api.telegram.org/bot{token}/sendMessage"
+        payload = {"chat_id": item["chat_id"], "text": item["text"]}
+        if item["parse_mode"]:
+            payload["parse_mode"] = item["parse_mode"]
+
+        for attempt in range(1, self.max_attempts + 1):
+            await self._throttle(bucket)
+            try:
+                response = await self._client.post(url, json=payload)
+            except httpx.HTTPError as e:
+                logger.warning(f"[TELEGRAM] Connection error (attempt {attempt}): {e}")
+                self._stats["retries"] += 1
+                await asyncio.sleep(min(30, 2 ** attempt))
+                continue
+
+            if response.status_code == 200:
+                self._stats["sent"] += 1
+                delivery_seconds.observe(time.monotonic() - item["enqueued_at"])
+                return
+            if response.status_code == 429:
+                try:
+                    retry_after = float((response.json().get("parameters") or {}).get("retry_after", 5))
+                except (ValueError, TypeError, AttributeError):
+                    retry_after = 5.0  # Body không phải JSON (proxy/CDN trả HTML)
+                logger.warning(f"[TELEGRAM] 429 Too Many Requests, chat {item['chat_id']} retry after {retry_after}s")
+                self._stats["retries"] += 1
+                self._stats["rate_limited"] += 1
+                await asyncio.sleep(retry_after)
+                continue
+            # Kiểm tra trước vẫn có thể lọt (ví dụ entity lồng nhau) -> gửi lại dạng Plain Text
+            if response.status_code == 400 and "parse entities" in response.text and "parse_mode" in payload:
+                logger.warning("[TELEGRAM] Markdown parse failed. Gửi lại dạng Plain Text...")
+                payload.pop("parse_mode")
+                self._stats["plain_fallbacks"] += 1
+                continue
+            if response.status_code >= 500:
+                self._stats["retries"] += 1
+                await asyncio.sleep(min(30, 2 ** attempt))
+                continue
+            logger.error(f"[TELEGRAM] Failed to send message: {response.text}")
+            break
+
+        self._stats["failed"] += 1
+
+# Singleton instance (Thread gửi chỉ được khởi động ở tin nhắn đầu tiên)
+telegram_delivery = TelegramDelivery(
+    per_chat_rate=float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1")),
+    global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")),
+)
+# Script CLI (harvest, sync...) cũng phải gửi hết tin trước khi process thoát
+atexit.register(telegram_delivery.shutdown)
@@ -0,0 +1,303 @@
+import os
+import time
+import bisect
+import random
+import logging
+import functools
+import threading
+import contextvars
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("AI_COACH")
+
+# ==========================================
+# 📈 METRICS (Prometheus text format)
+# ==========================================
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _label_key(labels: Dict[str, Any]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _fmt_labels(key: Tuple, extra: Tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs)
+    return "{" + body + "}"
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, registry: "Telemetry", name: str, help_text: str):
+        self._registry = registry
+        self.name, self.help = name, help_text
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        if not self._registry.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in items]
+
+class Gauge:
+    """Gauge đặt giá trị trực tiếp, hoặc đọc qua callback lúc scrape (queue depth, collection size...)."""
+    def __init__(self, registry: "Telemetry", name: str, help_text: str,
+                 callback: Optional[Callable[[], Any]] = None):
+        self._registry = registry
+        self.name, self.help = name, help_text
+        self._values: Dict[Tuple, float] = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        if self._registry.enabled:
+            self._values[_label_key(labels)] = value
+
+    def render(self) -> List[str]:
+        values = dict(self._values)
+        if self._callback is not None:
+            try:
+                result = self._callback()
+                # Callback trả về số, hoặc dict {label_value: số} với nhãn `key`
+                if isinstance(result, dict):
+                    values.update({(("key", str(k)),): v for k, v in result.items()})
+                elif result is not None:
+                    values[()] = result
+            except Exception as e:
+                logger.error(f"[TELEMETRY] Gauge '{self.name}' callback failed: {e}")
+        return [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in values.items()]
+
+class Histogram:
+    def __init__(self, registry: "Telemetry", name: str, help_text: str, buckets: Tuple = DEFAULT_BUCKETS):
+        self._registry = registry
+        self.name, self.help = name, help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, List] = {}  # key -> [bucket_counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if not self._registry.enabled:
+            return
+        key = _label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(s)) for k, s in self._series.items()]
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, (('le', _fmt_value(float(bound))),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(key, (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(float(series[-2]))}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {series[-1]}")
+        return lines
+
+# ==========================================
+# 🔎 TRACING (span lồng nhau qua contextvars)
+# ==========================================
+MAX_SPANS_PER_TRACE = 500  # Trace dài (harvest nhiều user) chỉ giữ chi tiết 500 span đầu
+
+class Trace:
+    """1 lượt xử lý end-to-end. Hoàn tất khi không còn span mở và không còn tác vụ nền đang giữ trace."""
+    __slots__ = ("trace_id", "name", "started_at", "spans", "pending", "error")
+
+    def __init__(self, name: str):
+        self.trace_id = f"{random.getrandbits(64):016x}"
+        self.name = name
+        self.started_at = time.time()
+        self.spans: List[Dict] = []
+        self.pending = 0
+        self.error = False
+
+    def to_dict(self) -> Dict:
+        duration = max((s["offset_ms"] + s["duration_ms"] for s in self.spans), default=0.0)
+        return {"trace_id": self.trace_id, "name": self.name, "started_at": self.started_at,
+                "duration_ms": round(duration, 2), "error": self.error,
+                "spans": sorted(self.spans, key=lambda s: s["offset_ms"])}
+
+class Span:
+    __slots__ = ("telemetry", "trace", "name", "span_id", "parent_id", "attrs", "_start", "_token")
+
+    def __init__(self, telemetry: "Telemetry", name: str, attrs: Dict[str, Any]):
+        self.telemetry = telemetry
+        self.name = name
+        self.attrs = attrs
+        self.span_id = f"{random.getrandbits(32):08x}"
+        self.trace, self.parent_id = None, None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            self.trace, self.parent_id = parent.trace, parent.span_id
+        else:
+            self.trace = Trace(self.name)
+        self.telemetry._hold(self.trace)
+        self._token = _current_span.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        status = "error" if exc_type else "ok"
+        if exc_type:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+            self.trace.error = True
+        if len(self.trace.spans) < MAX_SPANS_PER_TRACE:
+            self.trace.spans.append({
+                "name": self.name, "span_id": self.span_id, "parent_id": self.parent_id,
+                "offset_ms": round((time.time() - elapsed - self.trace.started_at) * 1000, 2),
+                "duration_ms": round(elapsed * 1000, 2), "status": status, "attrs": self.attrs,
+            })
+        self.telemetry.span_seconds.observe(elapsed, span=self.name, status=status)
+        self.telemetry._release(self.trace)
+        return False
+
+class _NoopSpan:
+    """Dùng khi telemetry tắt: không cấp phát, không đo thời gian."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+_current_span: contextvars.ContextVar = contextvars.ContextVar("telemetry_span", default=None)
+
+class Telemetry:
+    """
+    Tracing + metrics trong process, không phụ thuộc thư viện ngoài.
+    - span(name): context manager/decorator; span con tự gắn vào trace của span cha (contextvars).
+    - bind(func): mang trace hiện tại sang BackgroundTasks/thread khác; trace chỉ "xong" khi tác vụ nền xong.
+    - Mỗi span ghi vào histogram `span_duration_seconds`; trace xong được giữ trong `recent_traces`.
+    - TELEMETRY_ENABLED=false -> span là no-op, metric bỏ qua ngay (1 phép so sánh bool).
+    """
+    def __init__(self, enabled: bool = True, max_traces: int = 100):
+        self.enabled = enabled
+        self._metrics: Dict[str, Any] = {}
+        self._traces: deque = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+        self.span_seconds = self.histogram("span_duration_seconds", "Thời gian xử lý theo span")
+
+    # ---------- Metrics ----------
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self._register(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str = "", callback: Optional[Callable[[], Any]] = None) -> Gauge:
+        return self._register(Gauge, name, help_text, callback)
+
+    def histogram(self, name: str, help_text: str = "", buckets: Tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help_text, buckets)
+
+    def render_prometheus(self) -> str:
+        kinds = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}
+        with self._lock:
+            metrics = list(self._metrics.values())
+        out = []
+        for metric in metrics:
+            lines = metric.render()
+            if not lines:
+                continue
+            if metric.help:
+                out.append(f"# HELP {metric.name} {metric.help}")
+            out.append(f"# TYPE {metric.name} {kinds[type(metric)]}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    # ---------- Tracing ----------
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, attrs)
+
+    def traced(self, name: Optional[str] = None):
+        """Decorator: bọc cả hàm trong 1 span."""
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Span(self, span_name, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def bind(self, func: Callable) -> Callable:
+        """Gắn trace hiện tại vào hàm chạy sau (BackgroundTasks, executor) để span con nối đúng trace."""
+        parent = _current_span.get() if self.enabled else None
+        if parent is None:
+            return func
+        trace = parent.trace
+        self._hold(trace)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span_token = _current_span.set(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current_span.reset(span_token)
+                self._release(trace)
+        return wrapper
+
+    def current_trace_id(self) -> Optional[str]:
+        span = _current_span.get()
+        return span.trace.trace_id if span is not None else None
+
+    def _hold(self, trace: Trace):
+        with self._lock:
+            trace.pending += 1
+
+    def _release(self, trace: Trace):
+        with self._lock:
+            trace.pending -= 1
+            if trace.pending == 0:
+                self._traces.append(trace)
+
+    def recent_traces(self, limit: int = 20, name: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            traces = list(self._traces)
+        if name:
+            traces = [t for t in traces if t.name == name]
+        return [t.to_dict() for t in reversed(traces[-limit:])]
+
+# Singleton instance
+telemetry = Telemetry(enabled=os.getenv("TELEMETRY_ENABLED", "true").lower() == "true")
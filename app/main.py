@@ -4,8 +4,12 @@ from fastapi import FastAPI
 # --- IMPORTS (Modular Structure) ---
 # Folders/Files are snake_case: app.core.database
 from app.core.database import init_db
-from app.routers import webhooks, admin, dashboard
-from app.services.scheduler import start_scheduler, scheduler
+from app.routers import webhooks, admin, dashboard, api, metrics
+from app.services.scheduler import init_scheduler, start_scheduler, pause_scheduler, sync_scheduler_config, scheduler
+from app.core.leader import leader
+from app.services.embedding_worker import embedding_client
+from app.core.telegram_delivery import telegram_delivery
+from app.core.email_outbox import email_outbox
 from app.core.logging_conf import setup_logging
 
 # 1. Setup Logging
@@ -29,6 +33,8 @@ app = FastAPI(
 app.include_router(webhooks.router)
 app.include_router(admin.router)
 app.include_router(dashboard.router) # Đăng ký router mới
+app.include_router(api.router)       # JSON API cho Dashboard (/api/v1)
+app.include_router(metrics.router)   # Prometheus (/metrics)
 
 # 5. Lifecycle Events
 @app.on_event("startup")
@@ -36,18 +42,30 @@ async def startup_event():
     """Executed once when the container starts."""
     logger.info("🚀 Personal AI OS is starting up...")
     
-    # Start background tasks
-    start_scheduler()
+    # Chỉ worker giữ lease (Leader) mới chạy Scheduler, tránh harvest/backup/briefing chạy trùng
+    init_scheduler()
+    leader.start(on_elected=start_scheduler, on_demoted=pause_scheduler, on_tick=sync_scheduler_config)
+
+    # Worker gửi email nền (gửi tiếp cả email còn tồn từ lần chạy trước)
+    email_outbox.start()
     
-    logger.info("✅ System Ready. Scheduler Active.")
+    logger.info("✅ System Ready. Leader election started.")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Executed when the container stops."""
     logger.info("🛑 Personal AI OS is shutting down...")
     
-    # Gracefully stop the scheduler
+    # Gracefully stop the scheduler (nhả lease cho worker khác tiếp quản)
+    await leader.stop()
     if scheduler.running:
         scheduler.shutdown()
+
+    # Dừng Embedding Worker process
+    embedding_client.shutdown()
+
+    # Gửi nốt các tin Telegram còn trong hàng đợi
+    telegram_delivery.shutdown()
+    email_outbox.shutdown()
         
     logger.info("✅ Scheduler Stopped. Goodbye!")
\ No newline at end of file
@@ -1,18 +1,31 @@
 import os
+import json
+import asyncio
 import secrets
 import logging
 from typing import Optional
 
-from fastapi import APIRouter, Request, Form, Depends, HTTPException, status
+from fastapi import APIRouter, Request, Form, Depends, HTTPException, Query, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse
 
-from app.core.config import load_config, save_config
+from pydantic import ValidationError
+
+from app.core.config import get_config, load_config, save_config
 from app.core.notification import send_html_email
-from app.core.logging_conf import log_capture_string 
+from app.core.logging_conf import log_buffer, level_number
 from app.core.state import state
-from app.services.scheduler import reload_scheduler
+from app.core.telemetry import telemetry
+from app.core.profiler import profiler, ProfilerBusy
+from app.core.database import rebuild_volume_rollups
+from app.services.scheduler import (
+    reload_scheduler, get_jobs_overview, submit_maintenance, task_recompute_trimp, task_relabel_sessions
+)
+from app.services.trimp_recompute import physiology_key
+from app.agents.coach.harvest import seed_primary_user
+from app.services.rag_memory import rag_db
+from app.agents.coach.tool_registry import tool_registry
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
@@ -47,13 +60,15 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)) ->
 @router.get("/admin", response_class=HTMLResponse)
 async def admin_dashboard(request: Request, username: str = Depends(verify_credentials)):
     """Hiển thị giao diện Admin Dashboard."""
-    logs_text = "\n".join(list(log_capture_string))
-    
+    logs_text = "\n".join(log_buffer.tail(50))
+
     return templates.TemplateResponse("admin.html", {
         "request": request,
-        "config": load_config(),
+        "config": get_config().data,
         "logs": logs_text,
-        "service_active": state.service_active
+        "logs_seq": log_buffer.last_seq,
+        "service_active": state.service_active,
+        "jobs": get_jobs_overview()
     })
 
 @router.post("/admin/save")
@@ -66,6 +81,7 @@ async def save_settings(
     output_format: str = Form(...),
     max_hr: int = Form(185),
     rest_hr: int = Form(55),
+    sex: str = Form("M"),
     race_date: Optional[str] = Form(None),
     current_goal: str = Form(""),
     briefing_time: str = Form("06:00"),
@@ -74,11 +90,13 @@ async def save_settings(
     harvest_minute: str = Form("15"),
     email_enabled: Optional[str] = Form(None),
     debug_mode: Optional[str] = Form(None),
+    prompt_raw_samples: Optional[str] = Form(None),
     model_name: str = Form("models/gemini-2.0-flash"),
     username: str = Depends(verify_credentials)
 ):
     """Xử lý form lưu cấu hình từ Admin UI."""
     config = load_config()
+    old_physiology = physiology_key(config)
     
     # 1. Cập nhật thông tin AI Persona
     config["system_instruction"] = system_instruction
@@ -90,11 +108,14 @@ async def save_settings(
     # 2. Cập nhật thông số Sinh lý học & Mục tiêu (Sports Science)
     config["max_hr"] = max_hr
     config["rest_hr"] = rest_hr
+    config["sex"] = sex
     config["race_date"] = race_date
     config["current_goal"] = current_goal
     
     # 3. Cập nhật Lịch trình (Scheduler)
+    # (giữ các khóa nâng cao không có trên form như harvest_window_minutes, harvest_concurrency)
     config["scheduler"] = {
+        **config.get("scheduler", {}),
         "briefing_time": briefing_time,
         "backup_time": backup_time,
         "harvest_hours": harvest_hours,
@@ -110,10 +131,22 @@ async def save_settings(
     
     # 5. Cập nhật System settings
     config["debug_mode"] = True if debug_mode == "on" else False
+    config["prompt_raw_samples"] = True if prompt_raw_samples == "on" else False
     config["model_name"] = model_name
     
-    save_config(config)
+    try:
+        save_config(config)  # Ghi nguyên tử + nạp lại snapshot ngay
+    except ValidationError as e:
+        logger.error(f"[ADMIN] Rejected invalid configuration: {e}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cấu hình không hợp lệ: {e}")
     reload_scheduler()
+
+    # HR/giới tính đổi -> TRIMP đã lưu (và ACWR) không còn khớp: tính lại toàn bộ lịch sử ở nền
+    if physiology_key(config) != old_physiology and os.getenv("TELEGRAM_CHAT_ID"):
+        seed_primary_user(config)
+        submit_maintenance("trimp_recompute", task_recompute_trimp, [os.getenv("TELEGRAM_CHAT_ID")])
+        submit_maintenance("session_relabel", task_relabel_sessions, [os.getenv("TELEGRAM_CHAT_ID")])  # Nhãn Tempo theo %HRR
+        logger.info(f"[ADMIN] Physiology changed {old_physiology} -> {physiology_key(config)}, TRIMP recompute queued.")
     
     logger.info(f"[ADMIN] Auth User '{username}' saved configuration.")
     return RedirectResponse(url="/admin", status_code=303)
@@ -127,6 +160,27 @@ async def catch_accidental_get_save(username: str = Depends(verify_credentials))
     logger.info(f"[ADMIN] Bắt được request GET đi lạc vào /admin/save từ user '{username}'. Đang đưa về trang chủ...")
     return RedirectResponse(url="/admin", status_code=303)
 
+@router.post("/admin/recompute-trimp")
+async def recompute_trimp_route(user_id: Optional[str] = None, username: str = Depends(verify_credentials)):
+    """Tính lại TRIMP toàn bộ lịch sử (1 VĐV hoặc mọi VĐV active) ở nền."""
+    queued = submit_maintenance("trimp_recompute", task_recompute_trimp, [user_id] if user_id else None)
+    logger.info(f"[ADMIN] User '{username}' queued TRIMP recompute ({user_id or 'all users'})")
+    return {"status": "queued" if queued else "merged", "user_id": user_id}
+
+@router.post("/admin/relabel-sessions")
+async def relabel_sessions_route(user_id: Optional[str] = None, username: str = Depends(verify_credentials)):
+    """Chạy lại segmentation/nhãn buổi tập cho toàn bộ lịch sử (1 VĐV hoặc mọi VĐV active) ở nền."""
+    queued = submit_maintenance("session_relabel", task_relabel_sessions, [user_id] if user_id else None)
+    logger.info(f"[ADMIN] User '{username}' queued session relabel ({user_id or 'all users'})")
+    return {"status": "queued" if queued else "merged", "user_id": user_id}
+
+@router.post("/admin/rebuild-rollups")
+def rebuild_rollups_route(user_id: Optional[str] = None, username: str = Depends(verify_credentials)):
+    """Dựng lại bảng volume tuần/tháng từ run_activities (1 câu SQL mỗi bảng, chạy ngay trên threadpool)."""
+    rows = rebuild_volume_rollups(user_id)
+    logger.info(f"[ADMIN] User '{username}' rebuilt volume rollups ({user_id or 'all users'}): {rows} rows")
+    return {"status": "ok", "user_id": user_id, "rows": rows}
+
 @router.get("/admin/test-email")
 async def test_email_route(username: str = Depends(verify_credentials)):
     """Gửi email test để kiểm tra kết nối SMTP."""
@@ -148,4 +202,114 @@ async def toggle_service(username: str = Depends(verify_credentials)):
     state.service_active = not state.service_active
     status = "RESUMED" if state.service_active else "PAUSED"
     logger.info(f"[ADMIN] User '{username}' triggered Service {status}")
-    return RedirectResponse(url="/admin", status_code=303)
\ No newline at end of file
+    return RedirectResponse(url="/admin", status_code=303)
+
+@router.get("/admin/traces")
+async def recent_traces(limit: int = Query(20, ge=1, le=100), name: Optional[str] = None,
+                        username: str = Depends(verify_credentials)):
+    """Các trace gần nhất (mới nhất trước), mỗi trace kèm danh sách span + thời gian."""
+    return {"enabled": telemetry.enabled, "traces": telemetry.recent_traces(limit, name)}
+
+@router.get("/admin/cache-stats")
+async def cache_stats(username: str = Depends(verify_credentials)):
+    """Thống kê hit/miss/latency của các tầng cache (JSON)."""
+    return {"rag_recall": rag_db.cache.stats(), "agent_tools": tool_registry.stats()}
+
+# ==========================================
+# 📜 LOGS (ring buffer + SSE)
+# ==========================================
+@router.get("/admin/logs")
+async def query_logs(
+    level: Optional[str] = None,
+    logger_name: Optional[str] = Query(None, alias="logger"),
+    tag: Optional[str] = None,
+    q: Optional[str] = None,
+    since_seq: int = 0,
+    limit: int = Query(200, ge=1, le=5000),
+    username: str = Depends(verify_credentials)
+):
+    """Tra cứu log trong bộ đệm: lọc theo level tối thiểu, logger (prefix), tag [XXX], chuỗi con."""
+    try:
+        entries = log_buffer.query(level, logger_name, tag, q, since_seq, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"last_seq": log_buffer.last_seq, "buffer": log_buffer.stats(),
+            "records": [e.to_dict() for e in entries]}
+
+@router.get("/admin/logs/stream")
+async def stream_logs(
+    request: Request,
+    level: Optional[str] = None,
+    tag: Optional[str] = None,
+    since_seq: Optional[int] = None,
+    username: str = Depends(verify_credentials)
+):
+    """
+    Server-Sent Events: đẩy log mới theo thời gian thực. Khi reconnect, trình duyệt gửi Last-Event-ID
+    -> gửi bù các bản ghi bị lỡ từ bộ đệm trước khi stream tiếp.
+    """
+    try:
+        min_level = level_number(level)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    tag = tag.upper() if tag else None
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since_seq = int(last_event_id)
+
+    def _wanted(entry) -> bool:
+        return entry.levelno >= min_level and (not tag or (entry.tag or "").upper() == tag)
+
+    def _event(entry) -> str:
+        return f"id: {entry.seq}\ndata: {json.dumps(entry.to_dict(), ensure_ascii=False)}\n\n"
+
+    async def event_source():
+        queue = log_buffer.subscribe()
+        try:
+            last_seq = 0
+            if since_seq is not None:
+                for entry in log_buffer.query(level, None, tag, None, since_seq, limit=5000):
+                    last_seq = entry.seq
+                    yield _event(entry)
+            while not await request.is_disconnected():
+                try:
+                    entry = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"  # Giữ kết nối qua proxy
+                    continue
+                if entry.seq > last_seq and _wanted(entry):
+                    yield _event(entry)
+        finally:
+            log_buffer.unsubscribe(queue)
+
+    return StreamingResponse(event_source(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ==========================================
+# 🔥 PROFILER (lấy mẫu process đang chạy)
+# ==========================================
+@router.get("/admin/profile")
+async def profile_process(
+    seconds: float = Query(10, ge=0.5, le=120),
+    interval_ms: float = Query(10, ge=1, le=200),
+    memory: bool = False,
+    include_idle: bool = False,
+    top: int = Query(30, ge=1, le=200),
+    format: str = Query("json", pattern="^(json|collapsed)$"),
+    username: str = Depends(verify_credentials)
+):
+    """
+    Sampling profiler trong `seconds` giây: format=collapsed trả file collapsed stack (flamegraph.pl / speedscope),
+    format=json trả thêm bảng top hàm và (memory=true) diff tracemalloc.
+    Mặc định bỏ qua thread đang chờ (wait/select...), include_idle=true để giữ lại. Mỗi lúc chỉ 1 phiên.
+    """
+    logger.info(f"[ADMIN] User '{username}' started profiling for {seconds}s (memory={memory})")
+    try:
+        # Chạy trong thread riêng: event loop vẫn phục vụ request (và cũng được lấy mẫu)
+        result = await asyncio.to_thread(profiler.profile, seconds, interval_ms / 1000, memory, top, include_idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if format == "collapsed":
+        return PlainTextResponse(result["collapsed"] + "\n", headers={
+            "Content-Disposition": f'attachment; filename="profile-{int(seconds)}s.collapsed"'})
+    return result
@@ -0,0 +1,181 @@
+from fastapi import APIRouter, Request, Response, Query, HTTPException, Depends
+from datetime import date, datetime, timedelta
+from typing import Optional, Tuple
+import hashlib
+import logging
+
+from app.core.config import get_config, periodization, TZ_VN
+from app.core.database import (
+    get_data_version, get_activities, get_daily_training, get_training_loads, get_user, get_mean_max_bests,
+    get_race_predictions, get_latest_race_prediction, get_volume_rollups
+)
+from app.agents.coach.utils import calculate_acwr, calculate_fitness_fatigue, fill_daily_series
+from app.agents.coach.mean_max import format_pace
+from app.agents.coach.race_predictor import format_race_time
+from app.routers.admin import verify_credentials
+
+# JSON API cho Dashboard (thin client). Mọi response có weak ETag theo phiên bản dữ liệu của user:
+# lần tải lại không có gì mới chỉ tốn 1 câu SELECT version rồi trả 304.
+# Dữ liệu cá nhân của mọi VĐV -> toàn bộ router yêu cầu đăng nhập admin (HTTP Basic, dùng chung với /dashboard).
+router = APIRouter(prefix="/api/v1", tags=["dashboard-api"], dependencies=[Depends(verify_credentials)])
+logger = logging.getLogger("AI_COACH")
+
+MAX_RANGE_DAYS = 730
+WARMUP_DAYS = 120  # Lịch sử thêm để ACWR/CTL ở đầu khoảng đã hội tụ
+
+def _etag(request: Request, user_id: str) -> Tuple[Optional[str], bool]:
+    """
+    Weak ETag = phiên bản dữ liệu user + mtime config + ngày hiện tại (ACWR "hôm nay" đổi theo ngày)
+    + endpoint/tham số. Trả về (etag, not_modified).
+    """
+    version = get_data_version(user_id)
+    if version is None:
+        return None, False
+    parts = f"{version}:{get_config().mtime_ns}:{datetime.now(TZ_VN).date()}:{request.url.path}?{request.url.query}"
+    etag = f'W/"{hashlib.sha1(parts.encode()).hexdigest()[:20]}"'
+    candidates = [t.strip() for t in request.headers.get("if-none-match", "").split(",")]
+    return etag, etag in candidates or "*" in candidates
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+def _cache_headers(response: Response, etag: Optional[str]):
+    if etag:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"  # Luôn hỏi lại server, nhưng chỉ tốn 304
+
+def _parse_range(start: Optional[str], end: Optional[str], default_days: int) -> Tuple[date, date]:
+    try:
+        end_d = date.fromisoformat(end) if end else datetime.now(TZ_VN).date()
+        start_d = date.fromisoformat(start) if start else end_d - timedelta(days=default_days - 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end phải có dạng YYYY-MM-DD")
+    if start_d > end_d or (end_d - start_d).days > MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Khoảng thời gian không hợp lệ (tối đa {MAX_RANGE_DAYS} ngày)")
+    return start_d, end_d
+
+def _bucket(day: str, resolution: str) -> str:
+    if resolution == "week":
+        d = date.fromisoformat(day)
+        return (d - timedelta(days=d.weekday())).isoformat()
+    if resolution == "month":
+        return day[:7]
+    return day
+
+@router.get("/users/{user_id}/activities")
+def list_activities(request: Request, response: Response, user_id: str,
+                    start: Optional[str] = None, end: Optional[str] = None,
+                    limit: int = Query(20, ge=1, le=500)):
+    """Danh sách bài chạy (mới nhất trước) trong khoảng [start, end]."""
+    etag, fresh = _etag(request, user_id)
+    if fresh:
+        return _not_modified(etag)
+    if start or end:
+        _parse_range(start, end, MAX_RANGE_DAYS)
+    _cache_headers(response, etag)
+    return {"user_id": user_id, "activities": get_activities(user_id, start, end, limit)}
+
+@router.get("/users/{user_id}/load")
+def load_series(request: Request, response: Response, user_id: str,
+                start: Optional[str] = None, end: Optional[str] = None,
+                resolution: str = Query("day", pattern="^(day|week|month)$")):
+    """
+    Chuỗi tải trọng: TRIMP + km (tổng theo bucket), ACWR / CTL / ATL / TSB (giá trị cuối bucket).
+    """
+    etag, fresh = _etag(request, user_id)
+    if fresh:
+        return _not_modified(etag)
+    start_d, end_d = _parse_range(start, end, 90)
+
+    warm_start = start_d - timedelta(days=WARMUP_DAYS)
+    rows = get_daily_training(user_id, warm_start.isoformat(), end_d.isoformat())
+    series = fill_daily_series(rows, warm_start, end_d)
+    trimps = [d["trimp"] for d in series]
+    ff = calculate_fitness_fatigue(trimps)
+
+    points = {}
+    for i, d in enumerate(series):
+        if d["day"] < start_d.isoformat():
+            continue
+        acwr = calculate_acwr(sum(trimps[max(0, i - 6): i + 1]), sum(trimps[max(0, i - 27): i + 1]))
+        key = _bucket(d["day"], resolution)
+        point = points.setdefault(key, {"period": key, "trimp": 0.0, "km": 0.0})
+        point["trimp"] += d["trimp"]
+        point["km"] += d["km"]
+        point.update(acwr=acwr["acwr"], ctl=ff[i]["ctl"], atl=ff[i]["atl"], tsb=ff[i]["tsb"])
+
+    for p in points.values():
+        for k in ("trimp", "km", "ctl", "atl", "tsb"):
+            p[k] = round(p[k], 2)
+    _cache_headers(response, etag)
+    return {"user_id": user_id, "resolution": resolution, "start": start_d.isoformat(),
+            "end": end_d.isoformat(), "series": list(points.values())}
+
+@router.get("/users/{user_id}/mean-max")
+def mean_max(request: Request, response: Response, user_id: str,
+             days: int = Query(90, ge=1, le=3650)):
+    """Curve pace tốt nhất theo thời lượng trong `days` ngày gần đây + kỷ lục mọi thời điểm (envelope)."""
+    etag, fresh = _etag(request, user_id)
+    if fresh:
+        return _not_modified(etag)
+    since = (datetime.now(TZ_VN).date() - timedelta(days=days)).isoformat()
+
+    def points(rows):
+        return [{**r, "pace": format_pace(r["speed_mps"])} for r in rows]
+
+    _cache_headers(response, etag)
+    return {"user_id": user_id, "days": days, "since": since,
+            "recent": points(get_mean_max_bests(user_id, since)), "all_time": points(get_mean_max_bests(user_id))}
+
+@router.get("/users/{user_id}/race-predictions")
+def race_predictions(request: Request, response: Response, user_id: str,
+                     days: int = Query(180, ge=1, le=MAX_RANGE_DAYS)):
+    """Chuỗi dự đoán thành tích theo ngày (thời gian dự đoán, dải 80%, GCS) cho biểu đồ xu hướng."""
+    etag, fresh = _etag(request, user_id)
+    if fresh:
+        return _not_modified(etag)
+    since = (datetime.now(TZ_VN).date() - timedelta(days=days)).isoformat()
+    series = [{**r, "predicted": format_race_time(r["predicted_s"])} for r in get_race_predictions(user_id, since)]
+    _cache_headers(response, etag)
+    return {"user_id": user_id, "days": days, "since": since, "series": series}
+
+@router.get("/users/{user_id}/volume")
+def volume(request: Request, response: Response, user_id: str,
+           period: str = Query("week", pattern="^(week|month)$"),
+           since: Optional[str] = None, until: Optional[str] = None):
+    """Volume theo tuần ISO (key = ngày thứ 2, YYYY-MM-DD) hoặc theo tháng (YYYY-MM) từ bảng rollup."""
+    etag, fresh = _etag(request, user_id)
+    if fresh:
+        return _not_modified(etag)
+    _cache_headers(response, etag)
+    return {"user_id": user_id, "period": period, "rows": get_volume_rollups(user_id, period, since, until)}
+
+@router.get("/users/{user_id}/summary")
+def summary(request: Request, response: Response, user_id: str):
+    """Chỉ số tổng quan cho các thẻ trên Dashboard."""
+    etag, fresh = _etag(request, user_id)
+    if fresh:
+        return _not_modified(etag)
+    snapshot = get_config()
+    profile = get_user(user_id) or {}
+    loads = get_training_loads(user_id)
+    acwr = calculate_acwr(loads['acute_load_7d'], loads['chronic_load_28d'])
+    race_date = profile.get("race_date") or snapshot.data.get("race_date")
+    current_goal = profile.get("current_goal") or snapshot.data.get("current_goal")
+    period = periodization(race_date, current_goal, datetime.now(TZ_VN).date())
+    prediction = get_latest_race_prediction(user_id)
+    latest_gcs = prediction["gcs"] if prediction and prediction["gcs"] is not None else \
+        next((a["gcs_score"] for a in get_activities(user_id, limit=20) if a["gcs_score"] is not None), None)
+
+    _cache_headers(response, etag)
+    return {
+        "user_id": user_id,
+        "name": profile.get("name"),
+        "current_goal": current_goal,
+        "race_date": race_date,
+        "days_to_race": period.days_to_race,
+        "phase": period.phase,
+        "loads": loads,
+        "acwr": acwr,
+        "latest_gcs": latest_gcs,
+    }
@@ -0,0 +1,29 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+import logging
+
+from app.core.telemetry import telemetry
+from app.core.telegram_delivery import telegram_delivery
+from app.core.database import count_emails_by_status
+from app.services.embedding_worker import embedding_client
+from app.services.rag_memory import rag_db
+
+# Endpoint cho Prometheus scrape. Gauge được đọc lúc scrape (không tốn gì giữa 2 lần scrape).
+router = APIRouter(tags=["metrics"])
+logger = logging.getLogger("AI_COACH")
+
+def _telegram_stats():
+    stats = telegram_delivery.stats()
+    return {k: stats.get(k, 0) for k in ("queued", "active_chats", "sent", "failed", "retries", "rate_limited", "plain_fallbacks")}
+
+telemetry.gauge("telegram_delivery_state", "Hàng đợi + bộ đếm của TelegramDelivery (key=queued/sent/...)", _telegram_stats)
+telemetry.gauge("email_outbox_emails", "Số email trong outbox theo trạng thái (key=status)", count_emails_by_status)
+telemetry.gauge("embedding_pending_requests", "Yêu cầu nhúng đang chờ worker", lambda: embedding_client.stats()["pending"])
+telemetry.gauge("chroma_collection_documents", "Số document trong collection ChromaDB", lambda: rag_db.collection.count())
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text exposition format 0.0.4."""
+    if not telemetry.enabled:
+        return PlainTextResponse("# telemetry disabled\n", media_type="text/plain; version=0.0.4")
+    return PlainTextResponse(telemetry.render_prometheus(), media_type="text/plain; version=0.0.4")
@@ -2,40 +2,70 @@ from fastapi import APIRouter, Request, BackgroundTasks
 import os
 import logging
 
-from app.core.config import load_config
+from app.core.config import get_config
 from app.core.notification import send_telegram_msg, send_html_email
 from app.agents.coach.agent import analyze_run_with_gemini, handle_telegram_chat
-from app.agents.coach.strava_client import StravaClient
 
 # Bổ sung hàm execute_manual_sync vào import
-from app.agents.coach.harvest import harvest_data, execute_manual_sync
+from app.agents.coach.harvest import (
+    harvest_data, execute_manual_sync, get_strava_client, apply_stream_analytics, apply_segmentation, fetch_streams
+)
+from app.core.database import get_user, get_user_by_athlete_id
 from app.core.state import state
+from app.core.telemetry import telemetry
 
 router = APIRouter()
 logger = logging.getLogger("AI_COACH")
 
 # --- STRAVA WORKFLOW ---
-def run_strava_workflow(activity_id: str):
+@telemetry.traced("run_strava_workflow")
+def run_strava_workflow(activity_id: str, owner_id: str = None):
     if not state.service_active: 
         logger.info(f"[WEBHOOK] Service is PAUSED. Ignoring Activity {activity_id}.")
         return
         
-    config = load_config()
-    client = StravaClient()
+    config = get_config().data
+    # owner_id (Strava athlete) -> VĐV trong bảng users; Tenant chính (.env) khớp qua STRAVA_ATHLETE_ID
+    # hoặc athlete id đã lưu khi refresh token. Tenant chính chưa biết athlete id (bản single-tenant mặc định)
+    # -> vẫn nhận; owner lạ còn lại bị bỏ qua: không bao giờ dùng token/chat của người khác để xử lý.
+    primary_id = os.getenv("TELEGRAM_CHAT_ID")
+    user = get_user_by_athlete_id(owner_id) if owner_id else None
+    if not user:
+        primary = (get_user(primary_id) if primary_id else None) or {"user_id": primary_id}
+        if (not owner_id or str(owner_id) == os.getenv("STRAVA_ATHLETE_ID")
+                or not primary.get("strava_athlete_id")):
+            user = primary
+    if not user or not user.get("user_id"):
+        logger.warning(f"[WEBHOOK] Unknown Strava owner {owner_id}. Ignoring Activity {activity_id}.")
+        return
+    chat_id = user["user_id"]
+    client = get_strava_client(user)
     
     logger.info(f"[*] Fetching data for Activity {activity_id}...")
     try:
-        act_name, csv_data, meta_data = client.get_activity_data(activity_id)
+        with telemetry.span("strava.get_activity_data", activity_id=str(activity_id)):
+            act_name, csv_data, meta_data = client.get_activity_data(activity_id)
     except ValueError:
         return
     
     if not csv_data: return
+    # Stream đã nằm trong cache sau get_activity_data -> chỉ tốn phần tính numpy (lưu lại cho harvest/sync)
+    meta_data["stream_metrics"] = apply_stream_analytics(client, chat_id, activity_id)
+    # Nhãn buổi tập tính + lưu ngay với lap của Activity Detail vừa tải -> prompt và nhãn trong DB là 1 kết quả
+    max_hr = int(user.get("max_hr") or config.get("max_hr", 185))
+    rest_hr = int(user.get("rest_hr") or config.get("rest_hr", 55))
+    meta_data["structure"] = apply_segmentation(
+        client, chat_id, {"activity_id": str(activity_id), "start_date": meta_data.get("start_date_local")},
+        max_hr, rest_hr, laps=meta_data.get("laps") or [])
 
     logger.info("[*] Sending Data to Gemini...")
-    analysis_text = analyze_run_with_gemini(activity_id, act_name, csv_data, meta_data, config)
+    with telemetry.span("agent.analyze_run"):
+        analysis_text = analyze_run_with_gemini(activity_id, act_name, csv_data, meta_data, config, user_id=chat_id,
+                                                streams=fetch_streams(client, chat_id, activity_id))
     
     if analysis_text:
-        client.update_activity_description(activity_id, analysis_text)
+        with telemetry.span("strava.update_description"):
+            client.update_activity_description(activity_id, analysis_text)
         
         email_body = f"""
         <h2>🏃‍♂️ Run Analysis: {act_name}</h2>
@@ -43,16 +73,19 @@ def run_strava_workflow(activity_id: str):
         <hr>
         <pre style="white-space: pre-wrap; font-family: sans-serif;">{analysis_text}</pre>
         """
-        send_html_email(f"Coach Dyno Report: {act_name}", email_body, config)
+        # EMAIL_RECEIVER trong .env là hộp thư của Tenant chính -> VĐV khác chỉ nhận Telegram
+        if chat_id == primary_id:
+            with telemetry.span("notify.email"):
+                send_html_email(f"Coach Dyno Report: {act_name}", email_body, config)
 
-        chat_id = os.getenv("TELEGRAM_CHAT_ID")
         if chat_id:
             telegram_msg = (
                 f"🏃‍♂️ **Phân tích bài chạy mới:** {act_name}\n\n"
                 f"{analysis_text}\n\n"
                 f"🔗 [Xem trên Strava](https://www.strava.com/activities/{activity_id})"
             )
-            send_telegram_msg(chat_id, telegram_msg)
+            with telemetry.span("notify.telegram"):
+                send_telegram_msg(chat_id, telegram_msg)
             logger.info(f"[*] Sent Telegram notification for Activity {activity_id}")
         
 @router.post("/webhook")
@@ -60,7 +93,9 @@ async def strava_event(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
     if data.get("object_type") == "activity" and data.get("aspect_type") == "create":
         activity_id = data.get("object_id")
-        background_tasks.add_task(run_strava_workflow, activity_id)
+        # Trace bắt đầu từ webhook, tiếp tục trong background task
+        with telemetry.span("strava_event", activity_id=str(activity_id)):
+            background_tasks.add_task(telemetry.bind(run_strava_workflow), activity_id, data.get("owner_id"))
     return {"status": "ok"}
 
 @router.get("/webhook")
@@ -94,6 +129,6 @@ async def telegram_event(request: Request, background_tasks: BackgroundTasks):
             background_tasks.add_task(execute_manual_sync, str(chat_id), limit, days_back)
             return {"status": "ok"}
 
-        config = load_config()
+        config = get_config().data
         background_tasks.add_task(handle_telegram_chat, str(chat_id), text, config)
     return {"status": "ok"}
\ No newline at end of file
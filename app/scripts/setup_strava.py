@@ -1,3 +1,4 @@
+import sys
 import requests
 import webbrowser
 
@@ -31,6 +32,15 @@ def get_tokens():
         res.raise_for_status()
         data = res.json()
         
+        # python -m app.scripts.setup_strava <telegram_chat_id>: lưu thẳng token của VĐV vào bảng users
+        if len(sys.argv) > 1:
+            from app.core.database import init_db, save_strava_credentials
+            init_db()
+            save_strava_credentials(sys.argv[1], data.get('athlete', {}).get('id'), data['refresh_token'],
+                                    data.get('access_token'), data.get('expires_at', 0))
+            print(f"THÀNH CÔNG! Đã kết nối Strava cho user {sys.argv[1]}.")
+            return
+
         print("-" * 60)
         print("THÀNH CÔNG! HÃY COPY DÒNG DƯỚI VÀO FILE .env CỦA BẠN:")
         print(f"STRAVA_REFRESH_TOKEN={data['refresh_token']}")
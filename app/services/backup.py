@@ -1,37 +1,257 @@
 import os
-import shutil
+import sys
+import json
+import zlib
+import sqlite3
+import hashlib
 import logging
+import tempfile
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 logger = logging.getLogger("AI_COACH")
 
+CHUNK_SIZE = 1024 * 1024          # 1 MiB: khớp bội số page SQLite nên page không đổi -> chunk không đổi
+SQLITE_MAGIC = b"SQLite format 3\x00"
+SKIP_SUFFIXES = ("-journal", "-wal", "-shm")  # Đã nằm trong bản snapshot của backup API
+
+class BackupEngine:
+    """
+    Backup tăng dần (incremental) cho thư mục data/.
+    - SQLite (os_core.db, chroma.sqlite3...) được chụp nhất quán qua sqlite3.Connection.backup.
+    - File được cắt thành chunk, nén zlib và lưu theo SHA-256 (content-addressed):
+      chunk không đổi giữa các snapshot chỉ lưu 1 lần duy nhất.
+    - File có size + mtime giống snapshot trước được tái sử dụng mà không cần đọc lại.
+
+    Cấu trúc kho:  backups/repo/chunks/ab/<sha256>   +   backups/repo/snapshots/<id>.json
+    """
+    def __init__(self, source_dir: str = "data", repo_dir: str = "backups/repo",
+                 keep: int = 7, chunk_size: int = CHUNK_SIZE):
+        self.source_dir = source_dir
+        self.repo_dir = repo_dir
+        self.keep = keep
+        self.chunk_size = chunk_size
+        self.chunks_dir = os.path.join(repo_dir, "chunks")
+        self.snapshots_dir = os.path.join(repo_dir, "snapshots")
+        self.tmp_dir = os.path.join(repo_dir, "tmp")
+
+    # ------------------------------------------
+    # Chunk store
+    # ------------------------------------------
+    def _chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def _store_stream(self, fileobj) -> Tuple[List[str], int, int]:
+        """Đọc stream theo từng chunk, chỉ ghi những chunk chưa có. Trả về (hashes, size, bytes_mới)."""
+        hashes, size, new_bytes = [], 0, 0
+        while True:
+            block = fileobj.read(self.chunk_size)
+            if not block:
+                break
+            digest = hashlib.sha256(block).hexdigest()
+            path = self._chunk_path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                compressed = zlib.compress(block, 6)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as out:
+                    out.write(compressed)
+                os.replace(tmp_path, path)
+                new_bytes += len(compressed)
+            hashes.append(digest)
+            size += len(block)
+        return hashes, size, new_bytes
+
+    def _read_chunk(self, digest: str) -> bytes:
+        with open(self._chunk_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    # ------------------------------------------
+    # Snapshots
+    # ------------------------------------------
+    @staticmethod
+    def _is_sqlite(path: str) -> bool:
+        try:
+            with open(path, "rb") as f:
+                return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+        except OSError:
+            return False
+
+    def _sqlite_snapshot(self, path: str) -> str:
+        """Chụp bản sao nhất quán của DB đang chạy vào file tạm bằng Online Backup API."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix=".db")
+        os.close(fd)
+        src = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        return tmp_path
+
+    def list_snapshots(self) -> List[str]:
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        return sorted(f[:-5] for f in os.listdir(self.snapshots_dir) if f.endswith(".json"))
+
+    def load_manifest(self, snapshot_id: str) -> Dict:
+        with open(os.path.join(self.snapshots_dir, f"{snapshot_id}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def create_snapshot(self) -> Dict:
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        existing = self.list_snapshots()
+        previous = self.load_manifest(existing[-1])["files"] if existing else {}
+
+        snapshot_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        files, total_size, new_bytes, reused = {}, 0, 0, 0
+
+        for root, _, filenames in os.walk(self.source_dir):
+            for name in sorted(filenames):
+                if name.endswith(SKIP_SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.source_dir)
+                st = os.stat(path)
+                prev = previous.get(rel)
+
+                if prev and prev.get("src_size") == st.st_size and prev.get("mtime_ns") == st.st_mtime_ns:
+                    entry = dict(prev)
+                    reused += 1
+                elif self._is_sqlite(path):
+                    tmp_path = self._sqlite_snapshot(path)
+                    try:
+                        with open(tmp_path, "rb") as f:
+                            hashes, size, added = self._store_stream(f)
+                    finally:
+                        os.remove(tmp_path)
+                    entry = {"chunks": hashes, "size": size, "sqlite": True}
+                    new_bytes += added
+                else:
+                    with open(path, "rb") as f:
+                        hashes, size, added = self._store_stream(f)
+                    entry = {"chunks": hashes, "size": size, "sqlite": False}
+                    new_bytes += added
+
+                # size/mtime của file gốc dùng để phát hiện thay đổi ở lần sau
+                entry["src_size"] = st.st_size
+                entry["mtime_ns"] = st.st_mtime_ns
+                entry["mode"] = st.st_mode & 0o777
+                files[rel] = entry
+                total_size += entry["size"]
+
+        manifest = {
+            "snapshot": snapshot_id,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "source_dir": self.source_dir,
+            "files": files,
+            "total_size": total_size,
+            "new_bytes": new_bytes,
+            "reused_files": reused,
+        }
+        manifest_path = os.path.join(self.snapshots_dir, f"{snapshot_id}.json")
+        with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+        return manifest
+
+    # ------------------------------------------
+    # Retention, Verify, Restore
+    # ------------------------------------------
+    def prune(self) -> int:
+        """Giữ lại `keep` snapshot mới nhất và xóa các chunk không còn snapshot nào tham chiếu."""
+        snapshots = self.list_snapshots()
+        for snapshot_id in snapshots[:-self.keep] if len(snapshots) > self.keep else []:
+            os.remove(os.path.join(self.snapshots_dir, f"{snapshot_id}.json"))
+            logger.info(f"[BACKUP] Đã xóa snapshot cũ: {snapshot_id}")
+
+        referenced = set()
+        for snapshot_id in self.list_snapshots():
+            for entry in self.load_manifest(snapshot_id)["files"].values():
+                referenced.update(entry["chunks"])
+
+        removed = 0
+        if os.path.isdir(self.chunks_dir):
+            for prefix in os.listdir(self.chunks_dir):
+                prefix_dir = os.path.join(self.chunks_dir, prefix)
+                for digest in os.listdir(prefix_dir):
+                    if digest not in referenced:
+                        os.remove(os.path.join(prefix_dir, digest))
+                        removed += 1
+        return removed
+
+    def verify(self, snapshot_id: Optional[str] = None) -> Dict:
+        """Giải nén và băm lại mọi chunk của snapshot để phát hiện chunk thiếu/hỏng."""
+        snapshot_id = snapshot_id or self.list_snapshots()[-1]
+        manifest = self.load_manifest(snapshot_id)
+        missing, corrupt, checked = [], [], set()
+        for entry in manifest["files"].values():
+            for digest in entry["chunks"]:
+                if digest in checked:
+                    continue
+                checked.add(digest)
+                if not os.path.exists(self._chunk_path(digest)):
+                    missing.append(digest)
+                    continue
+                try:
+                    if hashlib.sha256(self._read_chunk(digest)).hexdigest() != digest:
+                        corrupt.append(digest)
+                except zlib.error:
+                    corrupt.append(digest)
+        return {"snapshot": snapshot_id, "ok": not missing and not corrupt,
+                "chunks": len(checked), "missing": missing, "corrupt": corrupt}
+
+    def restore(self, snapshot_id: str, target_dir: str) -> int:
+        """Khôi phục snapshot ra target_dir (ghi file tạm rồi rename, không làm hỏng file đang có)."""
+        manifest = self.load_manifest(snapshot_id)
+        for rel, entry in manifest["files"].items():
+            dest = os.path.join(target_dir, rel)
+            os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+            with open(f"{dest}.restore", "wb") as out:
+                for digest in entry["chunks"]:
+                    out.write(self._read_chunk(digest))
+            os.replace(f"{dest}.restore", dest)
+            os.chmod(dest, entry.get("mode", 0o644))
+        return len(manifest["files"])
+
 def perform_backup():
     """
-    Nén toàn bộ thư mục 'data/' thành file ZIP và lưu vào thư mục 'backups/'.
-    Tự động xóa các bản backup cũ, chỉ giữ lại 7 bản gần nhất (xoay vòng 1 tuần).
+    Tạo snapshot tăng dần của thư mục 'data/' vào 'backups/repo/'.
+    Tự động xoay vòng, chỉ giữ lại 7 snapshot gần nhất (1 tuần) và dọn các chunk mồ côi.
     """
-    source_dir = "data"
-    backup_dir = "backups"
-    
-    # Tạo thư mục backups nếu chưa có
-    os.makedirs(backup_dir, exist_ok=True)
-    
-    # Tạo tên file theo thời gian thực
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = f"coach_data_{timestamp}"
-    backup_path = os.path.join(backup_dir, backup_filename)
-    
+    engine = BackupEngine()
     try:
-        # Nén thư mục data/
-        shutil.make_archive(backup_path, 'zip', source_dir)
-        logger.info(f"[BACKUP] Đã sao lưu thành công: {backup_filename}.zip")
-        
-        # Dọn dẹp: Chỉ giữ lại 7 bản backup gần nhất để đỡ tốn ổ cứng T440
-        all_backups = sorted([f for f in os.listdir(backup_dir) if f.endswith('.zip')])
-        while len(all_backups) > 7:
-            oldest_file = all_backups.pop(0)
-            os.remove(os.path.join(backup_dir, oldest_file))
-            logger.info(f"[BACKUP] Đã xóa bản sao lưu cũ: {oldest_file}")
-            
+        manifest = engine.create_snapshot()
+        logger.info(
+            f"[BACKUP] Đã sao lưu thành công: {manifest['snapshot']} "
+            f"({len(manifest['files'])} files, {manifest['total_size'] / 1e6:.1f} MB dữ liệu, "
+            f"{manifest['new_bytes'] / 1e6:.2f} MB mới, {manifest['reused_files']} file không đổi)"
+        )
+        removed = engine.prune()
+        if removed:
+            logger.info(f"[BACKUP] Đã dọn {removed} chunk không còn được tham chiếu.")
+        return manifest
     except Exception as e:
-        logger.error(f"[BACKUP] Lỗi khi sao lưu dữ liệu: {e}")
\ No newline at end of file
+        logger.error(f"[BACKUP] Lỗi khi sao lưu dữ liệu: {e}")
+        return None
+
+if __name__ == "__main__":
+    # python -m app.services.backup [snapshot | list | verify [id] | restore <id> <target_dir>]
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    engine = BackupEngine()
+    command = sys.argv[1] if len(sys.argv) > 1 else "snapshot"
+    if command == "snapshot":
+        perform_backup()
+    elif command == "list":
+        for sid in engine.list_snapshots():
+            m = engine.load_manifest(sid)
+            print(f"{sid}  files={len(m['files'])}  size={m['total_size'] / 1e6:.1f}MB  new={m['new_bytes'] / 1e6:.2f}MB")
+    elif command == "verify":
+        print(json.dumps(engine.verify(sys.argv[2] if len(sys.argv) > 2 else None), indent=2))
+    elif command == "restore" and len(sys.argv) > 3:
+        count = engine.restore(sys.argv[2], sys.argv[3])
+        print(f"Restored {count} files to {sys.argv[3]}")
+    else:
+        print("Usage: python -m app.services.backup [snapshot|list|verify [id]|restore <id> <target_dir>]")
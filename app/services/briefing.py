@@ -0,0 +1,147 @@
+import json
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from app.core.config import get_config, periodization, TZ_VN
+from app.core.database import (
+    get_user, get_active_users, get_daily_training, get_session_mix,
+    save_briefing_digest, get_briefing_digest, mark_briefing_sent
+)
+from app.core.events import event_bus, HARVEST_COMPLETED
+from app.core.notification import send_telegram_msg
+from app.agents.coach.utils import calculate_acwr, calculate_fitness_fatigue, fill_daily_series
+from app.agents.coach.segmentation import SESSION_TYPES
+
+logger = logging.getLogger("AI_COACH")
+
+HISTORY_DAYS = 120  # Đủ để EWMA 42 ngày (CTL) hội tụ
+
+def next_briefing_date(now: Optional[datetime] = None) -> date:
+    """Ngày của bản tin sắp gửi: hôm nay nếu chưa tới giờ briefing, ngược lại là ngày mai."""
+    now = now or datetime.now(TZ_VN)
+    brief_time = get_config().settings.scheduler.briefing_time
+    try: bh, bm = map(int, brief_time.split(':'))
+    except ValueError: bh, bm = 6, 0
+    if (now.hour, now.minute) < (bh, bm):
+        return now.date()
+    return now.date() + timedelta(days=1)
+
+def _load_series(user_id: str, end: date) -> List[Dict]:
+    """Chuỗi liên tục theo ngày (kể cả ngày nghỉ = 0) kết thúc ở `end`."""
+    start = end - timedelta(days=HISTORY_DAYS - 1)
+    return fill_daily_series(get_daily_training(user_id, start.isoformat(), end.isoformat()), start, end)
+
+def _acwr_at(series: List[Dict], idx: int) -> Dict:
+    acute = sum(d["trimp"] for d in series[max(0, idx - 6): idx + 1])
+    chronic = sum(d["trimp"] for d in series[max(0, idx - 27): idx + 1])
+    return calculate_acwr(round(acute, 2), round(chronic, 2))
+
+def _trend(now: float, before: float, eps: float = 0.02) -> str:
+    if now > before + eps: return "↗️"
+    if now < before - eps: return "↘️"
+    return "➡️"
+
+def build_digest(user_id: str, for_date: Optional[date] = None) -> Optional[Dict]:
+    """Tính + render + lưu bản tin của 1 VĐV cho ngày `for_date` (mặc định: bản tin sắp gửi)."""
+    user = get_user(user_id)
+    if not user:
+        return None
+    snapshot = get_config()
+    for_date = for_date or next_briefing_date()
+    yesterday = for_date - timedelta(days=1)
+
+    series = _load_series(user_id, yesterday)
+    last, week_ago = len(series) - 1, len(series) - 8
+    tsb = [f["tsb"] for f in calculate_fitness_fatigue([d["trimp"] for d in series])]
+    acwr_now, acwr_prev = _acwr_at(series, last), _acwr_at(series, week_ago)
+
+    # Volume tuần: từ thứ 2 tới hôm qua; thứ 2 thì tổng kết tuần vừa xong
+    week_start = for_date - timedelta(days=for_date.weekday())
+    if for_date.weekday() == 0:
+        week_start -= timedelta(days=7)
+    wtd_km = sum(d["km"] for d in series if d["day"] >= week_start.isoformat())
+    plan_km = snapshot.settings.weekly_volume_km
+    if not plan_km:
+        # Không có kế hoạch -> so với trung bình 4 tuần trước đó
+        base_start, base_end = (week_start - timedelta(days=28)).isoformat(), week_start.isoformat()
+        plan_km = sum(d["km"] for d in series if base_start <= d["day"] < base_end) / 4
+
+    period = periodization(user.get("race_date") or snapshot.data.get("race_date"),
+                           user.get("current_goal") or snapshot.data.get("current_goal"), for_date)
+
+    payload = {
+        "for_date": for_date.isoformat(),
+        "yesterday": {"trimp": round(series[last]["trimp"], 1), "km": round(series[last]["km"], 2)},
+        "acwr": acwr_now["acwr"], "acwr_status": acwr_now["status"], "acwr_7d_ago": acwr_prev["acwr"],
+        "tsb": round(tsb[last], 1), "tsb_7d_ago": round(tsb[week_ago], 1),
+        "week_to_date_km": round(wtd_km, 1), "week_plan_km": round(plan_km or 0, 1),
+        "week_label": "Volume tuần trước" if for_date.weekday() == 0 else "Volume tuần",
+        "week_sessions": get_session_mix(user_id, week_start.isoformat(), yesterday.isoformat()),
+        "days_to_race": period.days_to_race, "phase": period.phase,
+    }
+    message = render_digest(user, payload, period.countdown_text)
+    save_briefing_digest(user_id, payload["for_date"], message, json.dumps(payload))
+    return {"message": message, "payload": payload}
+
+def render_digest(user: Dict, p: Dict, countdown_text: str) -> str:
+    for_date = date.fromisoformat(p["for_date"])
+    y = p["yesterday"]
+    yesterday_line = f"`{y['km']:.1f} km` | TRIMP `{y['trimp']:.0f}`" if y["km"] else "Nghỉ ngơi 😴"
+    plan_pct = f" ({p['week_to_date_km'] / p['week_plan_km'] * 100:.0f}%)" if p["week_plan_km"] else ""
+    sessions = p.get("week_sessions") or {}
+    mix_line = ""
+    if sessions:
+        mix = " · ".join(f"{sessions[k]} {k}" for k in SESSION_TYPES if sessions.get(k))
+        mix_line = f"▪️ Cơ cấu buổi tập: {mix}\n"
+    if p["days_to_race"] is not None and p["days_to_race"] >= 0:
+        race_line = f"🏁 Còn `{p['days_to_race']}` ngày tới Race ({p['phase']})"
+    else:
+        race_line = f"🏁 {countdown_text}"
+
+    # Format tin nhắn tiếng Việt chuẩn Markdown
+    return (
+        f"☀️ **CHÀO BUỔI SÁNG {(user.get('name') or 'DYNO').upper()}!**\n"
+        f"📅 Hôm nay là: {for_date.strftime('%A, %d/%m')}\n"
+        f"--------------------------------\n"
+        f"📊 **Tổng kết phong độ:**\n"
+        f"▪️ Hôm qua: {yesterday_line}\n"
+        f"▪️ ACWR: `{p['acwr']}` {_trend(p['acwr'], p['acwr_7d_ago'])} ({p['acwr_status']})\n"
+        f"▪️ Form (TSB): `{p['tsb']:+.1f}` {_trend(p['tsb'], p['tsb_7d_ago'], 1.0)}\n"
+        f"▪️ {p['week_label']}: `{p['week_to_date_km']:.1f} / {p['week_plan_km']:.1f} km`{plan_pct}\n"
+        f"{mix_line}\n"
+        f"{race_line}\n"
+        f"💡 *Gõ /sync để cập nhật dữ liệu nếu cậu vừa chạy xong.*"
+    )
+
+def dispatch_briefings() -> int:
+    """Job 06:00: chỉ gửi text đã dựng sẵn; digest thiếu/cũ mới được dựng lại tại chỗ."""
+    today = datetime.now(TZ_VN).date()
+    sent = 0
+    for user in get_active_users():
+        user_id = user["user_id"]
+        try:
+            digest = get_briefing_digest(user_id)
+            if not digest or digest["for_date"] != today.isoformat():
+                digest = build_digest(user_id, today)
+            elif digest.get("sent_at"):
+                continue  # Đã gửi (job chạy bù) -> không gửi trùng
+            if not digest:
+                continue
+            send_telegram_msg(user_id, digest["message"])
+            mark_briefing_sent(user_id)
+            sent += 1
+        except Exception as e:
+            logger.error(f"[BRIEFING] Failed for {user_id}: {e}")
+    return sent
+
+def _on_harvest_completed(user_id: Optional[str] = None, **_):
+    """Dựng lại digest ngay sau harvest để bản tin sáng luôn có số liệu mới nhất."""
+    user_ids = [user_id] if user_id else [u["user_id"] for u in get_active_users()]
+    for uid in user_ids:
+        try:
+            build_digest(uid)
+        except Exception as e:
+            logger.error(f"[BRIEFING] Digest rebuild failed for {uid}: {e}")
+
+event_bus.subscribe(HARVEST_COMPLETED, _on_harvest_completed)
@@ -0,0 +1,256 @@
+import os
+import time
+import heapq
+import queue
+import logging
+import threading
+import itertools
+import multiprocessing as mp
+from functools import cached_property
+from typing import List, Dict, Any
+
+logger = logging.getLogger("AI_COACH")
+
+# Mức ưu tiên: số nhỏ được xử lý trước.
+# recall (chat đang chờ trả lời) luôn chen lên trước memorize (backfill /sync month).
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+_SHUTDOWN = None  # Sentinel gửi qua queue để dừng worker
+
+# ==========================================
+# 🏭 PHÍA WORKER (Chạy trong process riêng)
+# ==========================================
+def _build_embedder(num_threads: int):
+    """Tạo ONNX MiniLM giống DefaultEmbeddingFunction nhưng ghim cố định số thread."""
+    from chromadb.utils import embedding_functions
+
+    class PinnedThreadsMiniLM(embedding_functions.ONNXMiniLM_L6_V2):
+        @cached_property
+        def model(self):
+            providers = self._preferred_providers or self.ort.get_available_providers()
+            so = self.ort.SessionOptions()
+            so.log_severity_level = 3
+            so.intra_op_num_threads = num_threads
+            so.inter_op_num_threads = 1
+            return self.ort.InferenceSession(
+                os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME, "model.onnx"),
+                providers=providers,
+                sess_options=so,
+            )
+
+    return PinnedThreadsMiniLM()
+
+def _worker_main(request_q, result_q, num_threads: int, batch_window_ms: float, max_batch: int):
+    """
+    Vòng lặp của Embedding Worker.
+    Gom các request đến trong vài ms thành 1 batch (micro-batching), ưu tiên INTERACTIVE trước BULK.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    embedder = _build_embedder(num_threads)
+    window = batch_window_ms / 1000.0
+    pending = []  # heap: (priority, seq, req_id, texts)
+    seq = itertools.count()
+    running = True
+
+    def push(item):
+        nonlocal running
+        if item is _SHUTDOWN:
+            running = False
+            return
+        priority, req_id, texts = item
+        heapq.heappush(pending, (priority, next(seq), req_id, texts))
+
+    while running or pending:
+        if not pending:
+            push(request_q.get())
+            if not running:
+                break
+
+        # Micro-batch: chờ thêm tối đa `window` để gom các request tới sát nhau
+        deadline = time.monotonic() + window
+        while running and len(pending) < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                push(request_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Chỉ gom các request cùng mức ưu tiên với đầu heap để recall không phải đợi batch bulk lớn
+        top_priority = pending[0][0]
+        batch = []
+        n_texts = 0
+        while pending and pending[0][0] == top_priority and n_texts < max_batch:
+            _, _, req_id, texts = heapq.heappop(pending)
+            batch.append((req_id, texts))
+            n_texts += len(texts)
+
+        all_texts = [t for _, texts in batch for t in texts]
+        try:
+            vectors = embedder(all_texts)
+            offset = 0
+            for req_id, texts in batch:
+                result_q.put((req_id, [list(map(float, v)) for v in vectors[offset:offset + len(texts)]], None))
+                offset += len(texts)
+        except Exception as e:
+            for req_id, _ in batch:
+                result_q.put((req_id, None, str(e)))
+
+# ==========================================
+# 🔌 PHÍA CLIENT (Chạy trong FastAPI process)
+# ==========================================
+class _PendingRequest:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class EmbeddingClient:
+    """
+    Client in-process cho Embedding Worker (process riêng, không tranh GIL với FastAPI).
+    Tương thích interface EmbeddingFunction của ChromaDB (`__call__(input)`).
+    Nếu worker bị tắt (EMBEDDING_WORKER=false) hoặc chết, tự động nhúng tại chỗ.
+    """
+    def __init__(self, num_threads: int = 2, batch_window_ms: float = 5.0,
+                 max_batch: int = 32, timeout: float = 60.0, enabled: bool = True):
+        self.num_threads = num_threads
+        self.batch_window_ms = batch_window_ms
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._process = None
+        self._request_q = None
+        self._result_q = None
+        self._reader = None
+        self._pending: Dict[str, _PendingRequest] = {}
+        self._req_seq = itertools.count()
+        self._local_fn = None
+
+    def _ensure_started(self) -> bool:
+        if not self.enabled:
+            return False
+        if self._process is not None and self._process.is_alive():
+            return True
+        with self._lock:
+            if self._process is not None and self._process.is_alive():
+                return True
+            if self._process is not None:
+                logger.error("[EMBED] Embedding worker died. Falling back to in-process embeddings.")
+                self._fail_pending("Embedding worker died")
+                self.enabled = False
+                return False
+            try:
+                # spawn: worker không thừa hưởng state của FastAPI (thread, socket, scheduler)
+                ctx = mp.get_context("spawn")
+                self._request_q = ctx.Queue()
+                self._result_q = ctx.Queue()
+                self._process = ctx.Process(
+                    target=_worker_main,
+                    args=(self._request_q, self._result_q, self.num_threads, self.batch_window_ms, self.max_batch),
+                    name="embedding-worker",
+                    daemon=True,
+                )
+                self._process.start()
+                self._reader = threading.Thread(target=self._read_results, name="embedding-reader", daemon=True)
+                self._reader.start()
+                logger.info(f"[EMBED] Embedding worker started (pid={self._process.pid}, threads={self.num_threads}, window={self.batch_window_ms}ms)")
+                return True
+            except Exception as e:
+                logger.error(f"[EMBED] Cannot start embedding worker, using in-process embeddings: {e}")
+                self.enabled = False
+                return False
+
+    def _read_results(self):
+        while True:
+            try:
+                item = self._result_q.get()
+            except (EOFError, OSError):
+                break
+            if item is _SHUTDOWN:
+                break
+            req_id, vectors, error = item
+            slot = self._pending.pop(req_id, None)
+            if slot is None:
+                continue  # Request đã timeout phía client
+            slot.result, slot.error = vectors, error
+            slot.event.set()
+
+    def _fail_pending(self, reason: str):
+        for req_id in list(self._pending):
+            slot = self._pending.pop(req_id, None)
+            if slot:
+                slot.error = reason
+                slot.event.set()
+
+    def _embed_local(self, texts: List[str]) -> List[List[float]]:
+        if self._local_fn is None:
+            from chromadb.utils import embedding_functions
+            self._local_fn = embedding_functions.DefaultEmbeddingFunction()
+        return [list(map(float, v)) for v in self._local_fn(texts)]
+
+    def embed(self, texts: List[str], priority: int = PRIORITY_INTERACTIVE) -> List[List[float]]:
+        """Nhúng danh sách văn bản. Block thread gọi (không giữ GIL) cho tới khi worker trả kết quả."""
+        texts = list(texts)
+        if not texts:
+            return []
+        if not self._ensure_started():
+            return self._embed_local(texts)
+
+        req_id = f"{os.getpid()}-{next(self._req_seq)}"
+        slot = _PendingRequest()
+        self._pending[req_id] = slot
+        self._request_q.put((priority, req_id, texts))
+
+        deadline = time.monotonic() + self.timeout
+        while not slot.event.wait(0.5):
+            if not self._process.is_alive():
+                self._pending.pop(req_id, None)
+                self._ensure_started()
+                return self._embed_local(texts)
+            if time.monotonic() > deadline:
+                self._pending.pop(req_id, None)
+                raise TimeoutError(f"Embedding worker timed out after {self.timeout}s")
+
+        if slot.error:
+            raise RuntimeError(f"Embedding worker error: {slot.error}")
+        return slot.result
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self.embed(input, priority=PRIORITY_INTERACTIVE)
+
+    def shutdown(self, timeout: float = 5.0):
+        """Dừng worker process (gọi khi app shutdown)."""
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._request_q.put(_SHUTDOWN)
+                self._process.join(timeout)
+                if self._process.is_alive():
+                    self._process.terminate()
+                self._result_q.put(_SHUTDOWN)
+            except Exception as e:
+                logger.error(f"[EMBED] Error stopping embedding worker: {e}")
+            self._fail_pending("Embedding worker stopped")
+            self._process = None
+            logger.info("[EMBED] Embedding worker stopped.")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "alive": bool(self._process and self._process.is_alive()),
+            "pending": len(self._pending),
+        }
+
+# Singleton instance (Worker chỉ được spawn ở lần nhúng đầu tiên)
+embedding_client = EmbeddingClient(
+    num_threads=int(os.getenv("EMBEDDING_THREADS", "2")),
+    batch_window_ms=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")),
+    enabled=os.getenv("EMBEDDING_WORKER", "True").lower() == "true",
+)
@@ -0,0 +1,66 @@
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+
+from app.core.config import get_config, periodization, TZ_VN
+from app.core.database import (
+    get_user, get_daily_training, get_mean_max_bests, save_race_prediction, get_latest_race_prediction
+)
+from app.core.events import event_bus, ACTIVITY_SAVED, HARVEST_COMPLETED
+from app.agents.coach.utils import calculate_fitness_fatigue, fill_daily_series
+from app.agents.coach.race_predictor import predict_race, parse_goal, WINDOW_DAYS
+
+logger = logging.getLogger("AI_COACH")
+
+HISTORY_DAYS = 120  # Đủ để EWMA 42 ngày (CTL) hội tụ + so sánh 4 tuần
+
+def update_prediction(user_id: str, as_of: Optional[date] = None, activity_id: Optional[str] = None) -> Optional[Dict]:
+    """
+    Tính dự đoán của VĐV tại ngày `as_of` (mặc định hôm nay) từ mean-max bests trong WINDOW_DAYS ngày
+    và chuỗi TRIMP tới ngày đó, chiếu tới `race_date` nếu ngày đua còn ở phía trước,
+    rồi lưu thành 1 điểm của chuỗi race_predictions.
+    """
+    user = get_user(user_id)
+    if not user:
+        return None
+    as_of = as_of or datetime.now(TZ_VN).date()
+    config = get_config().data
+    goal = user.get("current_goal") or config.get("current_goal")
+    distance_m, target_s = parse_goal(goal)
+    days_to_race = periodization(user.get("race_date") or config.get("race_date"), goal, as_of).days_to_race
+
+    bests = get_mean_max_bests(user_id, (as_of - timedelta(days=WINDOW_DAYS)).isoformat(), as_of.isoformat())
+    start = as_of - timedelta(days=HISTORY_DAYS - 1)
+    series = fill_daily_series(get_daily_training(user_id, start.isoformat(), as_of.isoformat()), start, as_of)
+    ctl = [f["ctl"] for f in calculate_fitness_fatigue([d["trimp"] for d in series])]
+
+    prediction = predict_race(bests, ctl, distance_m, target_s, days_to_race)
+    if not prediction:
+        return None
+    prediction["activity_id"] = activity_id
+    prediction["as_of"] = as_of.isoformat()
+    save_race_prediction(user_id, prediction["as_of"], prediction)
+    return prediction
+
+def latest_prediction(user_id: str) -> Optional[Dict]:
+    """Tra cứu rẻ: điểm mới nhất của chuỗi; chưa có thì tính ngay."""
+    return get_latest_race_prediction(user_id) or update_prediction(user_id)
+
+def _on_activity_saved(user_id: Optional[str] = None, activity_id: Optional[str] = None,
+                       start_date: Optional[str] = None, **_):
+    """Mỗi bài vừa lưu -> 1 điểm dự đoán tại ngày của bài đó (backfill lịch sử cũng ra chuỗi theo ngày)."""
+    if not user_id:
+        return
+    try:
+        as_of = date.fromisoformat(start_date[:10]) if start_date else None
+    except ValueError:
+        as_of = None
+    update_prediction(user_id, as_of, activity_id)
+
+def _on_harvest_completed(user_id: Optional[str] = None, **_):
+    """TRIMP có thể vừa được tính lại -> làm mới điểm hôm nay."""
+    if user_id:
+        update_prediction(user_id)
+
+event_bus.subscribe(ACTIVITY_SAVED, _on_activity_saved)
+event_bus.subscribe(HARVEST_COMPLETED, _on_harvest_completed)
@@ -1,6 +1,11 @@
 import os
+import re
+import copy
+import time
 import logging
-from typing import Optional, Dict, Any
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Callable, Tuple
 from dotenv import load_dotenv
 
 # 1. BẮT BUỘC: Nạp file .env TRƯỚC khi import ChromaDB
@@ -20,9 +25,95 @@ if cache_dir:
     os.environ["XDG_CACHE_HOME"] = cache_dir # Thêm dòng này để trị triệt để ONNX
 # 3. SAU KHI ĐÃ GÀI BIẾN MÔI TRƯỜNG XONG, MỚI IMPORT CHROMA
 import chromadb
-from chromadb.utils import embedding_functions
+
+from app.services.embedding_worker import embedding_client, PRIORITY_BULK, PRIORITY_INTERACTIVE
+from app.core.database import index_memory_text, search_keyword_memory
+from app.core.events import event_bus, MEMORY_WRITTEN, MESSAGE_SAVED
+from app.core.telemetry import telemetry
 
 logger = logging.getLogger("AI_COACH")
+cache_lookups = telemetry.counter("cache_lookups_total", "Tra cứu cache theo tầng và kết quả")
+
+class RecallCache:
+    """
+    Cache LRU + TTL cho kết quả recall, phân vùng theo user_id.
+    memorize() của user nào chỉ xóa phân vùng của user đó (và phân vùng GLOBAL của các query không lọc user).
+    """
+    GLOBAL = "*"
+
+    def __init__(self, max_entries_per_user: int = 128, ttl_seconds: float = 300):
+        self.max_entries_per_user = max_entries_per_user
+        self.ttl_seconds = ttl_seconds
+        self._partitions: Dict[str, OrderedDict] = {}
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._hit_time = 0.0
+        self._miss_time = 0.0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Chuẩn hóa câu hỏi gần giống nhau về cùng một key (chữ thường, bỏ dấu câu, gộp khoảng trắng)."""
+        return " ".join(re.sub(r"[^\w\s]", " ", query.lower(), flags=re.UNICODE).split())
+
+    def generation(self, partition: str) -> int:
+        return self._generations.get(partition, 0)
+
+    def get(self, partition: str, key: Tuple) -> Tuple[bool, Any]:
+        with self._lock:
+            entries = self._partitions.get(partition)
+            if not entries or key not in entries:
+                return False, None
+            expires_at, value = entries[key]
+            if expires_at < time.monotonic():
+                del entries[key]
+                return False, None
+            entries.move_to_end(key)
+            return True, value
+
+    def put(self, partition: str, key: Tuple, value: Any, generation: int):
+        with self._lock:
+            # Bỏ qua nếu đã có memorize xen giữa lúc đang tính (tránh ghi kết quả cũ vào cache)
+            if self._generations.get(partition, 0) != generation:
+                return
+            entries = self._partitions.setdefault(partition, OrderedDict())
+            entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries_per_user:
+                entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Xóa phân vùng của user (None = xóa toàn bộ)."""
+        with self._lock:
+            partitions = list(self._partitions) if user_id is None else [str(user_id), self.GLOBAL]
+            for partition in partitions:
+                self._partitions.pop(partition, None)
+                self._generations[partition] = self._generations.get(partition, 0) + 1
+            self.invalidations += 1
+
+    def record(self, hit: bool, elapsed: float):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self._hit_time += elapsed
+            else:
+                self.misses += 1
+                self._miss_time += elapsed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "invalidations": self.invalidations,
+                "avg_hit_ms": round(self._hit_time / self.hits * 1000, 3) if self.hits else 0.0,
+                "avg_miss_ms": round(self._miss_time / self.misses * 1000, 3) if self.misses else 0.0,
+                "entries": sum(len(p) for p in self._partitions.values()),
+            }
 
 class RagMemory:
     """
@@ -32,38 +123,110 @@ class RagMemory:
     def __init__(self, db_path: str = "data/chroma_db"):
         self.client = chromadb.PersistentClient(path=db_path)
         
-        # Kích hoạt Local AI Model tích hợp sẵn của Chroma (Không cần Google API)
-        self.embed_fn = embedding_functions.DefaultEmbeddingFunction()
+        # Local AI Model (ONNX MiniLM) chạy trong Embedding Worker process riêng (Không cần Google API)
+        self.embed_fn = embedding_client
         
         # Tạo bảng bộ nhớ mới (os_local_memory) để tương thích với model cục bộ
         self.collection = self.client.get_or_create_collection(
             name="os_local_memory",
             embedding_function=self.embed_fn
         )
+        self.cache = RecallCache(
+            max_entries_per_user=int(os.getenv("RAG_CACHE_SIZE", "128")),
+            ttl_seconds=float(os.getenv("RAG_CACHE_TTL", "300")),
+        )
+        # hybrid_recall đọc cả chat_history (FTS5) -> tin nhắn mới cũng phải xóa cache của user đó
+        event_bus.subscribe(MESSAGE_SAVED, lambda user_id=None, **_: self.cache.invalidate(user_id))
         logger.info(f"[RAG] Memory Center loaded using Local AI Embeddings at {db_path}")
 
+    def _cached(self, user_id: Optional[str], key: Tuple, compute: Callable[[], Any]) -> Any:
+        """Đọc qua RecallCache; trả về bản sao để caller không làm bẩn cache."""
+        partition = str(user_id) if user_id else RecallCache.GLOBAL
+        start = time.perf_counter()
+        hit, value = self.cache.get(partition, key)
+        if not hit:
+            generation = self.cache.generation(partition)
+            value = compute()
+            self.cache.put(partition, key, value, generation)
+        self.cache.record(hit, time.perf_counter() - start)
+        cache_lookups.inc(cache="rag_recall", result="hit" if hit else "miss")
+        return copy.deepcopy(value)
+
     def memorize(self, doc_id: str, content: str, domain: str, extra_meta: Optional[Dict[str, Any]] = None):
         """Lưu trữ ký ức mới vào vector database."""
         metadata = {"domain": domain}
         if extra_meta:
             metadata.update(extra_meta)
             
+        # Memorize là tác vụ nền (bulk) -> nhường worker cho recall
+        embeddings = self.embed_fn.embed([content], priority=PRIORITY_BULK)
         self.collection.upsert(
             documents=[content],
+            embeddings=embeddings,
             metadatas=[metadata],
             ids=[doc_id]
         )
+        # Đồng bộ văn bản sang FTS5 để tra cứu từ khóa không cần embedding
+        index_memory_text(doc_id, metadata.get("user_id"), content, source=metadata.get("type", "memory"))
+        # Write-through invalidation: chỉ xóa cache recall của đúng user vừa được ghi
+        self.cache.invalidate(metadata.get("user_id"))
+        event_bus.publish(MEMORY_WRITTEN, user_id=metadata.get("user_id"), doc_id=doc_id)
         logger.debug(f"[RAG] Successfully memorized item: {doc_id}")
 
-    def recall(self, query: str, domain: Optional[str] = None, n_results: int = 5):
+    def recall(self, query: str, domain: Optional[str] = None, n_results: int = 5, user_id: Optional[str] = None):
         """Hồi tưởng ký ức dựa trên câu hỏi."""
-        where_clause = {"domain": domain} if domain else None
+        key = ("vector", RecallCache.normalize(query), domain, n_results)
+        return self._cached(user_id, key, lambda: self._recall_uncached(query, domain, n_results, user_id))
+
+    def _recall_uncached(self, query: str, domain: Optional[str], n_results: int, user_id: Optional[str]):
+        filters = []
+        if domain:
+            filters.append({"domain": domain})
+        if user_id:
+            filters.append({"user_id": str(user_id)})
+        where_clause = {"$and": filters} if len(filters) > 1 else (filters[0] if filters else None)
         
+        query_embeddings = self.embed_fn.embed([query], priority=PRIORITY_INTERACTIVE)
         results = self.collection.query(
-            query_texts=[query],
+            query_embeddings=query_embeddings,
             n_results=n_results,
             where=where_clause
         )
         return results
 
+    def hybrid_recall(self, query: str, user_id: str, domain: Optional[str] = "coach", n_results: int = 3) -> List[Dict[str, Any]]:
+        """
+        Recall 2 tầng: BM25 (FTS5) trước, chỉ gọi Vector Search khi từ khóa không đủ kết quả.
+        Khi phải dùng cả 2, kết quả được hợp nhất bằng Reciprocal Rank Fusion (RRF).
+        """
+        key = ("hybrid", RecallCache.normalize(query), domain, n_results)
+        return self._cached(user_id, key, lambda: self._hybrid_recall_uncached(query, user_id, domain, n_results))
+
+    def _hybrid_recall_uncached(self, query: str, user_id: str, domain: Optional[str], n_results: int) -> List[Dict[str, Any]]:
+        keyword_hits = search_keyword_memory(user_id, query, limit=n_results)
+        if len(keyword_hits) >= n_results:
+            return [{"id": h["ref_id"], "content": h["content"], "source": h["source"]} for h in keyword_hits]
+
+        try:
+            vector = self.recall(query=query, domain=domain, n_results=n_results, user_id=user_id)
+            vector_ids = vector["ids"][0] if vector and vector.get("ids") else []
+            vector_docs = vector["documents"][0] if vector and vector.get("documents") else []
+        except Exception as e:
+            logger.error(f"[RAG] Vector recall failed, using keyword results only: {e}")
+            vector_ids, vector_docs = [], []
+
+        rrf_k = 60
+        fused: Dict[str, Dict[str, Any]] = {}
+        for rank, h in enumerate(keyword_hits):
+            item = fused.setdefault(h["ref_id"], {"id": h["ref_id"], "content": h["content"], "source": h["source"], "score": 0.0})
+            item["score"] += 1.0 / (rrf_k + rank)
+        for rank, (doc_id, doc) in enumerate(zip(vector_ids, vector_docs)):
+            item = fused.setdefault(doc_id, {"id": doc_id, "content": doc, "source": "vector", "score": 0.0})
+            item["score"] += 1.0 / (rrf_k + rank)
+
+        ranked = sorted(fused.values(), key=lambda x: x["score"], reverse=True)[:n_results]
+        for item in ranked:
+            item.pop("score", None)
+        return ranked
+
 rag_db = RagMemory()
\ No newline at end of file
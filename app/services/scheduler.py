@@ -1,87 +1,220 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+from apscheduler.schedulers.base import STATE_RUNNING
 import pytz
-import os
-import json
+import time
 import logging
-from datetime import datetime
-from app.core.notification import send_telegram_msg
-from app.agents.coach.harvest import harvest_data
+import threading
+import functools
+import concurrent.futures
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional, Set
+from app.core.database import record_job_run, get_job_runs, get_runtime_state, set_runtime_state, get_user
+from app.agents.coach.harvest import harvest_data, harvest_user, seed_primary_user
+from app.services.briefing import dispatch_briefings
 from app.services.backup import perform_backup
+from app.services.trimp_recompute import recompute_trimp
+from app.services.session_labels import relabel_sessions
+from app.core.config import load_config
+from app.core.telemetry import telemetry
+from app.core.leader import leader
 logger = logging.getLogger("AI_COACH")
 TZ_VN = pytz.timezone('Asia/Ho_Chi_Minh')
-scheduler = AsyncIOScheduler()
-
-async def task_morning_briefing():
-    """Gửi bản tin tóm tắt buổi sáng qua Telegram"""
-    chat_id = os.getenv("TELEGRAM_CHAT_ID")
-    if chat_id:
-        stats = {}
-        # Đọc dữ liệu Strava đã được harvest_data thu thập
-        if os.path.exists("data/athlete_stats.json"):
+
+# Job chạy trên Thread Pool giới hạn (không chạy trên event loop của FastAPI)
+# - max_instances=1 + coalesce: 1 job không bao giờ chạy chồng lên chính nó, các lần lỡ dồn lại thành 1
+# - misfire_grace_time: trễ tối đa 10 phút vẫn chạy bù, quá thì ghi nhận "missed"
+scheduler = AsyncIOScheduler(
+    executors={"default": ThreadPoolExecutor(max_workers=2)},
+    job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 600},
+    timezone=TZ_VN,
+)
+
+def tracked_job(job_id: str, requires_lease: bool = True):
+    """
+    Decorator: đo thời gian + lưu kết quả lần chạy gần nhất của job vào bảng job_runs.
+    Job theo lịch (requires_lease) chỉ chạy khi worker này còn giữ lease Leader trong DB: event loop bị treo
+    quá TTL thì worker khác đã tiếp quản và sẽ tự chạy job đó.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if requires_lease and not leader.holds_lease():
+                logger.warning(f"[SCHEDULER] Job '{job_id}' skipped: this worker no longer holds the leader lease.")
+                record_job_run(job_id, "skipped")
+                return None
+            started_at = datetime.now(TZ_VN).strftime("%Y-%m-%d %H:%M:%S")
+            start = time.perf_counter()
+            status, error = "success", None
             try:
-                with open("data/athlete_stats.json", "r") as f:
-                    stats = json.load(f)
+                with telemetry.span(f"job.{job_id}"):
+                    return func(*args, **kwargs)
             except Exception as e:
-                logger.error(f"[SCHEDULER] Failed to read stats: {e}")
-        
-        ytd_km = stats.get('ytd_run_totals', 0)
-        recent_km = stats.get('recent_run_totals', 0)
-        
-        # Format tin nhắn tiếng Việt chuẩn Markdown
-        msg = (
-            f"☀️ **CHÀO BUỔI SÁNG DYNO!**\n"
-            f"📅 Hôm nay là: {datetime.now(TZ_VN).strftime('%A, %d/%m')}\n"
-            f"--------------------------------\n"
-            f"📊 **Tổng kết phong độ:**\n"
-            f"▪️ Tích lũy năm nay: `{ytd_km:.1f} km`\n"
-            f"▪️ Volume 4 tuần: `{recent_km:.1f} km`\n\n"
-            f"🔥 *Chỉ còn 5 tuần nữa là đến Race. Đừng quên bài chạy hôm nay nhé!*\n"
-            f"💡 *Gõ /sync để cập nhật dữ liệu nếu cậu vừa chạy xong.*"
-        )
-        send_telegram_msg(chat_id, msg)
-        logger.info("[SCHEDULER] Sent Morning Briefing.")
-
-async def task_auto_harvest():
-    """Tự động đồng bộ Strava mỗi 6 tiếng"""
+                status, error = "failed", str(e)
+                logger.error(f"[SCHEDULER] Job '{job_id}' failed: {e}")
+            finally:
+                duration = round(time.perf_counter() - start, 3)
+                record_job_run(job_id, status, started_at=started_at, duration_s=duration, error=error)
+                logger.info(f"[SCHEDULER] Job '{job_id}' finished: {status} in {duration}s")
+        return wrapper
+    return decorator
+
+def _on_job_skipped(event):
+    """Listener: ghi nhận job bị lỡ lịch (misfire) hoặc bị chặn vì lần trước chưa chạy xong."""
+    status = "missed" if event.code == EVENT_JOB_MISSED else "skipped"
+    logger.warning(f"[SCHEDULER] Job '{event.job_id}' {status}.")
+    record_job_run(event.job_id, status)
+
+scheduler.add_listener(_on_job_skipped, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+@tracked_job("briefing")
+def task_morning_briefing():
+    """Gửi bản tin buổi sáng (đã dựng sẵn sau harvest) qua Telegram cho mọi VĐV đang active"""
+    seed_primary_user(load_config())
+    sent = dispatch_briefings()
+    logger.info(f"[SCHEDULER] Sent Morning Briefing to {sent} users.")
+
+@tracked_job("harvest")
+def task_auto_harvest():
+    """Tự động đồng bộ Strava mỗi 6 tiếng: lên lịch 1 job/VĐV tại offset của họ (không ngủ trong pool)"""
     logger.info("[SCHEDULER] Auto-harvesting...")
-    harvest_data()
+    harvest_data(schedule=_schedule_user_harvest)
 
-# ... (Giữ nguyên các import và các hàm task_morning_briefing, task_auto_harvest, perform_backup) ...
+@tracked_job("harvest_user")
+def task_harvest_user(user_id: str):
+    """Harvest 1 VĐV của đợt Auto-harvest (chạy trên executor 'harvest', tách khỏi job khác)."""
+    user = get_user(user_id)  # Đọc lại lúc chạy: token có thể đã xoay vòng kể từ lúc lên lịch
+    if user and user.get("is_active") and user.get("strava_refresh_token"):
+        harvest_user(user)
 
-from app.core.config import load_config
+def _schedule_user_harvest(user, offset_s: int):
+    scheduler.add_job(task_harvest_user, DateTrigger(run_date=datetime.now(TZ_VN) + timedelta(seconds=offset_s)),
+                      args=[user["user_id"]], id=f"harvest:{user['user_id']}", replace_existing=True,
+                      executor="harvest")
+
+@tracked_job("trimp_recompute", requires_lease=False)
+def task_recompute_trimp(user_ids=None):
+    """Job theo yêu cầu (không có lịch): tính lại TRIMP toàn bộ lịch sử khi thông số sinh lý đổi."""
+    recompute_trimp(user_ids)
+
+@tracked_job("session_relabel", requires_lease=False)
+def task_relabel_sessions(user_ids=None):
+    """Job theo yêu cầu: chạy lại segmentation + nhãn buổi tập cho toàn bộ lịch sử từ stream đã lưu."""
+    relabel_sessions(user_ids)
+
+# Job bảo trì theo yêu cầu (tính lại TRIMP, gắn nhãn lại) ghi lại toàn bộ lịch sử -> chạy trên 1 worker riêng
+# (không bao giờ 2 lượt chạy chồng, không chiếm pool của Scheduler và chạy được cả trên worker không phải Leader).
+# Yêu cầu cùng job_id khi lượt trước còn đang chờ được gộp vào lượt đó (hợp user_ids, None = mọi VĐV).
+_maintenance_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+_maintenance_lock = threading.Lock()
+_maintenance_queued: Dict[str, Optional[Set[str]]] = {}
+
+def submit_maintenance(job_id: str, task: Callable, user_ids: Optional[Iterable[str]] = None) -> bool:
+    """Xếp hàng job bảo trì (single-flight theo job_id). Trả về False nếu đã gộp vào lượt đang chờ."""
+    ids = None if user_ids is None else {str(u) for u in user_ids}
+    with _maintenance_lock:
+        if job_id in _maintenance_queued:
+            queued = _maintenance_queued[job_id]
+            _maintenance_queued[job_id] = None if queued is None or ids is None else queued | ids
+            return False
+        _maintenance_queued[job_id] = ids
+
+    def run():
+        with _maintenance_lock:
+            pending = _maintenance_queued.pop(job_id)
+        task(sorted(pending) if pending is not None else None)
+
+    _maintenance_pool.submit(telemetry.bind(run))
+    return True
+
+@tracked_job("backup")
+def task_backup():
+    """Sao lưu thư mục data/ hàng ngày"""
+    perform_backup()
 
 def setup_jobs():
     """Đọc cấu hình và thiết lập lịch chạy (có thể gọi lại để reload)"""
     config = load_config()
     sched_cfg = config.get("scheduler", {})
-    
+
     # 1. Lịch Briefing (Mặc định 06:00)
     brief_time = sched_cfg.get("briefing_time", "06:00")
     try: bh, bm = map(int, brief_time.split(':'))
     except: bh, bm = 6, 0
-    
+
     # 2. Lịch Backup (Mặc định 02:00)
     backup_time = sched_cfg.get("backup_time", "02:00")
     try: bkh, bkm = map(int, backup_time.split(':'))
     except: bkh, bkm = 2, 0
-    
+
     # 3. Lịch Harvest (Mặc định chạy các khung giờ 0,6,12,18 phút 15)
     harv_hours = sched_cfg.get("harvest_hours", "0,6,12,18")
     harv_min = str(sched_cfg.get("harvest_minute", "15"))
 
     # replace_existing=True giúp đè lịch mới lên lịch cũ nếu cùng ID
     scheduler.add_job(task_morning_briefing, CronTrigger(hour=bh, minute=bm, timezone=TZ_VN), id='briefing', replace_existing=True)
-    scheduler.add_job(perform_backup, CronTrigger(hour=bkh, minute=bkm, timezone=TZ_VN), id='backup', replace_existing=True)
+    scheduler.add_job(task_backup, CronTrigger(hour=bkh, minute=bkm, timezone=TZ_VN), id='backup', replace_existing=True)
     scheduler.add_job(task_auto_harvest, CronTrigger(hour=harv_hours, minute=harv_min, timezone=TZ_VN), id='harvest', replace_existing=True)
-    
+
     logger.info(f"[SCHEDULER] Đã nạp lịch: Briefing({bh}:{bm}), Backup({bkh}:{bkm}), Harvest({harv_hours}h:{harv_min}m)")
 
+def get_jobs_overview():
+    """Gộp lịch chạy tiếp theo (APScheduler) với kết quả lần chạy gần nhất (job_runs) cho Admin UI."""
+    # Worker không phải Leader không có job trong bộ nhớ -> vẫn hiển thị kết quả từ job_runs
+    runs = {r["job_id"]: r for r in get_job_runs()}
+    next_runs = {job.id: getattr(job, "next_run_time", None) for job in scheduler.get_jobs()
+                 if not job.id.startswith("harvest:")}  # Job 1 lần của từng VĐV -> gộp vào "harvest_user"
+    overview = []
+    for job_id in sorted(set(runs) | set(next_runs)):
+        row = dict(runs.get(job_id, {"job_id": job_id}))
+        next_run = next_runs.get(job_id)
+        row["next_run_time"] = next_run.strftime("%Y-%m-%d %H:%M") if next_run else None
+        overview.append(row)
+    return overview
+
+# Phiên bản cấu hình lịch đang áp dụng (so với runtime_state 'scheduler_rev' dùng chung giữa các worker)
+_applied_rev = None
+
+def init_scheduler():
+    """
+    Gọi 1 lần trong startup (trên event loop của FastAPI): Scheduler khởi động ở trạng thái PAUSE,
+    chỉ khi worker được bầu Leader mới resume. start/pause/resume sau đó gọi an toàn từ thread.
+    """
+    if scheduler.running:
+        return
+    # Pool riêng cho harvest từng VĐV: đợt harvest không chiếm 2 worker của các job khác
+    concurrency = int(load_config().get("scheduler", {}).get("harvest_concurrency", 4))
+    scheduler.add_executor(ThreadPoolExecutor(max_workers=max(1, concurrency)), alias="harvest")
+    scheduler.start(paused=True)
+
 def start_scheduler():
-    """Khởi động bộ lập lịch lần đầu tiên"""
+    """Nạp lịch rồi chạy Scheduler (gọi trong thread khi worker này được bầu làm Leader)"""
+    global _applied_rev
+    _applied_rev = get_runtime_state("scheduler_rev")
     setup_jobs()
-    scheduler.start()
+    scheduler.resume()
+
+def pause_scheduler():
+    """Tạm dừng bộ lập lịch (gọi khi worker mất quyền Leader). Job đang chạy dở vẫn được chạy nốt."""
+    if scheduler.state == STATE_RUNNING:
+        scheduler.pause()
+        logger.info("[SCHEDULER] Scheduler paused on this worker.")
+
+def sync_scheduler_config():
+    """Leader gọi định kỳ: nạp lại lịch nếu worker khác đã lưu cấu hình mới từ Admin UI."""
+    global _applied_rev
+    rev = get_runtime_state("scheduler_rev")
+    if rev != _applied_rev:
+        _applied_rev = rev
+        setup_jobs()
 
 def reload_scheduler():
     """Gọi từ Admin UI để cập nhật lịch ngay lập tức"""
-    setup_jobs()
\ No newline at end of file
+    global _applied_rev
+    _applied_rev = str(time.time())
+    set_runtime_state("scheduler_rev", _applied_rev)
+    if scheduler.state == STATE_RUNNING:  # Chỉ Leader; worker khác nạp qua sync_scheduler_config khi lên Leader
+        setup_jobs()
@@ -0,0 +1,53 @@
+import time
+import logging
+from typing import Dict, Iterable, Optional
+
+from app.core.database import get_user, get_active_users, iter_stream_blobs, save_activity_segments
+from app.core.events import event_bus, HARVEST_COMPLETED
+from app.agents.coach.strava_client import unpack_streams
+from app.agents.coach.segmentation import segment_run
+from app.agents.coach.harvest import segment_row
+from app.services.trimp_recompute import physiology_key
+
+logger = logging.getLogger("AI_COACH")
+
+def relabel_user_sessions(user_id: str, chunk_size: int = 200) -> Dict:
+    """
+    Chạy lại segmentation cho mọi bài đã lưu stream của 1 VĐV (đổi ngưỡng/thuật toán, đổi Max/Rest HR).
+    Đọc blob + lap đã lưu theo lô, ghi lại bằng 1 executemany/lô; không gọi Strava.
+    """
+    user = get_user(user_id)
+    if not user:
+        return {"user_id": user_id, "activities": 0, "labels": {}}
+    max_hr, rest_hr, _ = physiology_key(user)
+    start = time.perf_counter()
+    total = 0
+    labels: Dict[str, int] = {}
+    for chunk in iter_stream_blobs(user_id, chunk_size):
+        rows = []
+        for activity_id, start_date, blob, laps in chunk:
+            result = segment_run(unpack_streams(blob), max_hr, rest_hr, laps)
+            if not result:
+                continue
+            labels[result["session_type"]] = labels.get(result["session_type"], 0) + 1
+            rows.append(segment_row(activity_id, user_id, start_date, result))
+        save_activity_segments(rows)
+        total += len(rows)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"[SEGMENTS] Relabelled {total} activities for {user_id} in {elapsed * 1000:.0f} ms: {labels}")
+    if total:
+        event_bus.publish(HARVEST_COMPLETED, user_id=str(user_id))
+    return {"user_id": user_id, "activities": total, "labels": labels, "elapsed_ms": round(elapsed * 1000, 1)}
+
+def relabel_sessions(user_ids: Optional[Iterable[str]] = None) -> list:
+    """Gắn nhãn lại cho danh sách VĐV (mặc định: mọi VĐV đang active)."""
+    if user_ids is None:
+        user_ids = [u["user_id"] for u in get_active_users()]
+    results = []
+    for user_id in user_ids:
+        try:
+            results.append(relabel_user_sessions(str(user_id)))
+        except Exception as e:
+            logger.error(f"[SEGMENTS] Relabel failed for {user_id}: {e}")
+    return results
@@ -0,0 +1,73 @@
+import json
+import time
+import logging
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from app.core.database import (
+    get_user, get_active_users, iter_activity_hr_chunks, bulk_update_trimp, bulk_update_activity_load,
+    rebuild_volume_rollups
+)
+from app.core.events import event_bus, HARVEST_COMPLETED
+from app.agents.coach.utils import calculate_trimp_batch
+from app.agents.coach.load_engine import load_from_histogram
+
+logger = logging.getLogger("AI_COACH")
+
+CHUNK_SIZE = 5000
+
+def physiology_key(profile: Dict) -> tuple:
+    """Các thông số quyết định TRIMP; đổi 1 trong số này -> phải tính lại lịch sử."""
+    return (int(profile.get("max_hr") or 185), int(profile.get("rest_hr") or 55), (profile.get("sex") or "M").upper())
+
+def recompute_user_trimp(user_id: str, chunk_size: int = CHUNK_SIZE) -> Dict:
+    """
+    Tính lại trimp_score cho toàn bộ bài chạy của 1 VĐV theo thông số hiện tại trong bảng users.
+    Đọc theo lô, tính cả lô bằng numpy, ghi lại bằng 1 executemany/lô (chỉ dòng có giá trị đổi).
+    Bài có histogram nhịp tim từng giây dùng TRIMP tích phân (load engine), còn lại dùng nhịp tim TB.
+    """
+    user = get_user(user_id)
+    if not user:
+        return {"user_id": user_id, "activities": 0, "changed": 0}
+    max_hr, rest_hr, sex = physiology_key(user)
+    start = time.perf_counter()
+    total = changed = 0
+    for chunk in iter_activity_hr_chunks(user_id, chunk_size):
+        activity_ids = [row[0] for row in chunk]
+        durations = np.fromiter((row[1] or 0 for row in chunk), dtype=np.float64, count=len(chunk))
+        avg_hrs = np.fromiter((row[2] or 0 for row in chunk), dtype=np.float64, count=len(chunk))
+        trimps = calculate_trimp_batch(durations, avg_hrs, max_hr, rest_hr, sex).tolist()
+
+        load_rows = []
+        for i, row in enumerate(chunk):
+            if row[5] is None:
+                continue
+            load = load_from_histogram(row[4], json.loads(row[5]), max_hr, rest_hr, sex)
+            trimps[i] = load["bannister_trimp"]
+            load_rows.append((load["bannister_trimp"], load["edwards_trimp"], json.dumps(load["zone_seconds"]),
+                              max_hr, rest_hr, sex, row[0]))
+        bulk_update_activity_load(load_rows)
+        changed += bulk_update_trimp(list(zip(trimps, activity_ids)))
+        total += len(chunk)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"[TRIMP] Recomputed {total} activities for {user_id} "
+                f"(HR {rest_hr}-{max_hr}, sex {sex}): {changed} changed in {elapsed * 1000:.0f} ms")
+    if changed:
+        rebuild_volume_rollups(user_id)  # Cột trimp của rollup tuần/tháng
+        # ACWR / digest / cache tool phụ thuộc TRIMP -> báo như vừa harvest xong
+        event_bus.publish(HARVEST_COMPLETED, user_id=str(user_id))
+    return {"user_id": user_id, "activities": total, "changed": changed, "elapsed_ms": round(elapsed * 1000, 1)}
+
+def recompute_trimp(user_ids: Optional[Iterable[str]] = None) -> list:
+    """Tính lại cho danh sách VĐV (mặc định: mọi VĐV đang active)."""
+    if user_ids is None:
+        user_ids = [u["user_id"] for u in get_active_users()]
+    results = []
+    for user_id in user_ids:
+        try:
+            results.append(recompute_user_trimp(str(user_id)))
+        except Exception as e:
+            logger.error(f"[TRIMP] Recompute failed for {user_id}: {e}")
+    return results
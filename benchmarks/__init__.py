@@ -0,0 +1,5 @@
+"""
+Bộ benchmark offline cho pipeline coach: dữ liệu giả lập + stub Strava/Gemini/embedding,
+đo từng stage riêng lẻ và end-to-end. Chạy: `python -m benchmarks.run --help`.
+Đây là benchmark (đo thời gian, so với baseline), không phải test.
+"""
@@ -0,0 +1,121 @@
+import gc
+import os
+import json
+import time
+import platform
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+# ==========================================
+# ⏱️ HARNESS (đo, tổng hợp, so sánh baseline)
+# ==========================================
+# Mỗi case: `warmup` lần chạy bỏ qua + `repeat` lần đo bằng perf_counter, GC tắt trong lúc đo.
+# `setup` (nếu có) chạy ngoài vùng đo và trả về tham số cho lần đo đó (id mới, xóa cache...).
+
+REGRESSION_THRESHOLD = 1.25
+MIN_DELTA_MS = 0.2   # Chênh lệch tuyệt đối nhỏ hơn -> coi là nhiễu dù tỉ lệ lớn
+
+class Bench:
+    def __init__(self, repeat: int = 5, warmup: int = 1):
+        self.repeat = repeat
+        self.warmup = warmup
+        self.results: Dict[str, Dict[str, Any]] = {}
+
+    def measure(self, name: str, fn: Callable, setup: Optional[Callable[[], Any]] = None,
+                repeat: Optional[int] = None, **params) -> Dict[str, Any]:
+        """Đo `fn(setup())` (hoặc `fn()`), lưu thống kê ms vào results[name]."""
+        repeat = repeat or self.repeat
+        samples = []
+        for i in range(self.warmup + repeat):
+            arg = setup() if setup else None
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                fn(arg) if setup else fn()
+                elapsed = time.perf_counter() - start
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            if i >= self.warmup:
+                samples.append(elapsed * 1000)
+        stats = summarize(samples)
+        self.results[name] = {**stats, "params": params}
+        print(f"  {name:<48} median {stats['median_ms']:>10.3f} ms   p95 {stats['p95_ms']:>10.3f} ms")
+        return self.results[name]
+
+def summarize(samples_ms: List[float]) -> Dict[str, Any]:
+    values = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "runs": int(values.size),
+        "min_ms": round(float(values.min()), 4),
+        "median_ms": round(float(np.median(values)), 4),
+        "p95_ms": round(float(np.percentile(values, 95)), 4),
+        "mean_ms": round(float(values.mean()), 4),
+    }
+
+def _git_commit(repo_root: str) -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_root, capture_output=True,
+                             text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def build_report(results: Dict[str, Dict], args: Dict[str, Any], repo_root: str) -> Dict[str, Any]:
+    import pandas as pd
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": _git_commit(repo_root),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": args,
+        },
+        "results": results,
+    }
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Any], threshold: float = REGRESSION_THRESHOLD,
+            min_delta_ms: float = MIN_DELTA_MS) -> Dict[str, Dict[str, Any]]:
+    """So median từng case với baseline: regression / improvement / ok (case mới hoặc đã bỏ -> new / missing)."""
+    base_results = baseline.get("results", {})
+    comparison = {}
+    for name in sorted(set(results) | set(base_results)):
+        current, base = results.get(name), base_results.get(name)
+        if base is None or current is None:
+            comparison[name] = {"status": "new" if base is None else "missing"}
+            continue
+        ratio = current["median_ms"] / base["median_ms"] if base["median_ms"] > 0 else float("inf")
+        delta = current["median_ms"] - base["median_ms"]
+        status = "ok"
+        if ratio > threshold and delta > min_delta_ms:
+            status = "regression"
+        elif ratio < 1 / threshold and -delta > min_delta_ms:
+            status = "improvement"
+        comparison[name] = {"status": status, "ratio": round(ratio, 3), "baseline_ms": base["median_ms"],
+                            "current_ms": current["median_ms"]}
+    return comparison
+
+def print_comparison(comparison: Dict[str, Dict[str, Any]]):
+    marks = {"regression": "▲ SLOWER", "improvement": "▼ faster", "ok": "", "new": "(new)", "missing": "(missing)"}
+    print("\nSo với baseline (median):")
+    for name, row in comparison.items():
+        if "ratio" in row:
+            print(f"  {name:<48} {row['baseline_ms']:>10.3f} -> {row['current_ms']:>10.3f} ms  x{row['ratio']:<6} "
+                  f"{marks[row['status']]}")
+        else:
+            print(f"  {name:<48} {marks[row['status']]}")
+
+def write_json(path: str, data: Dict[str, Any]):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+def read_json(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,111 @@
+"""
+Chạy toàn bộ benchmark offline và ghi báo cáo JSON.
+
+    python -m benchmarks.run                      # stream 30'/2h/6h, DB 1k/10k/100k hàng, 2000 ký ức
+    python -m benchmarks.run --quick              # vòng nhanh khi đang sửa code
+    python -m benchmarks.run --rows 1000,1000000  # DB tới 1M hàng (seed mất vài phút)
+    python -m benchmarks.run --save-baseline      # chốt kết quả hiện tại làm baseline
+
+Có baseline (mặc định benchmarks/results/baseline.json) thì in bảng so sánh median và
+trả exit code 1 nếu có case chậm hơn `--threshold` lần.
+"""
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+# .env của máy dev không được lọt vào benchmark (load_dotenv không ghi đè biến đã có, kể cả rỗng)
+SECRET_ENV = ("TELEGRAM_BOT_TOKEN", "STRAVA_REFRESH_TOKEN", "STRAVA_CLIENT_ID", "STRAVA_CLIENT_SECRET",
+              "STRAVA_ATHLETE_ID", "EMAIL_SENDER", "EMAIL_PASSWORD", "EMAIL_RECEIVER")
+
+def bootstrap(workdir: str) -> str:
+    """
+    Môi trường cô lập TRƯỚC khi import `app`: cwd = workdir tạm (DB SQLite, Chroma, config đều là
+    đường dẫn tương đối 'data/...'), secret rỗng, không spawn embedding worker.
+    """
+    sys.path.insert(0, REPO_ROOT)
+    from benchmarks.synthetic import BENCH_USER
+
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    config_path = os.path.join(workdir, "data", "config.json")
+    if not os.path.exists(config_path):
+        shutil.copy(os.path.join(REPO_ROOT, "config.example.json"), config_path)
+    for key in SECRET_ENV:
+        os.environ[key] = ""
+    os.environ.update(GOOGLE_API_KEY="bench-offline", EMBEDDING_WORKER="false", TELEGRAM_CHAT_ID=BENCH_USER,
+                      ANONYMIZED_TELEMETRY="False", LOG_AI_PROMPTS="False")
+    os.chdir(workdir)
+    return workdir
+
+def _int_list(text: str):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Offline benchmarks cho coach pipeline")
+    parser.add_argument("--quick", action="store_true", help="1 cỡ stream, DB 1k hàng, 200 ký ức, 3 lần đo")
+    parser.add_argument("--sizes", type=_int_list, default=None, help="Số mẫu stream, VD 1800,7200,21600")
+    parser.add_argument("--rows", type=_int_list, default=None, help="Số hàng DB seed, VD 1000,10000,100000")
+    parser.add_argument("--docs", type=int, default=None, help="Số ký ức RAG seed sẵn")
+    parser.add_argument("--stages", default="streams,db,rag,pipeline", help="Chọn stage (phân cách bằng dấu phẩy)")
+    parser.add_argument("--repeat", type=int, default=None, help="Số lần đo mỗi case (sau 1 lần warmup)")
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIR, "latest.json"))
+    parser.add_argument("--baseline", default=os.path.join(RESULTS_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Ghi kết quả lần này thành baseline")
+    parser.add_argument("--threshold", type=float, default=None, help="Tỉ lệ median coi là regression (mặc định 1.25)")
+    parser.add_argument("--workdir", default=None, help="Thư mục làm việc (mặc định thư mục tạm, tự xóa)")
+    args = parser.parse_args(argv)
+    args.sizes = args.sizes or ([1800] if args.quick else [1800, 7200, 21600])
+    args.rows = args.rows or ([1000] if args.quick else [1000, 10000, 100000])
+    args.docs = args.docs or (200 if args.quick else 2000)
+    args.repeat = args.repeat or (3 if args.quick else 5)
+    args.stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    return args
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    output, baseline_path = os.path.abspath(args.output), os.path.abspath(args.baseline)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="coach-bench-")
+    bootstrap(os.path.abspath(workdir))
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    logging.getLogger("AI_COACH").setLevel(logging.WARNING)
+    logging.getLogger("chromadb.telemetry").setLevel(logging.CRITICAL)
+
+    from benchmarks.harness import Bench, REGRESSION_THRESHOLD, build_report, compare, print_comparison, write_json, read_json
+    from benchmarks.stages import run_all
+
+    threshold = args.threshold or REGRESSION_THRESHOLD
+    try:
+        bench = Bench(repeat=args.repeat)
+        results = run_all(bench, args.sizes, args.rows, args.docs, args.stages)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = build_report(results, {"sizes": args.sizes, "rows": args.rows, "docs": args.docs,
+                                    "stages": args.stages, "repeat": args.repeat}, REPO_ROOT)
+    exit_code = 0
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        comparison = compare(results, read_json(baseline_path), threshold)
+        report["comparison"] = {"baseline": baseline_path, "threshold": threshold, "cases": comparison}
+        print_comparison(comparison)
+        regressions = [name for name, row in comparison.items() if row["status"] == "regression"]
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) > x{threshold}: {', '.join(regressions)}")
+            exit_code = 1
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    write_json(output, report)
+    print(f"\nReport: {output}")
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        write_json(baseline_path, report)
+        print(f"Baseline saved: {baseline_path}")
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
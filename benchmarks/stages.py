@@ -0,0 +1,219 @@
+import os
+import time
+import itertools
+from datetime import datetime, timedelta
+from typing import Dict, List, Sequence
+
+from app.core import database
+from app.core.config import get_config
+from app.core.database import (
+    init_db, get_db_connection, get_user, save_run_activity, get_training_loads, get_daily_training,
+    get_recent_runs_log, get_volume_rollups, get_activities, load_history_for_gemini, search_keyword_memory,
+    rebuild_volume_rollups, index_memory_text
+)
+from app.agents.coach import agent
+from app.agents.coach.strava_client import STREAM_KEYS, stream_cache, pack_streams, unpack_streams
+from app.agents.coach.load_engine import compute_stream_load
+from app.agents.coach.mean_max import mean_max_curve
+from app.agents.coach.stream_analytics import analyze_streams
+from app.agents.coach.segmentation import segment_run
+from app.agents.coach.pre_analysis import build_run_report, format_run_report
+from app.agents.coach.harvest import harvest_user
+from app.routers.webhooks import run_strava_workflow
+from app.services.rag_memory import rag_db
+from benchmarks.harness import Bench
+from benchmarks.stubs import StubStravaClient, StubEmbedder, install_stubs
+from benchmarks.synthetic import BENCH_USER, BENCH_ATHLETE, make_streams, run_rows, chat_rows
+
+# ==========================================
+# 🏁 STAGES (mỗi stage 1 nhóm case, tên case = "<stage>.<bước>[tham số]")
+# ==========================================
+
+MAX_HR, REST_HR, SEX = 185, 55, "M"
+RUNS_PER_USER = 1000           # DB lớn = nhiều VĐV x ~3 năm lịch sử, không phải 1 VĐV có 1M bài
+PIPELINE_SAMPLES = 3600        # Bài chạy 1 giờ cho stage prompt / end-to-end
+PIPELINE_RUNS = 300
+RECALL_QUERY = "bài interval nhịp tim cao pace chậm lại"
+
+def use_database(name: str):
+    """Mỗi kích thước dữ liệu 1 file SQLite riêng trong workdir (get_db_connection đọc DB_PATH lúc gọi)."""
+    database.DB_PATH = os.path.join("data", f"bench_{name}.db")
+    if os.path.exists(database.DB_PATH):
+        os.remove(database.DB_PATH)
+    init_db()
+
+def seed_database(rows: int, now: datetime, runs_per_user: int = RUNS_PER_USER) -> List[str]:
+    """`rows` hàng run_activities + `rows` hàng chat_history chia cho rows/runs_per_user VĐV (BENCH_USER đầu tiên)."""
+    users = [BENCH_USER] + [f"bench-{k}" for k in range(1, max(1, -(-rows // runs_per_user)))]
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.executemany('''
+        INSERT OR REPLACE INTO users (user_id, name, max_hr, rest_hr, current_goal, is_active,
+                                      strava_athlete_id, strava_refresh_token)
+        VALUES (?, ?, ?, ?, 'Sub 1:45 HM', 1, ?, 'bench')
+    ''', [(u, f"Runner {u}", MAX_HR, REST_HR, BENCH_ATHLETE if u == BENCH_USER else None) for u in users])
+    for k, user_id in enumerate(users):
+        count = min(runs_per_user, rows - k * runs_per_user)
+        c.executemany('''
+            INSERT INTO run_activities (activity_id, user_id, name, start_date, distance_km, moving_time_min,
+                                        avg_hr, max_hr, suffer_score, trimp_score)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', run_rows(user_id, count, now, seed=k, id_base=k * runs_per_user))
+        c.executemany("INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                      chat_rows(user_id, count, now, seed=k))
+    conn.commit()
+    conn.close()
+    rebuild_volume_rollups()
+    return users
+
+# ---------- A. Stream processing ----------
+def bench_streams(bench: Bench, sizes: Sequence[int]):
+    for n in sizes:
+        tag = f"[n={n}]"
+        streams = make_streams(n, "interval", seed=n)
+        client = StubStravaClient(streams)
+        t, hr, distance = streams["time"], streams["heartrate"], streams["distance"]
+
+        def cached_streams_id():
+            # Stream có sẵn trong LRU -> get_activity_data chỉ còn detail JSON + pandas CSV
+            activity_id = str(client.new_activity_ids(1)[0])
+            stream_cache.put((activity_id, tuple(STREAM_KEYS)), streams)
+            return activity_id
+
+        bench.measure(f"streams.fetch_parse{tag}", client.get_activity_streams,
+                      setup=lambda: str(client.new_activity_ids(1)[0]), samples=n)
+        bench.measure(f"streams.activity_csv{tag}", client.get_activity_data, setup=cached_streams_id, samples=n)
+        bench.measure(f"streams.stream_load{tag}", lambda: compute_stream_load(t, hr, MAX_HR, REST_HR, SEX), samples=n)
+        bench.measure(f"streams.mean_max_curve{tag}", lambda: mean_max_curve(t, distance, hr), samples=n)
+        bench.measure(f"streams.analyze{tag}", lambda: analyze_streams(streams), samples=n)
+        bench.measure(f"streams.segment_run{tag}", lambda: segment_run(streams, MAX_HR, REST_HR), samples=n)
+
+        _, _, meta = client.get_activity_data(cached_streams_id())
+        bench.measure(f"streams.pre_analysis_report{tag}",
+                      lambda: format_run_report(build_run_report(streams, meta, MAX_HR, REST_HR, SEX)), samples=n)
+        blob = pack_streams(streams)
+        bench.measure(f"streams.pack{tag}", lambda: pack_streams(streams), samples=n, blob_bytes=len(blob))
+        bench.measure(f"streams.unpack{tag}", lambda: unpack_streams(blob), samples=n, blob_bytes=len(blob))
+
+# ---------- B. SQLite upserts + load queries ----------
+def bench_database(bench: Bench, row_counts: Sequence[int], now: datetime):
+    today = now.date()
+    since_120d = (today - timedelta(days=119)).isoformat()
+    since_1y = (today - timedelta(days=364)).isoformat()
+    for rows in row_counts:
+        tag = f"[rows={rows}]"
+        start = time.perf_counter()
+        use_database(str(rows))
+        users = seed_database(rows, now)
+        print(f"  (seeded {rows} runs + {rows} messages for {len(users)} users in {time.perf_counter() - start:.1f}s)")
+
+        conn = get_db_connection()
+        existing = [dict(r) for r in conn.execute(
+            "SELECT * FROM run_activities WHERE user_id = ? ORDER BY start_date DESC LIMIT 50", (BENCH_USER,))]
+        conn.close()
+        updates, bump = itertools.cycle(existing), itertools.count(1)
+
+        def changed_activity():
+            # Hàng không đổi bị save_run_activity bỏ qua -> đổi TRIMP để đo đường ghi thật
+            activity = dict(next(updates))
+            activity["trimp_score"] = round(activity["trimp_score"] + next(bump) * 0.1, 1)
+            return activity
+
+        bench.measure(f"db.save_run_activity{tag}", lambda a: save_run_activity(BENCH_USER, a),
+                      setup=changed_activity, rows=rows)
+        bench.measure(f"db.save_run_activity_unchanged{tag}", lambda a: save_run_activity(BENCH_USER, a),
+                      setup=lambda: dict(next(updates)), rows=rows)
+        bench.measure(f"db.get_training_loads{tag}", lambda: get_training_loads(BENCH_USER), rows=rows)
+        bench.measure(f"db.get_daily_training{tag}",
+                      lambda: get_daily_training(BENCH_USER, since_120d, today.isoformat()), rows=rows)
+        bench.measure(f"db.get_recent_runs_log{tag}", lambda: get_recent_runs_log(BENCH_USER, limit=5), rows=rows)
+        bench.measure(f"db.get_volume_rollups{tag}",
+                      lambda: get_volume_rollups(BENCH_USER, "week", since=since_1y), rows=rows)
+        bench.measure(f"db.get_activities{tag}", lambda: get_activities(BENCH_USER, limit=20), rows=rows)
+        bench.measure(f"db.load_history{tag}", lambda: load_history_for_gemini(BENCH_USER, limit=50), rows=rows)
+        bench.measure(f"db.keyword_search{tag}", lambda: search_keyword_memory(BENCH_USER, "tempo interval"),
+                      rows=rows)
+        bench.measure(f"db.rebuild_rollups_user{tag}", lambda: rebuild_volume_rollups(BENCH_USER), rows=rows)
+
+# ---------- C. RAG memorize / recall ----------
+def seed_pipeline(now: datetime, docs: int):
+    """DB + Chroma cho stage RAG / prompt / end-to-end: BENCH_USER với lịch sử vừa phải và `docs` ký ức."""
+    use_database("pipeline")
+    seed_database(PIPELINE_RUNS, now, runs_per_user=PIPELINE_RUNS)
+    texts = [text for _, _, text, _ in chat_rows(BENCH_USER, docs, now, seed=7)]
+    embedder = StubEmbedder()
+    for offset in range(0, docs, 500):
+        batch = texts[offset:offset + 500]
+        ids = [f"seed-{offset + i}" for i in range(len(batch))]
+        rag_db.collection.upsert(ids=ids, documents=batch, embeddings=embedder.embed(batch),
+                                 metadatas=[{"domain": "coach", "user_id": BENCH_USER, "type": "run_analysis"}] * len(batch))
+        for doc_id, text in zip(ids, batch):
+            index_memory_text(doc_id, BENCH_USER, text, source="run_analysis")
+    rag_db.cache.invalidate()
+
+def bench_rag(bench: Bench, docs: int):
+    tag = f"[docs={docs}]"
+    counter = itertools.count()
+
+    def invalidate():
+        rag_db.cache.invalidate(BENCH_USER)
+
+    bench.measure(f"rag.memorize{tag}",
+                  lambda doc_id: rag_db.memorize(doc_id, f"Bài tempo số {doc_id}: giữ nhịp tốt, HR ổn định.", "coach",
+                                                 {"user_id": BENCH_USER, "type": "run_analysis"}),
+                  setup=lambda: f"bench-mem-{next(counter)}", docs=docs)
+    bench.measure(f"rag.recall{tag}",
+                  lambda _: rag_db.recall(RECALL_QUERY, domain="coach", n_results=5, user_id=BENCH_USER),
+                  setup=invalidate, docs=docs)
+    bench.measure(f"rag.recall_cached{tag}",
+                  lambda: rag_db.recall(RECALL_QUERY, domain="coach", n_results=5, user_id=BENCH_USER), docs=docs)
+    bench.measure(f"rag.hybrid_recall{tag}",
+                  lambda _: rag_db.hybrid_recall(RECALL_QUERY, BENCH_USER), setup=invalidate, docs=docs)
+
+# ---------- D + E. Prompt build + end-to-end ----------
+def bench_pipeline(bench: Bench, client: StubStravaClient):
+    config = get_config().data
+    streams = client.streams
+    name, csv_data, meta = client.get_activity_data(str(client.new_activity_ids(1)[0]))
+    meta["stream_metrics"] = analyze_streams(streams)
+    samples = len(streams["time"])
+
+    bench.measure("pipeline.analyze_run",
+                  lambda activity_id: agent.analyze_run_with_gemini(activity_id, name, csv_data, meta, config,
+                                                                    user_id=BENCH_USER, streams=streams),
+                  setup=lambda: str(client.new_activity_ids(1)[0]), samples=samples)
+
+    def new_recent():
+        client.recent_ids = client.new_activity_ids(client.recent_limit)
+        return get_user(BENCH_USER)
+
+    bench.measure("e2e.harvest_user_cold", harvest_user, setup=new_recent,
+                  samples=samples, activities=client.recent_limit)
+    bench.measure("e2e.harvest_user_warm", harvest_user, setup=lambda: get_user(BENCH_USER),
+                  samples=samples, activities=client.recent_limit)
+    bench.measure("e2e.strava_webhook", lambda activity_id: run_strava_workflow(activity_id, owner_id=BENCH_ATHLETE),
+                  setup=lambda: str(client.new_activity_ids(1)[0]), samples=samples)
+
+STAGES = ("streams", "db", "rag", "pipeline")
+
+def run_all(bench: Bench, sizes: Sequence[int], row_counts: Sequence[int], docs: int,
+            stages: Sequence[str] = STAGES) -> Dict[str, Dict]:
+    now = datetime.now()
+    client = StubStravaClient(make_streams(PIPELINE_SAMPLES, "tempo", seed=1))
+    install_stubs(client)
+
+    if "streams" in stages:
+        print("[A] Stream processing")
+        bench_streams(bench, sizes)
+    if "db" in stages:
+        print("[B] SQLite upserts + load queries")
+        bench_database(bench, row_counts, now)
+    if "rag" in stages or "pipeline" in stages:
+        seed_pipeline(now, docs)
+    if "rag" in stages:
+        print("[C] RAG memorize / recall")
+        bench_rag(bench, docs)
+    if "pipeline" in stages:
+        print("[D+E] Prompt build + end-to-end (stub Strava / Gemini)")
+        bench_pipeline(bench, client)
+    return bench.results
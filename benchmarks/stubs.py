@@ -0,0 +1,119 @@
+import json
+import time
+import hashlib
+import itertools
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.agents.coach.strava_client import StravaClient
+from benchmarks.synthetic import activity_detail, activity_summary, streams_payload, iso_start
+
+# ==========================================
+# 🧱 STUBS (Strava / Gemini / Embedding không cần mạng)
+# ==========================================
+# Chỉ thay tầng I/O: body Strava được serialize sẵn thành JSON và parse lại ở mỗi request
+# (chi phí json.loads giống thật), mọi code xử lý phía sau vẫn là code của app.
+
+class StubResponse:
+    def __init__(self, text: str, status_code: int = 200):
+        self.text = text
+        self.status_code = status_code
+        self.headers: Dict[str, str] = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+class StubStravaClient(StravaClient):
+    """
+    StravaClient thật với `_request` trả payload dựng sẵn. Mọi bài chạy dùng chung 1 bộ stream mẫu,
+    id bài chạy do `new_activity_ids` cấp (id mới -> bỏ qua stream_cache/SQLite, đo đường cold).
+    Không đi qua rate limiter (benchmark gọi hàng trăm request liên tục).
+    """
+    _ids = itertools.count(10_000_000)
+
+    def __init__(self, streams: Dict[str, np.ndarray], recent_limit: int = 10):
+        super().__init__(refresh_token="bench", access_token="bench", expires_at=int(time.time()) + 10 ** 8)
+        self.streams = streams
+        self.streams_text = json.dumps(streams_payload(streams))
+        self.detail_text = json.dumps(activity_detail(streams, 0, iso_start(0, datetime.now())))
+        self.recent_limit = recent_limit
+        self.recent_ids: List[int] = self.new_activity_ids(recent_limit)
+        self.requests = 0
+
+    @classmethod
+    def new_activity_ids(cls, count: int) -> List[int]:
+        return [next(cls._ids) for _ in range(count)]
+
+    def recent_text(self) -> str:
+        """Danh sách /athlete/activities (mới nhất trước), 1 bài/ngày."""
+        now = datetime.now()
+        return json.dumps([activity_summary(self.streams, activity_id, iso_start(i, now))
+                           for i, activity_id in enumerate(reversed(self.recent_ids))])
+
+    def _request(self, method: str, url: str, **kwargs):
+        self.requests += 1
+        if method == "PUT":
+            return StubResponse("{}")
+        if url.endswith("/streams"):
+            return StubResponse(self.streams_text)
+        if url.endswith("/athlete/activities"):
+            return StubResponse(self.recent_text())
+        return StubResponse(self.detail_text)
+
+class StubChat:
+    def __init__(self, reply: str):
+        self.reply = reply
+
+    def send_message(self, message):
+        usage = SimpleNamespace(prompt_token_count=len(str(message)) // 4, candidates_token_count=len(self.reply) // 4)
+        return SimpleNamespace(text=self.reply, usage_metadata=usage)
+
+class StubGenaiClient:
+    """Thay `genai.Client`: chats.create(...) -> chat trả lời cố định, ghi lại config/history để kiểm tra prompt."""
+    def __init__(self, reply: str = "🔥 PHÂN TÍCH NHỊP TIM\nỔn định.\n\n🎯 KẾT LUẬN\nGiữ nhịp.\n\n---\n🤖 AI Coach"):
+        self.reply = reply
+        self.last_create: Optional[Dict] = None
+        self.chats = SimpleNamespace(create=self._create)
+
+    def _create(self, model=None, history=None, config=None, **kwargs):
+        self.last_create = {"model": model, "history": history, "config": config}
+        return StubChat(self.reply)
+
+class StubEmbedder:
+    """
+    Embedding giả 384 chiều (cùng kích thước MiniLM): băm từng từ vào 1 chiều rồi chuẩn hóa L2.
+    Tất định và có ngữ nghĩa thô (văn bản chung từ -> gần nhau), không cần model ONNX.
+    """
+    DIM = 384
+
+    def _vector(self, text: str) -> List[float]:
+        vec = np.zeros(self.DIM, dtype=np.float32)
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode(), digest_size=4).digest()
+            vec[int.from_bytes(digest, "little") % self.DIM] += 1.0
+        norm = float(np.linalg.norm(vec)) or 1.0
+        return (vec / norm).tolist()
+
+    def embed(self, texts: List[str], priority: int = 0) -> List[List[float]]:
+        return [self._vector(text) for text in texts]
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self.embed(input)
+
+def install_stubs(strava_client: StravaClient) -> StubGenaiClient:
+    """Gắn stub vào các module của app (gọi sau khi bootstrap môi trường benchmark)."""
+    from app.agents.coach import agent, harvest
+    from app.routers import webhooks
+    from app.services.rag_memory import rag_db
+
+    llm = StubGenaiClient()
+    agent.client = llm
+    rag_db.embed_fn = StubEmbedder()
+    harvest.get_strava_client = lambda user: strava_client
+    webhooks.get_strava_client = lambda user: strava_client
+    webhooks.send_telegram_msg = lambda chat_id, text: None
+    webhooks.send_html_email = lambda subject, html_content, config: None
+    return llm
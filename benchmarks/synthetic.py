@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+# ==========================================
+# 🧪 SYNTHETIC DATA (stream + payload Strava + hàng SQLite)
+# ==========================================
+# Stream 1 Hz giống thiết bị thật: khởi động, phần chính (easy / tempo / interval), thả lỏng,
+# 1 lần dừng đèn đỏ, 1 khoảng auto-pause, HR trễ theo tốc độ + drift, dốc hình sin.
+# Mọi hàm nhận seed -> cùng tham số luôn ra cùng dữ liệu (so sánh baseline được).
+
+BENCH_USER = "900001"        # VĐV được đo (cũng là TELEGRAM_CHAT_ID của môi trường benchmark)
+BENCH_ATHLETE = "7700001"
+STREAM_SIZES = (1800, 7200, 21600)  # 30 phút, 2 giờ, 6 giờ
+HR_LAG_S = 20
+AUTO_PAUSE_S = 90
+
+def _speed_profile(samples: int, workout: str) -> np.ndarray:
+    speed = np.full(samples, 2.9)
+    warmup = min(600, samples // 6)
+    cooldown = samples - min(600, samples // 8)
+    speed[:warmup] = 2.6
+    speed[cooldown:] = 2.5
+    if workout == "tempo":
+        speed[warmup + (cooldown - warmup) // 4:cooldown - (cooldown - warmup) // 4] = 3.7
+    elif workout == "interval":
+        phase = (np.arange(samples) - warmup) % 300
+        main = np.zeros(samples, dtype=bool)
+        main[warmup:cooldown] = True
+        speed[main & (phase < 180)] = 4.2
+        speed[main & (phase >= 180)] = 2.4
+    return speed
+
+def make_streams(samples: int, workout: str = "interval", seed: int = 0) -> Dict[str, np.ndarray]:
+    """{key: np.ndarray float32} cùng định dạng StravaClient.get_activity_streams trả về."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(samples, dtype=np.float64)
+    t[int(samples * 0.4):] += AUTO_PAUSE_S
+
+    speed = _speed_profile(samples, workout) + rng.normal(0, 0.08, samples)
+    stop = int(samples * 0.6)
+    speed[stop:stop + 60] = 0.0
+    speed = np.clip(speed, 0, None)
+
+    # HR bám theo tốc độ với độ trễ ~20 giây (kernel mũ) + cardiac drift ~5 bpm/giờ
+    target = np.clip(60 + 30 * speed, 95, 182)
+    kernel = np.exp(-np.arange(6 * HR_LAG_S) / HR_LAG_S)
+    padded = np.concatenate((np.full(kernel.size - 1, target[0]), target))
+    hr = np.convolve(padded, kernel / kernel.sum(), mode="valid")
+    hr += t / 3600 * 5 + rng.normal(0, 1.5, samples)
+
+    grade = 4 * np.sin(2 * np.pi * t / 600)
+    streams = {
+        "time": t,
+        "distance": np.cumsum(speed),
+        "heartrate": np.round(hr),
+        "velocity_smooth": speed,
+        "cadence": np.round(np.where(speed > 0.3, 75 + 4 * speed + rng.normal(0, 1, samples), 0)),
+        "grade_smooth": np.round(grade, 1),
+        "altitude": 10 + np.cumsum(speed * grade / 100),
+        "moving": (speed > 0.3).astype(np.float64),
+        "watts": np.round(np.clip(60 * speed + 20 * grade + rng.normal(0, 5, samples), 0, None)),
+    }
+    return {key: values.astype(np.float32) for key, values in streams.items()}
+
+def streams_payload(streams: Dict[str, np.ndarray]) -> Dict:
+    """Body của GET /activities/{id}/streams?key_by_type=true."""
+    return {key: {"data": np.round(values.astype(np.float64), 2).tolist(), "series_type": "time",
+                  "original_size": int(values.size), "resolution": "high"} for key, values in streams.items()}
+
+def _km_chunks(streams: Dict[str, np.ndarray]) -> List[Tuple[int, int]]:
+    distance = streams["distance"]
+    marks = np.searchsorted(distance, np.arange(1000.0, float(distance[-1]), 1000.0))
+    bounds = np.concatenate(([0], marks, [distance.size - 1]))
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+def activity_detail(streams: Dict[str, np.ndarray], activity_id: int, start_date: str,
+                    name: str = "Bench Run") -> Dict:
+    """Body của GET /activities/{id} (splits_metric + auto-lap 1 km như Garmin)."""
+    t, distance, hr = streams["time"], streams["distance"], streams["heartrate"]
+    splits, laps = [], []
+    for i, (a, b) in enumerate(_km_chunks(streams), start=1):
+        elapsed = float(t[b] - t[a]) or 1.0
+        dist = float(distance[b] - distance[a])
+        avg_hr = round(float(hr[a:b].mean()), 1)
+        splits.append({"split": i, "distance": dist, "elapsed_time": elapsed, "moving_time": elapsed,
+                       "average_speed": dist / elapsed, "average_heartrate": avg_hr})
+        laps.append({"name": f"Lap {i}", "distance": dist, "elapsed_time": elapsed, "average_speed": dist / elapsed,
+                     "average_heartrate": avg_hr, "start_index": a, "end_index": b})
+    return {
+        **activity_summary(streams, activity_id, start_date, name),
+        "device_name": "Bench Watch",
+        "splits_metric": splits,
+        "laps": laps,
+        "best_efforts": [],
+    }
+
+def activity_summary(streams: Dict[str, np.ndarray], activity_id: int, start_date: str,
+                     name: str = "Bench Run") -> Dict:
+    """1 phần tử của GET /athlete/activities."""
+    moving = streams["velocity_smooth"] > 0.3
+    return {
+        "id": activity_id, "name": name, "type": "Run", "start_date_local": start_date,
+        "distance": float(streams["distance"][-1]), "moving_time": int(moving.sum()),
+        "average_heartrate": round(float(streams["heartrate"][moving].mean()), 1),
+        "max_heartrate": float(streams["heartrate"].max()), "suffer_score": 42,
+    }
+
+def iso_start(days_ago: float, now: datetime) -> str:
+    return (now - timedelta(days=days_ago)).replace(hour=6, minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def run_rows(user_id: str, count: int, now: datetime, seed: int = 0, id_base: int = 0) -> Iterator[Tuple]:
+    """Hàng run_activities (~1 bài / 1.2 ngày lùi dần về quá khứ) cho executemany."""
+    rng = np.random.default_rng(seed)
+    distance = np.round(rng.gamma(4.0, 2.5, count), 2)
+    pace_min = rng.uniform(5.0, 7.0, count)
+    avg_hr = rng.integers(130, 175, count)
+    for i in range(count):
+        moving = round(float(distance[i] * pace_min[i]), 2)
+        yield (str(id_base + i), user_id, f"Run #{i}", iso_start(i * 1.2, now), float(distance[i]), moving,
+               int(avg_hr[i]), int(avg_hr[i]) + 12, 40, round(moving * (avg_hr[i] - 55) / 130 * 1.2, 1))
+
+def chat_rows(user_id: str, count: int, now: datetime, seed: int = 0) -> Iterator[Tuple]:
+    """Hàng chat_history xen kẽ user/model, timestamp tăng dần."""
+    rng = np.random.default_rng(seed)
+    words = ("tempo", "interval", "easy", "long run", "HR", "pace", "recovery", "race", "taper", "cadence")
+    picks = rng.integers(0, len(words), (count, 3))
+    start = now - timedelta(minutes=count)
+    for i in range(count):
+        topic = " ".join(words[j] for j in picks[i])
+        role, text = ("user", f"Hôm nay chạy {topic} thấy sao coach?") if i % 2 == 0 else \
+                     ("model", f"Bài {topic} ổn, giữ nhịp tim vùng 2 và ngủ đủ giấc.")
+        yield user_id, role, text, (start + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S")